@@ -0,0 +1,286 @@
+import os
+import math
+import time
+import tempfile
+import contextlib
+import numpy as np
+import util
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Iterator
+from csr import CSRGraph
+from contraction import ContractionHierarchy
+from graph import Location, Router, nearest_nodes
+
+"""
+Route many start and end pairs at once, spread over worker processes
+The prepared search arrays are written once as .npy files and memory mapped by
+every worker, so the networkx graph is never pickled into a worker
+"""
+
+
+# Engines that can run in a worker, they only need the prepared arrays
+batch_engines = ["dijkstra", "astar", "bidirectional", "contraction"]
+
+# Most routes a worker routes in one go
+_max_chunk = 1000
+
+# Searches of this worker process, set up by `load_shared_search`
+_worker_search: Callable[[int, int], list[int]] | None = None
+# Search trees by weighted cost (False) and by metres (True)
+_worker_trees: dict[bool, CSRGraph] = {}
+
+
+# Get the shortest path of each (start, end) pair
+# Pairs whose points snap to the same node, or that have no path, get an empty path
+# Routes in-process if workers is 1
+def shortest_paths(
+    router: Router,
+    pairs: list[tuple[Location, Location]],
+    engine: str = "dijkstra",
+    workers: int | None = None,
+) -> list[list[tuple[float, float]]]:
+    return list(iter_shortest_paths(router, pairs, engine, workers))
+
+
+# Same as `shortest_paths`, but yields each path in order as soon as it is found
+# Only the paths of the chunks in flight are held, so they can be written out as
+# they come, such as by `export.export_paths`
+def iter_shortest_paths(
+    router: Router,
+    pairs: list[tuple[Location, Location]],
+    engine: str = "dijkstra",
+    workers: int | None = None,
+) -> Iterator[list[tuple[float, float]]]:
+    if engine not in batch_engines:
+        raise Exception(
+            f'Engine "{engine}" cannot route in batches, choose one of {batch_engines}'
+        )
+    if len(pairs) == 0:
+        return
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # Snap every point in one query, workers only ever see node ids
+    points: list[Location] = [point for pair in pairs for point in pair]
+    ids: dict[tuple[float, float], int] = search_ids(router, engine)
+    snapped: list[int] = [ids[node] for node in nearest_nodes(router.graph, points)]
+    queries: list[tuple[int, int]] = list(zip(snapped[::2], snapped[1::2]))
+
+    start: float = time.perf_counter()
+    empty: int = 0
+    with tempfile.TemporaryDirectory(prefix="routes_") as folder:
+        nodes: list[tuple[float, float]] = share_search(router, engine, folder)
+        # Chunks are routed and yielded in order, a few per worker so workers
+        # finishing early pick up more, and at most _max_chunk routes each so
+        # the paths waiting to be yielded stay few
+        chunk_size: int = min(math.ceil(len(queries) / (workers * 4)), _max_chunk)
+        chunks: list[list[tuple[int, int]]] = [
+            queries[i : i + chunk_size] for i in range(0, len(queries), chunk_size)
+        ]
+        with contextlib.ExitStack() as stack:
+            if workers == 1:
+                load_shared_search(folder, engine)
+                results: Iterator[list[list[int]]] = map(_route_chunk, chunks)
+            else:
+                executor: ProcessPoolExecutor = stack.enter_context(
+                    ProcessPoolExecutor(
+                        max_workers=workers,
+                        initializer=load_shared_search,
+                        initargs=(folder, engine),
+                    )
+                )
+                results = _map_in_order(executor, _route_chunk, chunks, 2 * workers)
+            for chunk in results:
+                for path in chunk:
+                    empty += len(path) == 0
+                    yield [nodes[i] for i in path]
+    elapsed: float = time.perf_counter() - start
+
+    if empty > 0:
+        util.warning(f"{empty} of {len(pairs)} pairs have no path")
+    util.info(
+        f"Routed {len(pairs)} pairs in {elapsed:.1f} s with {workers} workers, "
+        f"{len(pairs) / max(elapsed, 1e-9):.0f} routes/s"
+    )
+
+
+# Map a function over items in an executor, yielding results in order
+# At most window items are in flight, so results waiting to be taken stay bounded
+def _map_in_order(
+    executor: ProcessPoolExecutor,
+    function: Callable,
+    items: list,
+    window: int,
+) -> Iterator:
+    pending: deque[Future] = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+# Read (start, end) pairs from a CSV file
+# Columns are start_lon, start_lat, end_lon and end_lat
+def read_pairs_csv(path: str) -> list[tuple[Location, Location]]:
+    # pandas is slow to import, and only needed to read the pairs
+    import pandas as pd
+
+    columns: list[str] = ["start_lon", "start_lat", "end_lon", "end_lat"]
+    table: pd.DataFrame = pd.read_csv(path)
+    missing: list[str] = [column for column in columns if column not in table]
+    if len(missing) > 0:
+        raise Exception(f'"{path}" is missing the columns {missing}')
+    return [
+        (Location(start_lon, start_lat), Location(end_lon, end_lat))
+        for start_lon, start_lat, end_lon, end_lat in table[columns].itertuples(
+            index=False
+        )
+    ]
+
+
+# Node ids of the structure an engine searches
+def search_ids(router: Router, engine: str) -> dict[tuple[float, float], int]:
+    if engine == "contraction":
+        return router.prepare_contraction().ids
+    return router.prepare_csr().ids
+
+
+# Write the arrays workers need to search with an engine, and to grow search
+# trees by cost or by metres, to a folder as .npy files
+# Returns the nodes, indexed by the ids that workers return
+def share_search(router: Router, engine: str, folder: str) -> list[tuple[float, float]]:
+    if engine not in batch_engines:
+        raise Exception(
+            f'Engine "{engine}" cannot run in a worker, choose one of {batch_engines}'
+        )
+    return write_search(
+        folder,
+        engine,
+        router.prepare_csr(),
+        router.prepare_length_csr(),
+        router.prepare_contraction() if engine == "contraction" else None,
+    )
+
+
+# Same as `share_search`, with the prepared structures given instead of a router,
+# so it can run in a thread while the router is changed elsewhere
+def write_search(
+    folder: str,
+    engine: str,
+    csr: CSRGraph,
+    length_csr: CSRGraph,
+    hierarchy: ContractionHierarchy | None = None,
+) -> list[tuple[float, float]]:
+    arrays: dict[str, np.ndarray] = {
+        "coordinates": csr.coordinates,
+        "indptr": csr.indptr,
+        "indices": csr.indices,
+        "weights": csr.weights,
+        "lengths": length_csr.weights,
+        "heuristic_scales": np.array(
+            [csr.heuristic_scale, length_csr.heuristic_scale], dtype=np.float64
+        ),
+    }
+    nodes: list[tuple[float, float]] = csr.nodes
+    if engine == "astar":
+        arrays["landmarks"] = csr.landmark_distances()
+    if engine == "contraction":
+        arrays.update(
+            {
+                "contraction_coordinates": hierarchy.coordinates,
+                "contraction_rank": hierarchy.rank,
+                "contraction_indptr": hierarchy.indptr,
+                "contraction_indices": hierarchy.indices,
+                "contraction_weights": hierarchy.weights,
+                "contraction_middles": hierarchy.middles,
+            }
+        )
+        nodes = hierarchy.nodes
+
+    for name, array in arrays.items():
+        np.save(os.path.join(folder, f"{name}.npy"), array)
+    return nodes
+
+
+# Set up the searches of a worker from the arrays written by `share_search`
+# The arrays are memory mapped and searched where they are, so every worker reads
+# the same pages, nodes are only looked up by the process that shared them
+def load_shared_search(folder: str, engine: str) -> None:
+    global _worker_search, _worker_trees
+
+    def load(name: str) -> np.ndarray:
+        return np.load(os.path.join(folder, f"{name}.npy"), mmap_mode="r")
+
+    coordinates: np.ndarray = load("coordinates")
+    indptr, indices = load("indptr"), load("indices")
+    scale, length_scale = load("heuristic_scales").tolist()
+    csr: CSRGraph = CSRGraph(
+        coordinates,
+        indptr,
+        indices,
+        load("weights"),
+        shared=True,
+        heuristic_scale=scale,
+        landmarks=load("landmarks") if engine == "astar" else None,
+    )
+    _worker_trees = {
+        False: csr,
+        True: CSRGraph(
+            coordinates,
+            indptr,
+            indices,
+            load("lengths"),
+            shared=True,
+            heuristic_scale=length_scale,
+        ),
+    }
+
+    if engine == "contraction":
+        hierarchy: ContractionHierarchy = ContractionHierarchy(
+            load("contraction_coordinates"),
+            load("contraction_rank"),
+            load("contraction_indptr"),
+            load("contraction_indices"),
+            load("contraction_weights"),
+            load("contraction_middles"),
+            shared=True,
+        )
+        _worker_search = hierarchy.shortest_path
+    else:
+        _worker_search = getattr(csr, engine)
+
+
+# In a worker, the shortest path between two node ids, empty if there is none
+def worker_route(source: int, target: int) -> list[int]:
+    if source == target:
+        return []
+    try:
+        return _worker_search(source, target)
+    except Exception:
+        return []
+
+
+# In a worker, the shortest path between two ids of the search tree arrays by
+# Dijkstra's, empty if there is none, for when the arrays of the engine are stale
+def worker_tree_route(source: int, target: int) -> list[int]:
+    if source == target:
+        return []
+    try:
+        return _worker_trees[False].dijkstra(source, target)
+    except Exception:
+        return []
+
+
+# In a worker, the distance to every node within a limit of a node id
+# The limit is in metres, or in weighted cost if metres is False
+def worker_reach(source: int, limit: float, metres: bool) -> dict[int, float]:
+    settled, _ = _worker_trees[metres].search_tree(source, limit=limit)
+    return settled
+
+
+# Route a chunk of (source, target) node id pairs in a worker
+def _route_chunk(queries: list[tuple[int, int]]) -> list[list[int]]:
+    return [worker_route(source, target) for source, target in queries]
@@ -0,0 +1,822 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import platform
+import tempfile
+import subprocess
+import contextlib
+import multiprocessing
+import numpy as np
+import networkx as nx
+import shapely
+import geopandas as gpd
+import main
+from datetime import datetime
+from typing import Callable
+from shapely.geometry import LineString, box
+from compact import CompactGraph, networkx_memory_bytes
+from landuse_raster import LandUseRaster
+from render import render_route_map
+from util import (
+    info,
+    warning,
+    gdf_to_graph,
+    segment,
+    split_geometry,
+    process_memory_mb,
+)
+from csr import CSRGraph, haversine
+from batch import load_shared_search, share_search, worker_route
+from graph import (
+    EdgeColumns,
+    Location,
+    alternative_paths,
+    close_edges,
+    largest_component,
+    nearest_edges,
+    nearest_node,
+    nearest_nodes,
+    prepare_router,
+    remove_override,
+    select_edges,
+    shortest_path,
+)
+
+"""
+Benchmark the hot paths of the planner on synthetic data, no OSM download needed
+Road networks are square grids and land use is random rectangles, both scaled
+by a grid size, so timings can be compared across sizes and across commits
+Results are written as JSON, with the memory of the graph as networkx and compact,
+how closely the land use raster matches the land use polygons, how long it
+takes to build and how much memory building it takes, up to the whole Lower
+Mainland, how much
+shorter routes are when points snap onto the nearest edge, how much faster
+roads are split into segments than one segment at a time, how long maps take
+to draw, how much memory worker processes searching shared arrays take, and how
+much memory routing on a graph read from the graph cache takes
+
+Usage: python3 benchmark.py [--sizes=10,20,40] [--repeat=5] [--output=<json>]
+                            [--compare=<older json>]
+"""
+
+
+# Distance between neighbouring grid roads in degrees, about a city block
+_block = 0.001
+
+# South west corner of the synthetic grids, in Vancouver
+_origin = (-123.145, 49.271)
+
+# Road classes and speeds the grid roads are drawn from
+_road_classes = ["footway", "residential", "path", "service", "tertiary", "track"]
+_road_speeds = [0, 30, 50]
+
+# Extent of the Lower Mainland as (west, south, east, north), the land use raster
+# is also built over all of it, with this many land use rectangles
+_region = (-123.3, 49.0, -121.8, 49.7)
+_region_landuse = 50000
+
+# Land use classes the rectangles are drawn from, "weird" has no niceness score
+_landuse_classes = ["park", "residential", "industrial", "retail", "farmland", "weird"]
+
+
+# Square grid of roads, size roads running east to west and size north to south
+# Each road passes through every intersection, so it splits into size - 1 segments
+def synthetic_roads(size: int, seed: int = 0) -> gpd.GeoDataFrame:
+    rng = random.Random(seed)
+    xs: np.ndarray = _origin[0] + _block * np.arange(size)
+    ys: np.ndarray = _origin[1] + _block * np.arange(size)
+    rows: list[dict] = []
+    for i in range(size):
+        for name, line in [
+            (f"Street {i}", LineString(np.column_stack([xs, np.full(size, ys[i])]))),
+            (f"Avenue {i}", LineString(np.column_stack([np.full(size, xs[i]), ys]))),
+        ]:
+            rows.append(
+                {
+                    "osm_id": str(len(rows)),
+                    "fclass": rng.choice(_road_classes),
+                    "name": name,
+                    "maxspeed": rng.choice(_road_speeds),
+                    "geometry": line,
+                }
+            )
+    return gpd.GeoDataFrame(rows, crs="EPSG:4326")
+
+
+# Random rectangles of land use over a grid of roads, about one per 4 blocks
+def synthetic_landuse(size: int, seed: int = 1) -> gpd.GeoDataFrame:
+    rng = random.Random(seed)
+    extent: float = _block * (size - 1)
+    rows: list[dict] = []
+    for _ in range(max(size * size // 4, 1)):
+        x: float = _origin[0] + rng.uniform(0, extent)
+        y: float = _origin[1] + rng.uniform(0, extent)
+        width: float = rng.uniform(0.5, 3) * _block
+        rows.append(
+            {
+                "fclass": rng.choice(_landuse_classes),
+                "geometry": box(x, y, x + width, y + width),
+            }
+        )
+    return gpd.GeoDataFrame(rows, crs="EPSG:4326")
+
+
+# Random rectangles of land use over an extent as (west, south, east, north), of
+# the sizes `synthetic_landuse` draws
+def synthetic_region_landuse(
+    bounds: tuple[float, float, float, float], count: int, seed: int = 3
+) -> gpd.GeoDataFrame:
+    rng = random.Random(seed)
+    west, south, east, north = bounds
+    rows: list[dict] = []
+    for _ in range(count):
+        width: float = rng.uniform(0.5, 3) * _block
+        x: float = rng.uniform(west, east - width)
+        y: float = rng.uniform(south, north - width)
+        rows.append(
+            {
+                "fclass": rng.choice(_landuse_classes),
+                "geometry": box(x, y, x + width, y + width),
+            }
+        )
+    return gpd.GeoDataFrame(rows, crs="EPSG:4326")
+
+
+# Random points within a grid of roads
+def synthetic_points(size: int, count: int, seed: int = 2) -> list[Location]:
+    rng = random.Random(seed)
+    extent: float = _block * (size - 1)
+    return [
+        Location(
+            _origin[0] + rng.uniform(0, extent), _origin[1] + rng.uniform(0, extent)
+        )
+        for _ in range(count)
+    ]
+
+
+# Run every benchmark at each size
+def run_benchmarks(sizes: list[int], repeat: int = 5) -> list[dict]:
+    results: list[dict] = []
+    for size in sizes:
+        info(f"Benchmarking a grid of {size} by {size} roads")
+        results.extend(_benchmark_size(size, repeat))
+    return results
+
+
+# Print how much slower or faster each result is than in an older run
+def compare_results(older: list[dict], newer: list[dict]) -> None:
+    before: dict[tuple[str, int], float] = {
+        (result["name"], result["size"]): result["seconds"] for result in older
+    }
+    for result in newer:
+        key: tuple[str, int] = (result["name"], result["size"])
+        if key not in before:
+            continue
+        ratio: float = result["seconds"] / before[key]
+        message: str = (
+            f"{result['name']:<22} size {result['size']:>4}: "
+            f"{before[key] * 1000:10.3f} ms -> {result['seconds'] * 1000:10.3f} ms "
+            f"({ratio:.2f}x)"
+        )
+        # More than 10% slower is flagged, timings are noisy below that
+        if ratio > 1.1:
+            warning(message)
+        else:
+            info(message)
+
+
+# Run every benchmark on a grid of one size
+def _benchmark_size(size: int, repeat: int) -> list[dict]:
+    roads: gpd.GeoDataFrame = synthetic_roads(size)
+    landuse: gpd.GeoDataFrame = synthetic_landuse(size)
+    points: list[Location] = synthetic_points(size, 100)
+    pairs: list[tuple[Location, Location]] = list(
+        zip(synthetic_points(size, 20, seed=3), synthetic_points(size, 20, seed=4))
+    )
+
+    segments: gpd.GeoDataFrame = split_geometry(roads)
+    graph: nx.MultiGraph = largest_component(gdf_to_graph(segments)).copy()
+    counts: dict[str, int] = {
+        "nodes": graph.number_of_nodes(),
+        "edges": graph.number_of_edges(),
+    }
+
+    # The niceness weights read land use from main, as when running main.py
+    main.landuse = landuse
+    main.node_niceness = main.score_landuse_niceness(graph, landuse)
+
+    # Build the indexes and weights once, the benchmarks time queries on them
+    nearest_node(graph, points[0])
+    nearest_edges(graph, points[:1])
+    shortest_path(graph, pairs[0][0], pairs[0][1], main.niceness)
+
+    compact: CompactGraph = CompactGraph.from_graph(graph)
+    columns: EdgeColumns = EdgeColumns(graph)
+    raster: LandUseRaster = main.build_landuse_raster(landuse)
+
+    # Roads around the middle of the grid, as closed for construction
+    middle: float = _block * (size - 1) / 2
+    closed_area = box(
+        _origin[0] + middle - _block,
+        _origin[1] + middle - _block,
+        _origin[0] + middle + _block,
+        _origin[1] + middle + _block,
+    )
+    closed: list[tuple] = select_edges(graph, area=closed_area)
+
+    paths: list[list[tuple[float, float]]] = [
+        shortest_path(graph, start, end, main.niceness) for start, end in pairs
+    ]
+
+    def save_gpx() -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            # Each saved file is reported, keep the benchmark output readable
+            with contextlib.redirect_stdout(io.StringIO()):
+                main.save_paths_as_gpx(paths, directory=directory)
+
+    benchmarks: list[tuple[str, Callable[[], object], int]] = [
+        ("nearest_node", lambda: [nearest_node(graph, p) for p in points], len(points)),
+        ("nearest_nodes", lambda: nearest_nodes(graph, points), len(points)),
+        ("nearest_edges", lambda: nearest_edges(graph, points), len(points)),
+        (
+            "shortest_path",
+            lambda: [shortest_path(graph, s, e, main.niceness) for s, e in pairs],
+            len(pairs),
+        ),
+        (
+            "shortest_path_dijkstra",
+            lambda: [
+                shortest_path(graph, s, e, main.niceness, "dijkstra") for s, e in pairs
+            ],
+            len(pairs),
+        ),
+        (
+            "shortest_path_astar",
+            lambda: [
+                shortest_path(graph, s, e, main.niceness, "astar") for s, e in pairs
+            ],
+            len(pairs),
+        ),
+        # Three routes, against the one route of shortest_path_dijkstra
+        (
+            "alternative_paths",
+            lambda: [
+                alternative_paths(graph, s, e, main.niceness, 3) for s, e in pairs
+            ],
+            len(pairs),
+        ),
+        (
+            "shortest_path_edge_snap",
+            lambda: [
+                shortest_path(graph, s, e, main.niceness, "dijkstra", "edge")
+                for s, e in pairs
+            ],
+            len(pairs),
+        ),
+        (
+            "point_niceness",
+            lambda: [main.point_niceness(p) for p in points[:20]],
+            20,
+        ),
+        (
+            "score_landuse_niceness",
+            lambda: main.score_landuse_niceness(graph, landuse),
+            1,
+        ),
+        ("split_geometry", lambda: split_geometry(roads), 1),
+        (
+            "gdf_to_graph",
+            lambda: largest_component(gdf_to_graph(segments)),
+            1,
+        ),
+        ("save_paths_as_gpx", save_gpx, len(paths)),
+        ("edge_columns", lambda: EdgeColumns(graph), 1),
+        (
+            "edge_weights",
+            lambda: [function(columns) for function in main.weight_profiles.values()],
+            len(main.weight_profiles),
+        ),
+        ("compact_from_graph", lambda: CompactGraph.from_graph(graph), 1),
+        ("compact_to_graph", compact.to_graph, 1),
+        ("select_edges", lambda: select_edges(graph, area=closed_area), 1),
+        (
+            "close_and_reopen",
+            lambda: remove_override(graph, close_edges(graph, closed)),
+            1,
+        ),
+        ("build_landuse_raster", lambda: main.build_landuse_raster(landuse), 1),
+        (
+            "raster_point_niceness",
+            lambda: [raster.lookup(np.array(p)) for p in points[:20]],
+            20,
+        ),
+        (
+            "score_raster_niceness",
+            lambda: main.score_raster_niceness(graph, raster),
+            1,
+        ),
+    ]
+
+    results: list[dict] = []
+    for name, function, calls in benchmarks:
+        timings: list[float] = _time(function, repeat)
+        results.append(
+            {
+                "name": name,
+                "size": size,
+                **counts,
+                "calls": calls,
+                # Seconds per call, the median and the fastest of the repeats
+                "seconds": float(np.median(timings)) / calls,
+                "min_seconds": min(timings) / calls,
+                "repeat": repeat,
+            }
+        )
+        info(f"  {name:<22} {results[-1]['seconds'] * 1000:10.3f} ms per call")
+    return results
+
+
+# Memory of the networkx graph and of its compact form, at each size
+def graph_memory(sizes: list[int]) -> list[dict]:
+    results: list[dict] = []
+    for size in sizes:
+        segments: gpd.GeoDataFrame = split_geometry(synthetic_roads(size))
+        graph: nx.MultiGraph = largest_component(gdf_to_graph(segments)).copy()
+        main.score_landuse_niceness(graph, synthetic_landuse(size))
+        results.append(
+            {
+                "size": size,
+                "nodes": graph.number_of_nodes(),
+                "edges": graph.number_of_edges(),
+                "networkx_bytes": networkx_memory_bytes(graph),
+                "compact_bytes": CompactGraph.from_graph(graph).memory_bytes(),
+            }
+        )
+        info(
+            f"Graph of size {size:>4}: "
+            f"{results[-1]['networkx_bytes'] / 2**20:8.2f} MB as networkx, "
+            f"{results[-1]['compact_bytes'] / 2**20:8.2f} MB compact"
+        )
+    return results
+
+
+# Memory of worker processes routing on the arrays shared with them, at each size
+# Workers either search the memory mapped arrays where they are, as batch routing
+# and the server do, or copy them into lists first
+# Each worker measures itself once every worker has routed, so shared pages are
+# mapped by all of them
+def worker_memory(sizes: list[int], workers: int = 2, count: int = 200) -> list[dict]:
+    results: list[dict] = []
+    for size in sizes:
+        segments: gpd.GeoDataFrame = split_geometry(synthetic_roads(size))
+        graph: nx.MultiGraph = largest_component(gdf_to_graph(segments)).copy()
+        main.landuse = synthetic_landuse(size)
+        main.node_niceness = main.score_landuse_niceness(graph, main.landuse)
+        router = prepare_router(graph, main.niceness)
+        rng: np.random.Generator = np.random.default_rng(size)
+        queries: list[tuple[int, int]] = [
+            (int(source), int(target))
+            for source, target in rng.integers(len(graph), size=(count, 2))
+        ]
+
+        result: dict = {"size": size, "workers": workers}
+        with tempfile.TemporaryDirectory() as folder:
+            share_search(router, "dijkstra", folder)
+            result["shared_bytes"] = sum(
+                os.path.getsize(os.path.join(folder, name))
+                for name in os.listdir(folder)
+            )
+            # Spawned workers start without the pages of this process, so their
+            # memory is only what importing, loading and routing takes
+            context = multiprocessing.get_context("spawn")
+            for copy in [False, True]:
+                barrier = context.Barrier(workers)
+                pipes: list = [context.Pipe(duplex=False) for _ in range(workers)]
+                processes: list = [
+                    context.Process(
+                        target=_measure_worker,
+                        args=(folder, queries, copy, barrier, sender),
+                    )
+                    for _, sender in pipes
+                ]
+                for process in processes:
+                    process.start()
+                reports: list[dict] = [receiver.recv() for receiver, _ in pipes]
+                for process in processes:
+                    process.join()
+                result["copied" if copy else "shared"] = reports
+
+        for name in ["shared", "copied"]:
+            grew: str = ", ".join(
+                f"{report['after']['private'] - report['before']['private']:6.2f}"
+                for report in result[name]
+            )
+            resident: str = ", ".join(
+                f"{report['after']['rss']:6.1f}" for report in result[name]
+            )
+            info(
+                f"Workers of size {size:>4}, {name} arrays: "
+                f"{result['shared_bytes'] / 2**20:6.2f} MB shared, private memory "
+                f"grew {grew} MB, resident {resident} MB"
+            )
+        results.append(result)
+    return results
+
+
+# Engines and snapping routed with on a graph read from the graph cache
+_cache_load_routes = [("networkx", "node"), ("dijkstra", "node"), ("dijkstra", "edge")]
+
+
+# Peak memory of a process reading a graph from the graph cache and routing on
+# it, at each size, on the compact graph it reads or on the MultiGraph built from
+# it, as every run did before routing on the compact graph
+# Each is measured in a new process, as how much its peak resident memory grew
+def cache_memory(sizes: list[int], count: int = 20) -> list[dict]:
+    from cache_graph import cache_graph
+
+    results: list[dict] = []
+    for size in sizes:
+        segments: gpd.GeoDataFrame = split_geometry(synthetic_roads(size))
+        graph: nx.MultiGraph = largest_component(gdf_to_graph(segments)).copy()
+        main.node_niceness = main.score_landuse_niceness(graph, synthetic_landuse(size))
+        router = prepare_router(graph, main.niceness)
+        router.prepare()
+        points: list[Location] = synthetic_points(size, 2 * count, seed=6)
+
+        result: dict = {"size": size}
+        with tempfile.TemporaryDirectory() as folder:
+            path: str = os.path.join(folder, "graph.npz")
+            cache_graph(graph, "benchmark", router.edge_weights, path)
+            context = multiprocessing.get_context("spawn")
+            for kind in ["compact", "networkx"]:
+                for engine, snap in _cache_load_routes:
+                    receiver, sender = context.Pipe(duplex=False)
+                    process = context.Process(
+                        target=_measure_cache_load,
+                        args=(path, kind, engine, snap, points, sender),
+                    )
+                    process.start()
+                    result[f"{kind}:{engine}:{snap}"] = receiver.recv()
+                    process.join()
+        results.append(result)
+        for kind in ["compact", "networkx"]:
+            peaks: str = ", ".join(
+                f"{result[f'{kind}:{engine}:{snap}']:6.1f}"
+                for engine, snap in _cache_load_routes
+            )
+            info(
+                f"Cached graph of size {size:>4} as {kind:<8}: peak memory grew "
+                f"{peaks} MB routing with networkx, dijkstra and snapped onto edges"
+            )
+    return results
+
+
+# Read a cached graph in a new process and route on it, and report how much its
+# peak resident memory grew in MB
+# The peak is of this process alone, a spawned process does not inherit it
+def _measure_cache_load(
+    path: str,
+    kind: str,
+    engine: str,
+    snap: str,
+    points: list[Location],
+    connection,
+) -> None:
+    from cache_graph import read_graph_from_cache
+
+    before: float = process_memory_mb()["peak"]
+    graph, weights = read_graph_from_cache("benchmark", path)
+    if kind == "networkx":
+        graph = graph.to_graph()
+    router = prepare_router(graph, main.niceness, weights)
+    for start, end in zip(points[::2], points[1::2]):
+        router.shortest_path(start, end, engine, snap)
+    connection.send(process_memory_mb()["peak"] - before)
+
+
+# Route in a worker process and report its memory before loading the arrays and
+# after routing, once every worker has routed
+def _measure_worker(
+    folder: str,
+    queries: list[tuple[int, int]],
+    copy: bool,
+    barrier,
+    connection,
+) -> None:
+    before: dict[str, float] | None = process_memory_mb()
+    if copy:
+        csr: CSRGraph = CSRGraph(
+            *(
+                np.load(os.path.join(folder, f"{name}.npy"), mmap_mode="r")
+                for name in ["coordinates", "indptr", "indices", "weights"]
+            )
+        )
+        for source, target in queries:
+            if source != target:
+                csr.dijkstra(source, target)
+    else:
+        load_shared_search(folder, "dijkstra")
+        for source, target in queries:
+            worker_route(source, target)
+    barrier.wait()
+    after: dict[str, float] | None = process_memory_mb()
+    # Stay up until every worker has measured itself
+    barrier.wait()
+    connection.send({"before": before, "after": after})
+
+
+# How closely land use scores from the raster match scores from the polygons, at
+# each size, over the graph nodes and over random points
+def raster_accuracy(sizes: list[int], count: int = 2000) -> list[dict]:
+    results: list[dict] = []
+    for size in sizes:
+        landuse: gpd.GeoDataFrame = synthetic_landuse(size)
+        segments: gpd.GeoDataFrame = split_geometry(synthetic_roads(size))
+        graph: nx.MultiGraph = largest_component(gdf_to_graph(segments)).copy()
+        points: nx.MultiGraph = nx.MultiGraph()
+        points.add_nodes_from(map(tuple, synthetic_points(size, count, seed=5)))
+        raster: LandUseRaster = main.build_landuse_raster(landuse)
+
+        result: dict = {"size": size, "raster_bytes": raster.memory_bytes()}
+        for name, nodes in [("nodes", graph), ("points", points)]:
+            polygon: dict = main.score_landuse_niceness(nodes, landuse)
+            scores: np.ndarray = np.array(list(polygon.values()))
+            errors: np.ndarray = np.abs(
+                np.array(list(main.score_raster_niceness(nodes, raster).values()))
+                - scores
+            )
+            result[name] = {
+                "count": len(scores),
+                "exact": float(np.mean(errors == 0)),
+                "mean_error": float(errors.mean()),
+                "max_error": float(errors.max()),
+                "mean_score": float(scores.mean()),
+            }
+            info(
+                f"Raster of size {size:>4}, {name:<6}: "
+                f"{100 * result[name]['exact']:5.1f}% exact, "
+                f"mean error {result[name]['mean_error']:.3f} "
+                f"of mean score {result[name]['mean_score']:.2f}"
+            )
+        results.append(result)
+    return results
+
+
+# Seconds, file size and peak memory to build the land use raster into a file, for
+# the land use of each grid size and of the whole Lower Mainland
+# Peak memory is the most allocated at once while building, as traced by tracemalloc
+def raster_builds(sizes: list[int]) -> list[dict]:
+    import tracemalloc
+
+    zones: list[tuple[str, Callable[[], gpd.GeoDataFrame]]] = [
+        (f"grid {size}", lambda size=size: synthetic_landuse(size)) for size in sizes
+    ]
+    zones.append(
+        (
+            "lower mainland",
+            lambda: synthetic_region_landuse(_region, _region_landuse),
+        )
+    )
+    results: list[dict] = []
+    for zone, make_landuse in zones:
+        landuse: gpd.GeoDataFrame = make_landuse()
+        with tempfile.TemporaryDirectory() as folder:
+            path: str = os.path.join(folder, "scores.npy")
+            tracemalloc.start()
+            start: float = time.perf_counter()
+            raster: LandUseRaster = main.build_landuse_raster(landuse, path)
+            seconds: float = time.perf_counter() - start
+            peak: int = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results.append(
+                {
+                    "zone": zone,
+                    "landuse": len(landuse),
+                    "cells": list(raster.scores.shape),
+                    "seconds": seconds,
+                    "file_bytes": os.path.getsize(path),
+                    "peak_bytes": peak,
+                }
+            )
+            del raster
+        info(
+            f"Raster of {zone:<15}: {results[-1]['cells'][0]} x "
+            f"{results[-1]['cells'][1]} cells built in {seconds:7.2f} s, "
+            f"{results[-1]['file_bytes'] / 2**20:8.1f} MB file, "
+            f"{peak / 2**20:6.1f} MB peak allocated"
+        )
+    return results
+
+
+# Seconds to draw a route with the roads and land use to a PNG file, at each size
+# "geopandas" plots every road and land use area as main.py used to, "route" draws
+# only what is around the route, and "zone" draws the whole grid, both decimated
+def render_times(sizes: list[int], repeat: int = 3) -> list[dict]:
+    import matplotlib
+
+    # The GeoPandas plots go through pyplot, which must not open a window
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from util import graph_to_gdf
+
+    results: list[dict] = []
+    for size in sizes:
+        segments: gpd.GeoDataFrame = split_geometry(synthetic_roads(size))
+        graph: nx.MultiGraph = largest_component(gdf_to_graph(segments)).copy()
+        landuse: gpd.GeoDataFrame = synthetic_landuse(size)
+        start, end = synthetic_points(size, 2, seed=8)
+        path: list[tuple[float, float]] = shortest_path(
+            graph, start, end, main.walking_distance, "dijkstra"
+        )
+        zone: tuple[float, float, float, float] = tuple(
+            np.array(list(graph.nodes())).min(axis=0).tolist()
+            + np.array(list(graph.nodes())).max(axis=0).tolist()
+        )
+
+        def geopandas_plot(file_path: str) -> None:
+            roads_plot = graph_to_gdf(graph).plot()
+            graph_to_gdf(graph.subgraph(path)).plot(ax=roads_plot, color="red")
+            landuse.plot(ax=roads_plot, color="green")
+            plt.savefig(file_path)
+            plt.close("all")
+
+        result: dict = {"size": size, "edges": graph.number_of_edges()}
+        with tempfile.TemporaryDirectory() as directory:
+            file_path: str = os.path.join(directory, "map.png")
+            # Build the edge index and import matplotlib before timing
+            render_route_map(file_path, graph, [path], landuse)
+            with contextlib.redirect_stdout(io.StringIO()):
+                for name, function in [
+                    ("geopandas", lambda: geopandas_plot(file_path)),
+                    (
+                        "route",
+                        lambda: render_route_map(file_path, graph, [path], landuse),
+                    ),
+                    (
+                        "zone",
+                        lambda: render_route_map(
+                            file_path, graph, [path], landuse, zone
+                        ),
+                    ),
+                    (
+                        "svg",
+                        lambda: render_route_map(
+                            os.path.join(directory, "map.svg"), graph, [path], landuse
+                        ),
+                    ),
+                ]:
+                    result[name] = float(np.median(_time(function, repeat)))
+        info(
+            f"Map of size {size:>4}: {result['geopandas'] * 1000:8.1f} ms GeoPandas, "
+            f"{result['route'] * 1000:8.1f} ms around the route, "
+            f"{result['zone'] * 1000:8.1f} ms of the whole grid, "
+            f"{result['svg'] * 1000:8.1f} ms as SVG"
+        )
+        results.append(result)
+    return results
+
+
+# Length in metres of the walk between random points, at each size, when points
+# snap to the nearest node and when they snap onto the nearest edge
+# The walk is from the start point to where it snaps, along the route, then from
+# where the end point snaps to the end point
+def snap_comparison(sizes: list[int], count: int = 100) -> list[dict]:
+    results: list[dict] = []
+    for size in sizes:
+        segments: gpd.GeoDataFrame = split_geometry(synthetic_roads(size))
+        graph: nx.MultiGraph = largest_component(gdf_to_graph(segments)).copy()
+        pairs: list[tuple[Location, Location]] = list(
+            zip(
+                synthetic_points(size, count, seed=6),
+                synthetic_points(size, count, seed=7),
+            )
+        )
+
+        result: dict = {"size": size, "pairs": count}
+        for snap in ["node", "edge"]:
+            walks: list[float] = []
+            for start, end in pairs:
+                path: list[tuple[float, float]] = shortest_path(
+                    graph, start, end, main.walking_distance, "dijkstra", snap
+                )
+                walk: np.ndarray = np.array([tuple(start), *path, tuple(end)])
+                walks.append(float(haversine(walk[:-1], walk[1:]).sum()))
+            result[f"{snap}_metres"] = float(np.mean(walks))
+        result["saved_metres"] = result["node_metres"] - result["edge_metres"]
+        info(
+            f"Walks on a grid of size {size:>4}: {result['node_metres']:8.1f} m "
+            f"snapping to nodes, {result['edge_metres']:8.1f} m snapping onto edges"
+        )
+        results.append(result)
+    return results
+
+
+# Split roads into 2 point segments one row and one segment at a time, as
+# `split_geometry` did before it was vectorized, to check and time it against
+# Each part of a MultiLineString is split on its own
+def split_by_segment(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    result: gpd.GeoDataFrame = gpd.GeoDataFrame(columns=gdf.columns)
+    i: int = 0
+    for _, row in gdf.iterrows():
+        for part in shapely.get_parts(row.geometry):
+            for geometry in segment(part):
+                result.loc[i] = row
+                result.loc[i, gdf.geometry.name] = geometry
+                i += 1
+    return result
+
+
+# Time splitting the grid roads into segments, vectorized and one segment at a
+# time, at each size
+def split_comparison(sizes: list[int], repeat: int = 3) -> list[dict]:
+    results: list[dict] = []
+    for size in sizes:
+        roads: gpd.GeoDataFrame = synthetic_roads(size)
+        result: dict = {"size": size, "rows": len(roads)}
+        result["segments"] = len(split_geometry(roads))
+        result["vectorized_seconds"] = min(_time(lambda: split_geometry(roads), repeat))
+        result["by_segment_seconds"] = min(_time(lambda: split_by_segment(roads), 1))
+        info(
+            f"Splitting a grid of size {size:>4}: "
+            f"{result['vectorized_seconds'] * 1000:8.2f} ms vectorized, "
+            f"{result['by_segment_seconds'] * 1000:8.1f} ms one segment at a time"
+        )
+        results.append(result)
+    return results
+
+
+# Wall time of each of several runs of a function
+def _time(function: Callable[[], object], repeat: int) -> list[float]:
+    timings: list[float] = []
+    for _ in range(repeat):
+        start: float = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+# Short hash of the checked out commit, if this is a git repository
+def _commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    # Values of "--name=value" options
+    values: dict[str, str] = dict(
+        arg.removeprefix("--").split("=", 1)
+        for arg in sys.argv[1:]
+        if arg.startswith("--") and "=" in arg
+    )
+    sizes: list[int] = [
+        int(size) for size in values.get("sizes", "10,20,40").split(",")
+    ]
+    repeat: int = int(values.get("repeat", 5))
+    output: str = values.get(
+        "output", f"benchmark_{datetime.now().strftime('%Y%m%d%H%M%S')}.json"
+    )
+
+    results: list[dict] = run_benchmarks(sizes, repeat)
+    memory: list[dict] = graph_memory(sizes)
+    accuracy: list[dict] = raster_accuracy(sizes)
+    builds: list[dict] = raster_builds(sizes)
+    snapping: list[dict] = snap_comparison(sizes)
+    splitting: list[dict] = split_comparison(sizes)
+    rendering: list[dict] = render_times(sizes)
+    workers: list[dict] = worker_memory(sizes)
+    loading: list[dict] = cache_memory(sizes)
+    report: dict = {
+        "commit": _commit(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+        "memory": memory,
+        "raster": accuracy,
+        "raster_builds": builds,
+        "snapping": snapping,
+        "splitting": splitting,
+        "rendering": rendering,
+        "workers": workers,
+        "cache_memory": loading,
+    }
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    info(f"Saved benchmark results to {output}")
+
+    if "compare" in values:
+        with open(values["compare"]) as file:
+            older: dict = json.load(file)
+        info(f"Compared to {values['compare']} (commit {older.get('commit')})")
+        compare_results(older["results"], results)
@@ -1,27 +1,71 @@
+from __future__ import annotations
+
 import os
-import geopandas as gpd
+import time
 import util
+from typing import TYPE_CHECKING
+from instrument import stage
+from concurrent.futures import ProcessPoolExecutor
+
+# GeoPandas is slow to import, so it is imported when a file is read or cached
+if TYPE_CHECKING:
+    import geopandas as gpd
 
 """
 Read in shapefiles
 Trim GeoPandas.GeoDataFrame to fit within spatial parameters
-Cache a local folder, for performance
+Cache a local folder as GeoParquet, for performance
 """
 
 
 # Names of data files to be cached
 _datanames = ["railways", "traffic", "roads", "landuse"]
 
+# Columns of each data file that are read from cache, the rest stay on disk
+_datacolumns = {
+    "railways": ["name", "geometry"],
+    "traffic": ["name", "fclass", "geometry"],
+    "roads": ["osm_id", "fclass", "name", "maxspeed", "geometry"],
+    "landuse": ["fclass", "geometry"],
+}
+
+# Data files already read from cache by this process
+_loaded: dict[str, gpd.GeoDataFrame] = {}
+
 
 # Cache files from an OSM data source folder
-def cache_from_osm(folder: str) -> None:
+# Each file is cached in its own worker process, unless workers is 1
+def cache_from_osm(folder: str, workers: int | None = None) -> None:
     if os.path.exists(folder) == False:
         raise Exception(f'"{folder}" does not exist')
     if os.path.isdir(folder) == False:
         raise Exception(f'"{folder} is not a folder')
 
+    if workers is None:
+        workers = min(len(_datanames), os.cpu_count() or 1)
+
+    start: float = time.perf_counter()
+    if workers == 1:
+        for name in _datanames:
+            _cache_dataname(folder, name)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_cache_dataname, folder, name) for name in _datanames
+            ]
+            # Raise the exception of any file that failed to cache
+            for future in futures:
+                future.result()
+    elapsed: float = time.perf_counter() - start
+
     for name in _datanames:
-        _cache_dataname(folder, name)
+        _loaded.pop(name, None)
+
+    # Memory of worker processes is only known once they have finished
+    peak: float | None = util.peak_memory_mb(children=workers != 1)
+    peak_text: str = "unknown" if peak is None else f"{peak:.0f} MB"
+    util.info(f"Cached {len(_datanames)} files in {elapsed:.1f} s")
+    util.info(f"Peak memory while caching: {peak_text}")
 
 
 # Does the cache already exist
@@ -29,15 +73,61 @@ def cache_osm_exists() -> bool:
     if not os.path.exists("cache"):
         return False
 
-    if not len(os.listdir("cache")) == 4:
-        return False
+    # Other files, such as the compiled graph, may also be in the cache folder
+    # Shapefiles from older caches count, they are migrated when first read
+    for name in _datanames:
+        if not os.path.exists(f"cache/{name}/data.parquet") and not os.path.exists(
+            f"cache/{name}/data.shp"
+        ):
+            return False
 
     return True
 
 
 # Read a GeoPandas.GeoDataFrame from cache
-def read_from_cache(filename: str) -> gpd.GeoDataFrame:
-    return gpd.read_file(f"cache/{filename}/data.shp")
+# Each file is read from disk once per process, later reads share it in memory
+def read_from_cache(
+    filename: str, columns: list[str] | None = None
+) -> gpd.GeoDataFrame:
+    if filename not in _loaded:
+        import geopandas as gpd
+
+        path: str = f"cache/{filename}/data.parquet"
+        with stage(f"cache load {filename}"):
+            if not os.path.exists(path):
+                _migrate_shapefile(filename)
+            _loaded[filename] = gpd.read_parquet(
+                path, columns=_datacolumns.get(filename)
+            )
+
+    data: gpd.GeoDataFrame = _loaded[filename]
+    if columns is not None:
+        data = data[columns]
+    # A shallow copy, so callers adding columns do not change the shared data
+    return data.copy(deep=False)
+
+
+# Forget data files read from cache, the next reads go to disk
+def clear_loaded_cache() -> None:
+    _loaded.clear()
+
+
+# Convert a data file cached as a shapefile by older versions to GeoParquet
+def _migrate_shapefile(dataname: str) -> None:
+    shapefile_path: str = f"cache/{dataname}/data.shp"
+    if not os.path.exists(shapefile_path):
+        raise Exception(f'Cannot find cached file "{dataname}"')
+
+    import geopandas as gpd
+
+    gpd.read_file(shapefile_path).to_parquet(f"cache/{dataname}/data.parquet")
+
+    # Remove the shapefile and its sidecar files
+    for filename in os.listdir(f"cache/{dataname}"):
+        if filename.startswith("data.") and not filename.endswith(".parquet"):
+            os.remove(f"cache/{dataname}/{filename}")
+
+    util.info(f"Migrated cached file '{dataname}' to GeoParquet")
 
 
 # Cache a folder based on data name
@@ -57,26 +147,30 @@ def _cache_dataname(folder: str, dataname: str) -> None:
             f"Cannot find file 'gis_osm_{dataname}_a_free_1.shp' or 'gis_osm_{dataname}_free_1.shp'"
         )
 
-    # Read and trim the data
-    source_df: gpd.GeoDataFrame = gpd.read_file(source_path)
+    import geopandas as gpd
+
+    start: float = time.perf_counter()
+
+    # Read only features whose bounding box meets the zone, then trim the data
+    source_df: gpd.GeoDataFrame = gpd.read_file(source_path, bbox=_zone_bounds())
     output_df: gpd.GeoDataFrame = _within_zone(source_df)
 
-    # Create folders to cache into
-    if not os.path.exists("cache"):
-        os.mkdir("cache")
-    if not os.path.exists(f"cache/{dataname}"):
-        os.mkdir(f"cache/{dataname}")
+    # Create folders to cache into, other workers may be creating them too
+    os.makedirs(f"cache/{dataname}", exist_ok=True)
 
     # Write output
-    output_path: str = f"cache/{dataname}/data.shp"
-    output_df.to_file(output_path)
+    output_path: str = f"cache/{dataname}/data.parquet"
+    output_df.to_parquet(output_path)
 
     # Inform that the file has been cached
-    util.info(f"Cached file '{dataname}'")
+    elapsed: float = time.perf_counter() - start
+    peak: float | None = util.peak_memory_mb()
+    peak_text: str = "" if peak is None else f", peak memory {peak:.0f} MB"
+    util.info(f"Cached file '{dataname}' in {elapsed:.1f} s{peak_text}")
 
 
-# Return part of dataframe within zone
-def _within_zone(input: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+# The longitude and latitude bounds of the zone, as (xmin, ymin, xmax, ymax)
+def _zone_bounds() -> tuple[float, float, float, float]:
     # The longitude and latitude bounds for the lower mainland
     """
     xmin = -123.3
@@ -89,4 +183,10 @@ def _within_zone(input: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     xmax = -123.116
     ymin = 49.271
     ymax = 49.288
+    return (xmin, ymin, xmax, ymax)
+
+
+# Return part of dataframe within zone
+def _within_zone(input: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    xmin, ymin, xmax, ymax = _zone_bounds()
     return input.cx[xmin:xmax, ymin:ymax]
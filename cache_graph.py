@@ -0,0 +1,76 @@
+import os
+import hashlib
+import numpy as np
+import networkx as nx
+import util
+from compact import CompactGraph
+
+"""
+Compile a routable networkx graph to a compact binary file, see compact.py
+Read it back on later runs as the compact graph, skipping the graph building
+pipeline, routers snap onto and route on it without building the MultiGraph
+Invalidate it when the source layers or the configuration change
+"""
+
+
+# Where the compiled graph is written
+_graph_cache_path = "cache/graph.npz"
+
+# Bump when the file layout changes, so old files are rebuilt
+_graph_cache_version = 2
+
+
+# Hash the cached source layers and configuration that a graph is built from
+def graph_cache_key(layers: list[str], config: object) -> str:
+    digest = hashlib.sha256()
+    digest.update(str(_graph_cache_version).encode())
+    digest.update(repr(config).encode())
+    for layer in layers:
+        folder: str = f"cache/{layer}"
+        if not os.path.isdir(folder):
+            raise Exception(f'Cannot find cached layer "{layer}"')
+        # File sizes and modification times change whenever a layer is recached
+        for filename in sorted(os.listdir(folder)):
+            stat = os.stat(os.path.join(folder, filename))
+            digest.update(
+                f"{layer}/{filename}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+            )
+    return digest.hexdigest()
+
+
+# Write a graph and the weights of its edges to the graph cache
+def cache_graph(
+    graph: nx.MultiGraph,
+    key: str,
+    weights: dict[tuple, float],
+    path: str = _graph_cache_path,
+) -> None:
+    arrays: dict[str, np.ndarray] = CompactGraph.from_graph(graph, weights).arrays()
+    arrays["key"] = np.array(key)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write to a temporary file first, so a cache is never left half written
+    temporary_path: str = f"{path}.tmp.npz"
+    np.savez(temporary_path, **arrays)
+    os.replace(temporary_path, path)
+
+
+# Read a graph and the weights of its edges from the graph cache, as the compact
+# graph, `CompactGraph.to_graph` builds the MultiGraph if one is needed
+# Returns None if there is no cache or it was built from other inputs
+def read_graph_from_cache(
+    key: str,
+    path: str = _graph_cache_path,
+) -> tuple[CompactGraph, dict[tuple, float]] | None:
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as file:
+        if str(file["key"]) != key:
+            util.info(f"Graph cache '{path}' is out of date")
+            return None
+        arrays: dict[str, np.ndarray] = {name: file[name] for name in file.files}
+
+    compact: CompactGraph = CompactGraph.from_arrays(arrays)
+    return compact, compact.weights()
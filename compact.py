@@ -0,0 +1,376 @@
+import sys
+import json
+import numpy as np
+import networkx as nx
+import shapely
+from typing import Iterable, Iterator
+
+"""
+Compact array representation of a road graph
+Nodes are integer ids into a coordinate array, edges are typed arrays of end
+node ids, keys and weights, and text or low cardinality attributes such as
+fclass and maxspeed are stored as categorical codes
+Converts to and from the networkx MultiGraph the rest of the planner uses
+Reads like the MultiGraph it was built from, so a graph read from cache is
+snapped onto and routed on without building the MultiGraph
+"""
+
+
+# Columns with at most this many distinct values per row are stored as codes
+_categorical_ratio = 0.5
+
+
+# Road graph as NumPy arrays
+class CompactGraph:
+    def __init__(
+        self,
+        coordinates: np.ndarray,
+        edge_u: np.ndarray,
+        edge_v: np.ndarray,
+        edge_key: np.ndarray,
+        edge_weight: np.ndarray | None,
+        node_columns: dict[str, np.ndarray],
+        edge_columns: dict[str, np.ndarray],
+        geometry_coordinates: np.ndarray | None,
+        geometry_offsets: np.ndarray | None,
+        attributes: dict,
+    ) -> None:
+        # Coordinates of node i are coordinates[i], as (longitude, latitude)
+        self.coordinates: np.ndarray = coordinates
+        # Edge i joins node edge_u[i] to node edge_v[i]
+        self.edge_u: np.ndarray = edge_u
+        self.edge_v: np.ndarray = edge_v
+        self.edge_key: np.ndarray = edge_key
+        self.edge_weight: np.ndarray | None = edge_weight
+        # Attribute columns, as written by `_encode`
+        self.node_columns: dict[str, np.ndarray] = node_columns
+        self.edge_columns: dict[str, np.ndarray] = edge_columns
+        # Geometry of edge i is geometry_coordinates[offsets[i]:offsets[i + 1]]
+        self.geometry_coordinates: np.ndarray | None = geometry_coordinates
+        self.geometry_offsets: np.ndarray | None = geometry_offsets
+        # Graph level attributes, such as the CRS
+        self.attributes: dict = attributes
+        # Keys of the edges between each pair of node ids, lowest id first, built
+        # when first asked for
+        self._keys: dict[tuple[int, int], list[int]] | None = None
+        self._ids: dict[tuple[float, float], int] | None = None
+
+    # Build from a MultiGraph, and the weight of each (u, v, key) edge if known
+    @classmethod
+    def from_graph(
+        cls, graph: nx.MultiGraph, weights: dict[tuple, float] | None = None
+    ) -> "CompactGraph":
+        nodes: list[tuple[float, float]] = list(graph.nodes())
+        ids: dict[tuple[float, float], int] = {node: i for i, node in enumerate(nodes)}
+        edges: list[tuple] = list(graph.edges(keys=True, data=True))
+
+        edge_weight: np.ndarray | None = None
+        if weights is not None:
+            edge_weight = np.array(
+                [weights[(u, v, k)] for u, v, k, _ in edges], dtype=np.float64
+            )
+
+        # Edge geometry as one flat coordinate array, with the offset of each edge
+        geometry_coordinates: np.ndarray | None = None
+        geometry_offsets: np.ndarray | None = None
+        geometries: list = [data.get("geometry") for _, _, _, data in edges]
+        if len(edges) > 0 and all(geometry is not None for geometry in geometries):
+            geometry_coordinates = shapely.get_coordinates(geometries)
+            geometry_offsets = np.concatenate(
+                [[0], np.cumsum(shapely.get_num_coordinates(geometries))]
+            ).astype(np.int64)
+
+        return cls(
+            np.array(nodes, dtype=np.float64).reshape(-1, 2),
+            _smallest_int([ids[u] for u, _, _, _ in edges], len(nodes)),
+            _smallest_int([ids[v] for _, v, _, _ in edges], len(nodes)),
+            _smallest_int([k for _, _, k, _ in edges], len(edges)),
+            edge_weight,
+            _encode([data for _, data in graph.nodes(data=True)]),
+            _encode([data for _, _, _, data in edges], skip={"geometry"}),
+            geometry_coordinates,
+            geometry_offsets,
+            _graph_attributes(graph),
+        )
+
+    # Number of nodes
+    def __len__(self) -> int:
+        return len(self.coordinates)
+
+    # Number of edges
+    def number_of_edges(self) -> int:
+        return len(self.edge_u)
+
+    # Number of nodes, as MultiGraph counts them
+    def number_of_nodes(self) -> int:
+        return len(self.coordinates)
+
+    # Nodes as (longitude, latitude) tuples, indexed by node id
+    def nodes(self) -> list[tuple[float, float]]:
+        return list(map(tuple, self.coordinates.tolist()))
+
+    # Graph level attributes, named as MultiGraph names them
+    @property
+    def graph(self) -> dict:
+        return self.attributes
+
+    # Every edge as (u, v), with its key and its attributes, as MultiGraph.edges
+    # gives them, the attributes are decoded as they are asked for
+    def edges(self, keys: bool = False, data: bool = False) -> Iterator[tuple]:
+        nodes: list[tuple[float, float]] = self.nodes()
+        rows: Iterable[tuple] = zip(
+            [nodes[i] for i in self.edge_u.tolist()],
+            [nodes[i] for i in self.edge_v.tolist()],
+        )
+        if keys:
+            rows = (row + (key,) for row, key in zip(rows, self.edge_key.tolist()))
+        if data:
+            rows = (row + (values,) for row, values in zip(rows, self._edge_data()))
+        return iter(rows)
+
+    # Does an edge join two nodes with a key, whichever way round they are given
+    def has_edge(
+        self, u: tuple[float, float], v: tuple[float, float], key: int
+    ) -> bool:
+        return key in self.edge_keys(u, v)
+
+    # Keys of the edges between two nodes, whichever way round they are given
+    def edge_keys(self, u: tuple[float, float], v: tuple[float, float]) -> list[int]:
+        if self._keys is None:
+            self._ids = {node: i for i, node in enumerate(self.nodes())}
+            self._keys = {}
+            for i, j, key in zip(
+                self.edge_u.tolist(), self.edge_v.tolist(), self.edge_key.tolist()
+            ):
+                self._keys.setdefault((min(i, j), max(i, j)), []).append(key)
+        i: int | None = self._ids.get(u)
+        j: int | None = self._ids.get(v)
+        if i is None or j is None:
+            return []
+        return self._keys.get((min(i, j), max(i, j)), [])
+
+    # Value of an attribute of every node that has it, by node
+    def node_attributes(self, name: str) -> dict[tuple[float, float], object]:
+        return {
+            node: data[name]
+            for node, data in zip(
+                self.nodes(), _decode(self.node_columns, len(self.coordinates))
+            )
+            if data.get(name) is not None
+        }
+
+    # Turn back into a MultiGraph, with the same nodes, edges and attributes
+    def to_graph(self) -> nx.MultiGraph:
+        nodes: list[tuple[float, float]] = self.nodes()
+        edge_u: list[tuple[float, float]] = [nodes[i] for i in self.edge_u.tolist()]
+        edge_v: list[tuple[float, float]] = [nodes[i] for i in self.edge_v.tolist()]
+
+        node_data: list[dict] = _decode(self.node_columns, len(nodes))
+        edge_data: list[dict] = self._edge_data()
+
+        graph: nx.MultiGraph = nx.MultiGraph(**self.attributes)
+        graph.add_nodes_from(zip(nodes, node_data))
+        graph.add_edges_from(zip(edge_u, edge_v, self.edge_key.tolist(), edge_data))
+        return graph
+
+    # Attributes of every edge, with its geometry if edges have geometries
+    def _edge_data(self) -> list[dict]:
+        edge_data: list[dict] = _decode(self.edge_columns, len(self.edge_u))
+        geometries: np.ndarray | None = self.edge_geometries()
+        if geometries is not None:
+            for data, geometry in zip(edge_data, geometries):
+                data["geometry"] = geometry
+        return edge_data
+
+    # Geometry of every edge, or None if edges have no geometries
+    def edge_geometries(self) -> np.ndarray | None:
+        if self.geometry_coordinates is None:
+            return None
+        counts: np.ndarray = np.diff(self.geometry_offsets)
+        return shapely.linestrings(
+            self.geometry_coordinates,
+            indices=np.repeat(np.arange(len(counts)), counts),
+        )
+
+    # Value of an attribute of every edge, None where an edge does not have it
+    def edge_values(self, name: str) -> list:
+        columns: dict[str, np.ndarray] = {
+            column: array
+            for column, array in self.edge_columns.items()
+            if column.split(":")[0] == name
+        }
+        return [row.get(name) for row in _decode(columns, len(self.edge_u))]
+
+    # Weight of each (u, v, key) edge, as the Router takes them
+    def weights(self) -> dict[tuple, float] | None:
+        if self.edge_weight is None:
+            return None
+        nodes: list[tuple[float, float]] = self.nodes()
+        return dict(
+            zip(
+                zip(
+                    [nodes[i] for i in self.edge_u.tolist()],
+                    [nodes[i] for i in self.edge_v.tolist()],
+                    self.edge_key.tolist(),
+                ),
+                self.edge_weight.tolist(),
+            )
+        )
+
+    # Every array, by name, as written to and read from files
+    def arrays(self) -> dict[str, np.ndarray]:
+        arrays: dict[str, np.ndarray] = {
+            "graph": np.array(json.dumps(self.attributes)),
+            "nodes": self.coordinates,
+            "edge_u": self.edge_u,
+            "edge_v": self.edge_v,
+            "edge_key": self.edge_key,
+        }
+        if self.edge_weight is not None:
+            arrays["edge_weight"] = self.edge_weight
+        if self.geometry_coordinates is not None:
+            arrays["geometry_coordinates"] = self.geometry_coordinates
+            arrays["geometry_offsets"] = self.geometry_offsets
+        for prefix, columns in [
+            ("node", self.node_columns),
+            ("edge", self.edge_columns),
+        ]:
+            for name, array in columns.items():
+                arrays[f"{prefix}:{name}"] = array
+        return arrays
+
+    # Build from arrays written by `arrays`
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray]) -> "CompactGraph":
+        def columns(prefix: str) -> dict[str, np.ndarray]:
+            return {
+                name.split(":", 1)[1]: array
+                for name, array in arrays.items()
+                if name.startswith(f"{prefix}:")
+            }
+
+        return cls(
+            arrays["nodes"],
+            arrays["edge_u"],
+            arrays["edge_v"],
+            arrays["edge_key"],
+            arrays.get("edge_weight"),
+            columns("node"),
+            columns("edge"),
+            arrays.get("geometry_coordinates"),
+            arrays.get("geometry_offsets"),
+            json.loads(str(arrays["graph"])),
+        )
+
+    # Memory of every array in bytes
+    def memory_bytes(self) -> int:
+        return sum(array.nbytes for array in self.arrays().values())
+
+
+# Approximate memory of a networkx graph in bytes, counting each object once
+# Includes the nodes, adjacency and attribute dictionaries, and the coordinates
+# shapely geometries hold outside of Python
+def networkx_memory_bytes(graph: nx.Graph) -> int:
+    seen: set[int] = set()
+    total: int = 0
+    stack: list = [graph.graph, graph._node, graph._adj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set)):
+            stack.extend(item)
+        elif isinstance(item, shapely.Geometry):
+            total += 16 * int(shapely.get_num_coordinates(item)) + 64
+    return total
+
+
+# Smallest signed integer array that holds values up to a limit
+def _smallest_int(values: list[int], limit: int) -> np.ndarray:
+    for dtype in (np.int8, np.int16, np.int32):
+        if limit < np.iinfo(dtype).max:
+            return np.array(values, dtype=dtype)
+    return np.array(values, dtype=np.int64)
+
+
+# Store the attribute dictionaries of nodes or edges as one column per attribute
+# Numbers with many distinct values are stored as typed arrays, with a ":missing"
+# mask if some are missing
+# Text, and numbers with few distinct values, are stored as ":codes" into
+# ":categories", with -1 for missing values
+def _encode(rows: list[dict], skip: set[str] = set()) -> dict[str, np.ndarray]:
+    columns: dict[str, np.ndarray] = {}
+    names: list[str] = sorted({name for row in rows for name in row} - skip)
+    for name in names:
+        values: list = [row.get(name) for row in rows]
+        present: list = [value for value in values if value is not None]
+        numbers: bool = all(
+            isinstance(value, (bool, int, float, np.number)) for value in present
+        )
+        distinct: set = set(present)
+        if numbers and len(distinct) > _categorical_ratio * len(values):
+            if len(present) == len(values):
+                columns[name] = np.array(values)
+            else:
+                columns[name] = np.array(
+                    [0 if value is None else value for value in values]
+                )
+                columns[f"{name}:missing"] = np.array(
+                    [value is None for value in values], dtype=bool
+                )
+            continue
+
+        # Mixed types cannot share one categories array, so they are stored as text
+        if not numbers and not all(isinstance(value, str) for value in present):
+            values = [None if value is None else str(value) for value in values]
+            distinct = {value for value in values if value is not None}
+        categories: list = sorted(distinct)
+        codes: dict = {value: i for i, value in enumerate(categories)}
+        columns[f"{name}:codes"] = _smallest_int(
+            [-1 if value is None else codes[value] for value in values],
+            len(categories),
+        )
+        columns[f"{name}:categories"] = (
+            np.array(categories) if len(categories) > 0 else np.array([], dtype=str)
+        )
+    return columns
+
+
+# Turn columns stored by `_encode` back into attribute dictionaries
+def _decode(columns: dict[str, np.ndarray], count: int) -> list[dict]:
+    rows: list[dict] = [{} for _ in range(count)]
+    for column, array in columns.items():
+        parts: list[str] = column.split(":")
+        name: str = parts[0]
+        if len(parts) == 1:
+            values: list = array.tolist()
+            missing: np.ndarray | None = columns.get(f"{name}:missing")
+            if missing is not None:
+                values = [
+                    None if is_missing else value
+                    for value, is_missing in zip(values, missing.tolist())
+                ]
+        elif parts[1] == "codes":
+            categories: list = columns[f"{name}:categories"].tolist()
+            values = [None if code < 0 else categories[code] for code in array.tolist()]
+        else:
+            continue
+        for row, value in zip(rows, values):
+            row[name] = value
+    return rows
+
+
+# Graph level attributes, made JSON serializable
+def _graph_attributes(graph: nx.MultiGraph) -> dict:
+    attributes: dict = {}
+    for name, value in graph.graph.items():
+        # A pyproj.CRS is stored as its authority string, e.g. "EPSG:4326"
+        if hasattr(value, "to_string"):
+            value = value.to_string()
+        attributes[name] = value
+    return attributes
@@ -0,0 +1,341 @@
+import os
+import heapq
+import numpy as np
+from csr import CSRGraph
+
+"""
+Contraction hierarchy over a weighted graph, for fast point to point queries
+Preprocessing contracts nodes one at a time, adding shortcuts that keep distances
+Queries only search upward in the hierarchy, from both ends
+"""
+
+
+# Where the contraction hierarchy of the routable graph is cached
+_contraction_cache_path = "cache/contraction.npz"
+
+
+# Nodes in order of importance, with the edges and shortcuts leading up the order
+# Shared arrays, such as arrays memory mapped by worker processes, are read where
+# they are, other arrays are copied into lists
+class ContractionHierarchy:
+    def __init__(
+        self,
+        coordinates: np.ndarray,
+        rank: np.ndarray,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        weights: np.ndarray,
+        middles: np.ndarray,
+        shared: bool = False,
+    ) -> None:
+        # Coordinates of node i are coordinates[i], as (longitude, latitude)
+        self.coordinates: np.ndarray = coordinates
+        # Order nodes were contracted in, lower ranks were contracted first
+        self.rank: np.ndarray = rank
+        # Upward edges of node i are indices[indptr[i]:indptr[i + 1]]
+        # Each leads to a node of higher rank, a shortcut skips its middle node
+        # The middle is -1 for an edge of the original graph
+        self.indptr: np.ndarray = indptr
+        self.indices: np.ndarray = indices
+        self.weights: np.ndarray = weights
+        self.middles: np.ndarray = middles
+
+        if shared:
+            # Memoryviews read items out of the arrays without copying them, so
+            # processes mapping the same file share its pages
+            self._rank: list[int] | memoryview = memoryview(rank)
+            self._indptr: list[int] | memoryview = memoryview(indptr)
+            self._indices: list[int] | memoryview = memoryview(indices)
+            self._weights: list[float] | memoryview = memoryview(weights)
+            self._middles: list[int] | memoryview = memoryview(middles)
+        else:
+            # Plain lists are much faster than NumPy arrays to index one item at a
+            # time, and somewhat faster than memoryviews
+            self._rank = rank.tolist()
+            self._indptr = indptr.tolist()
+            self._indices = indices.tolist()
+            self._weights = weights.tolist()
+            self._middles = middles.tolist()
+
+        # Built when first asked for, queries only need node ids
+        self._nodes: list[tuple[float, float]] | None = None
+        self._ids: dict[tuple[float, float], int] | None = None
+
+    # Coordinates of every node as tuples, the nodes of the graph built from
+    @property
+    def nodes(self) -> list[tuple[float, float]]:
+        if self._nodes is None:
+            self._nodes = list(map(tuple, self.coordinates.tolist()))
+        return self._nodes
+
+    # Id of each node
+    @property
+    def ids(self) -> dict[tuple[float, float], int]:
+        if self._ids is None:
+            self._ids = {node: i for i, node in enumerate(self.nodes)}
+        return self._ids
+
+    # Contract every node of a graph
+    # Witness searches settle at most witness_limit nodes, a lower limit is
+    # faster but adds shortcuts that are not needed
+    @classmethod
+    def build(cls, csr: CSRGraph, witness_limit: int = 50) -> "ContractionHierarchy":
+        size: int = len(csr)
+
+        # Adjacency as dictionaries, of parallel edges only the cheapest is kept
+        adjacency: list[dict[int, float]] = [{} for _ in range(size)]
+        for u in range(size):
+            for i in range(csr._indptr[u], csr._indptr[u + 1]):
+                v: int = csr._indices[i]
+                if u != v and csr._weights[i] < adjacency[u].get(v, float("inf")):
+                    adjacency[u][v] = csr._weights[i]
+                    adjacency[v][u] = csr._weights[i]
+
+        middle: dict[tuple[int, int], int] = {}
+        # Nodes already contracted, in the order they were contracted
+        contracted: set[int] = set()
+        contracted_neighbours: list[int] = [0] * size
+        rank: list[int] = [0] * size
+        upward: list[dict[int, float]] = [{} for _ in range(size)]
+
+        # Shortcuts needed to contract a node, as (u, w, weight)
+        def shortcuts(node: int) -> list[tuple[int, int, float]]:
+            neighbours: list[tuple[int, float]] = list(adjacency[node].items())
+            needed: list[tuple[int, int, float]] = []
+            for i, (u, weight_u) in enumerate(neighbours):
+                # Each pair of neighbours once, the graph is undirected
+                via: dict[int, float] = {
+                    w: weight_u + weight_w for w, weight_w in neighbours[i + 1 :]
+                }
+                if len(via) == 0:
+                    continue
+                witnesses: dict[int, float] = _witness_search(
+                    adjacency, u, node, via, witness_limit
+                )
+                for w, weight in via.items():
+                    if witnesses.get(w, float("inf")) > weight:
+                        needed.append((u, w, weight))
+            return needed
+
+        # Contract unimportant nodes first, importance is estimated by edge difference
+        def priority(node: int, needed: list[tuple[int, int, float]]) -> int:
+            return len(needed) - len(adjacency[node]) + contracted_neighbours[node]
+
+        heap: list[tuple[int, int]] = [
+            (priority(node, shortcuts(node)), node) for node in range(size)
+        ]
+        heapq.heapify(heap)
+        order: int = 0
+        while heap:
+            _, node = heapq.heappop(heap)
+            if node in contracted:
+                continue
+            # Priorities go stale as neighbours are contracted, recheck lazily
+            needed: list[tuple[int, int, float]] = shortcuts(node)
+            current: int = priority(node, needed)
+            if heap and current > heap[0][0]:
+                heapq.heappush(heap, (current, node))
+                continue
+
+            for u, w, weight in needed:
+                if weight < adjacency[u].get(w, float("inf")):
+                    adjacency[u][w] = weight
+                    adjacency[w][u] = weight
+                    middle[(min(u, w), max(u, w))] = node
+
+            # Contracted nodes are removed from the adjacency of the rest
+            upward[node] = adjacency[node]
+            for u in upward[node]:
+                del adjacency[u][node]
+                contracted_neighbours[u] += 1
+            adjacency[node] = {}
+            contracted.add(node)
+            rank[node] = order
+            order += 1
+
+        indptr: list[int] = [0]
+        indices: list[int] = []
+        weights: list[float] = []
+        middles: list[int] = []
+        for node in range(size):
+            for u, weight in upward[node].items():
+                indices.append(u)
+                weights.append(weight)
+                middles.append(middle.get((min(node, u), max(node, u)), -1))
+            indptr.append(len(indices))
+
+        return cls(
+            csr.coordinates,
+            np.array(rank, dtype=np.int32),
+            np.array(indptr, dtype=np.int64),
+            np.array(indices, dtype=np.int32),
+            np.array(weights, dtype=np.float64),
+            np.array(middles, dtype=np.int32),
+        )
+
+    # Number of nodes
+    def __len__(self) -> int:
+        return len(self.coordinates)
+
+    # Shortest path between two nodes
+    def shortest_path(self, source: int, target: int) -> list[int]:
+        if source == target:
+            return [source]
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+
+        # Index 0 searches upward from the source, index 1 upward from the target
+        distances: list[dict[int, float]] = [{source: 0.0}, {target: 0.0}]
+        predecessors: list[dict[int, int]] = [{}, {}]
+        done: list[set[int]] = [set(), set()]
+        heaps: list[list[tuple[float, int]]] = [[(0.0, source)], [(0.0, target)]]
+
+        # Cost and meeting node of the best path seen so far
+        best: float = float("inf")
+        meeting: int | None = None
+
+        while heaps[0] or heaps[1]:
+            # Expand the side with the closer frontier
+            if not heaps[1] or (heaps[0] and heaps[0][0][0] <= heaps[1][0][0]):
+                side: int = 0
+            else:
+                side = 1
+            distance, node = heapq.heappop(heaps[side])
+            # A side can stop once its frontier is no closer than the best path
+            if distance >= best:
+                heaps[side].clear()
+                continue
+            if node in done[side]:
+                continue
+            done[side].add(node)
+
+            other: dict[int, float] = distances[1 - side]
+            if node in other and distance + other[node] < best:
+                best = distance + other[node]
+                meeting = node
+
+            for i in range(indptr[node], indptr[node + 1]):
+                neighbour: int = indices[i]
+                candidate: float = distance + weights[i]
+                if candidate < distances[side].get(neighbour, float("inf")):
+                    distances[side][neighbour] = candidate
+                    predecessors[side][neighbour] = node
+                    heapq.heappush(heaps[side], (candidate, neighbour))
+
+        if meeting is None:
+            raise Exception(f"Node {target} not reachable from {source}")
+
+        # Path of edges and shortcuts, up from both ends to the meeting node
+        up: list[int] = [meeting]
+        while up[-1] != source:
+            up.append(predecessors[0][up[-1]])
+        down: list[int] = [meeting]
+        while down[-1] != target:
+            down.append(predecessors[1][down[-1]])
+        hierarchy_path: list[int] = up[::-1] + down[1:]
+
+        path: list[int] = [source]
+        for u, v in zip(hierarchy_path, hierarchy_path[1:]):
+            path.extend(self._unpack(u, v))
+        return path
+
+    # Nodes after u along an edge or shortcut from u to v, ending with v
+    def _unpack(self, u: int, v: int) -> list[int]:
+        result: list[int] = []
+        stack: list[tuple[int, int]] = [(u, v)]
+        while stack:
+            a, b = stack.pop()
+            middle: int = self._middle(a, b)
+            if middle < 0:
+                result.append(b)
+            else:
+                # Unpack the second half last, so it is pushed first
+                stack.append((middle, b))
+                stack.append((a, middle))
+        return result
+
+    # Middle node of the shortcut between two nodes, -1 for an edge of the graph
+    # Each edge is kept once, upward from its end of lower rank, among a few others
+    def _middle(self, a: int, b: int) -> int:
+        low, high = (a, b) if self._rank[a] < self._rank[b] else (b, a)
+        for i in range(self._indptr[low], self._indptr[low + 1]):
+            if self._indices[i] == high:
+                return self._middles[i]
+        return -1
+
+
+# Write a contraction hierarchy to cache, keyed like the graph it was built from
+def cache_contraction(
+    hierarchy: ContractionHierarchy,
+    key: str,
+    path: str = _contraction_cache_path,
+) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path: str = f"{path}.tmp.npz"
+    np.savez(
+        temporary_path,
+        key=np.array(key),
+        nodes=hierarchy.coordinates,
+        rank=hierarchy.rank,
+        indptr=hierarchy.indptr,
+        indices=hierarchy.indices,
+        weights=hierarchy.weights,
+        middles=hierarchy.middles,
+    )
+    os.replace(temporary_path, path)
+
+
+# Read a contraction hierarchy from cache
+# Returns None if there is no cache or it was built from another graph
+def read_contraction_from_cache(
+    key: str,
+    path: str = _contraction_cache_path,
+) -> ContractionHierarchy | None:
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as file:
+        if str(file["key"]) != key:
+            return None
+        return ContractionHierarchy(
+            file["nodes"],
+            file["rank"],
+            file["indptr"],
+            file["indices"],
+            file["weights"],
+            file["middles"],
+        )
+
+
+# Distances from a node to nearby nodes, without passing through the node skipped
+# Stops once every target is settled, the search passes the largest target
+# distance, or limit nodes are settled
+def _witness_search(
+    adjacency: list[dict[int, float]],
+    source: int,
+    skipped: int,
+    targets: dict[int, float],
+    limit: int,
+) -> dict[int, float]:
+    largest: float = max(targets.values())
+    remaining: int = len(targets)
+    distances: dict[int, float] = {source: 0.0}
+    done: set[int] = set()
+    heap: list[tuple[float, int]] = [(0.0, source)]
+    while heap and len(done) < limit:
+        distance, node = heapq.heappop(heap)
+        if node in done:
+            continue
+        if distance > largest:
+            break
+        done.add(node)
+        if node in targets:
+            remaining -= 1
+            if remaining == 0:
+                break
+        for neighbour, weight in adjacency[node].items():
+            if neighbour == skipped:
+                continue
+            candidate: float = distance + weight
+            if candidate < distances.get(neighbour, float("inf")):
+                distances[neighbour] = candidate
+                heapq.heappush(heap, (candidate, neighbour))
+    return distances
@@ -0,0 +1,608 @@
+import heapq
+import numpy as np
+import networkx as nx
+from math import sqrt
+
+"""
+Array backed routing engine
+Nodes are numbered 0 to n - 1, adjacency and weights are NumPy CSR arrays
+Searches: Dijkstra, A* and bidirectional Dijkstra, one-to-many search trees,
+Dijkstra between points part way along edges, and alternative paths
+"""
+
+
+# Mean radius of the Earth in metres
+_earth_radius = 6371008.8
+
+# Landmarks picked for the A* heuristic, and how many of them each search uses
+_landmark_count = 8
+_active_landmarks = 4
+
+
+# Compressed sparse row adjacency of an undirected weighted graph
+# Shared arrays, such as arrays memory mapped by worker processes, are read where
+# they are, other arrays are copied into lists
+class CSRGraph:
+    def __init__(
+        self,
+        coordinates: np.ndarray,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        weights: np.ndarray,
+        shared: bool = False,
+        heuristic_scale: float | None = None,
+        landmarks: np.ndarray | None = None,
+    ) -> None:
+        # Coordinates of node i are coordinates[i], as (longitude, latitude)
+        self.coordinates: np.ndarray = coordinates
+        # Neighbours of node i are indices[indptr[i]:indptr[i + 1]]
+        self.indptr: np.ndarray = indptr
+        self.indices: np.ndarray = indices
+        self.weights: np.ndarray = weights
+        self.shared: bool = shared
+        # Times weights were set in place, so copies of them can tell they are stale
+        self.edits: int = 0
+
+        if shared:
+            # Memoryviews read items out of the arrays without copying them, so
+            # processes mapping the same file share its pages
+            self._indptr: list[int] | memoryview = memoryview(indptr)
+            self._indices: list[int] | memoryview = memoryview(indices)
+            self._weights: list[float] | memoryview = memoryview(weights)
+            self._x: list[float] | memoryview = memoryview(coordinates[:, 0])
+            self._y: list[float] | memoryview = memoryview(coordinates[:, 1])
+        else:
+            # Plain lists are much faster than NumPy arrays to index one item at a
+            # time, and somewhat faster than memoryviews
+            self._indptr = indptr.tolist()
+            self._indices = indices.tolist()
+            self._weights = weights.tolist()
+            self._x = coordinates[:, 0].tolist()
+            self._y = coordinates[:, 1].tolist()
+
+        self.heuristic_scale: float = (
+            self._heuristic_scale() if heuristic_scale is None else heuristic_scale
+        )
+        # Distances from each landmark to every node, found on the first A* search
+        self._landmarks: np.ndarray | None = landmarks
+        # Built when first asked for, searches only need node ids
+        self._nodes: list[tuple[float, float]] | None = None
+        self._ids: dict[tuple[float, float], int] | None = None
+
+    # Coordinates of every node as tuples, the nodes of the graph built from
+    @property
+    def nodes(self) -> list[tuple[float, float]]:
+        if self._nodes is None:
+            self._nodes = list(map(tuple, self.coordinates.tolist()))
+        return self._nodes
+
+    # Id of each node
+    @property
+    def ids(self) -> dict[tuple[float, float], int]:
+        if self._ids is None:
+            self._ids = {node: i for i, node in enumerate(self.nodes)}
+        return self._ids
+
+    # Build from a weighted networkx graph, keeping its node and neighbour order
+    # With the same order, Dijkstra breaks ties between equal paths the same way
+    @classmethod
+    def from_graph(cls, graph: nx.Graph, weight: str = "weight") -> "CSRGraph":
+        nodes: list[tuple[float, float]] = list(graph.nodes())
+        ids: dict[tuple[float, float], int] = {node: i for i, node in enumerate(nodes)}
+        indptr: list[int] = [0]
+        indices: list[int] = []
+        weights: list[float] = []
+        for node in nodes:
+            for neighbour, data in graph.adj[node].items():
+                indices.append(ids[neighbour])
+                weights.append(data[weight])
+            indptr.append(len(indices))
+        csr: CSRGraph = cls(
+            np.array(nodes, dtype=np.float64).reshape(-1, 2),
+            np.array(indptr, dtype=np.int64),
+            np.array(indices, dtype=np.int32),
+            np.array(weights, dtype=np.float64),
+        )
+        csr._nodes, csr._ids = nodes, ids
+        return csr
+
+    # Build from edges joining node ids into an array of coordinates, as the
+    # networkx graph those edges would be added to in order, of parallel edges the
+    # cheapest is kept
+    # Nodes are numbered in the order they are first met and neighbours are in the
+    # order they were first joined, as networkx orders them, so Dijkstra breaks
+    # ties between equal paths the same way
+    @classmethod
+    def from_edges(
+        cls,
+        coordinates: np.ndarray,
+        u: np.ndarray,
+        v: np.ndarray,
+        weights: np.ndarray,
+    ) -> "CSRGraph":
+        ends: np.ndarray = np.column_stack([u, v]).astype(np.int64).ravel()
+        present, first = np.unique(ends, return_index=True)
+        order: np.ndarray = present[np.argsort(first, kind="stable")]
+        ids: np.ndarray = np.zeros(len(coordinates), dtype=np.int64)
+        ids[order] = np.arange(len(order))
+        ends = ids[ends].reshape(-1, 2)
+
+        # Each pair of nodes is one edge, where it was first met, of the least weight
+        low: np.ndarray = ends.min(axis=1)
+        high: np.ndarray = ends.max(axis=1)
+        pairs, first, inverse = np.unique(
+            low * len(order) + high, return_index=True, return_inverse=True
+        )
+        least: np.ndarray = np.full(len(pairs), np.inf)
+        np.minimum.at(least, inverse, np.asarray(weights, dtype=np.float64))
+        low, high = low[first], high[first]
+
+        # Both directions of each pair, a loop only once
+        loop: np.ndarray = low == high
+        sources: np.ndarray = np.concatenate([low, high[~loop]])
+        targets: np.ndarray = np.concatenate([high, low[~loop]])
+        joined: np.ndarray = np.concatenate([first, first[~loop]])
+        rows: np.ndarray = np.lexsort((joined, sources))
+        indptr: np.ndarray = np.zeros(len(order) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(sources, minlength=len(order)))
+        return cls(
+            np.asarray(coordinates, dtype=np.float64)[order],
+            indptr,
+            targets[rows].astype(np.int32),
+            np.concatenate([least, least[~loop]])[rows],
+        )
+
+    # Number of nodes
+    def __len__(self) -> int:
+        return len(self.coordinates)
+
+    # Shortest path between two nodes with Dijkstra's algorithm
+    def dijkstra(self, source: int, target: int) -> list[int]:
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+        distances: dict[int, float] = {source: 0.0}
+        predecessors: dict[int, int] = {}
+        done: set[int] = set()
+        # The counter breaks ties between equal distances by insertion order
+        counter: int = 0
+        heap: list[tuple[float, int, int]] = [(0.0, counter, source)]
+        while heap:
+            distance, _, node = heapq.heappop(heap)
+            if node in done:
+                continue
+            done.add(node)
+            if node == target:
+                return self._walk_back(predecessors, source, target)
+            for i in range(indptr[node], indptr[node + 1]):
+                neighbour: int = indices[i]
+                if neighbour in done:
+                    continue
+                candidate: float = distance + weights[i]
+                if neighbour not in distances or candidate < distances[neighbour]:
+                    distances[neighbour] = candidate
+                    predecessors[neighbour] = node
+                    counter += 1
+                    heapq.heappush(heap, (candidate, counter, neighbour))
+        raise Exception(f"Node {target} not reachable from {source}")
+
+    # Shortest path between two points part way along edges, with Dijkstra's algorithm
+    # Sources are the nodes the start point leads to, with the cost of getting to
+    # each, and targets the nodes that lead to the end point, with the cost of
+    # getting from each, so the points are searched from without adding them
+    # Returns the node ids of the path and its cost, from the start point to the end
+    def dijkstra_between(
+        self, sources: dict[int, float], targets: dict[int, float]
+    ) -> tuple[list[int], float]:
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+        distances: dict[int, float] = dict(sources)
+        predecessors: dict[int, int] = {}
+        done: set[int] = set()
+        counter: int = 0
+        heap: list[tuple[float, int, int]] = []
+        for source, distance in sources.items():
+            counter += 1
+            heapq.heappush(heap, (distance, counter, source))
+
+        # Cost and last node of the best path to the end point seen so far
+        best: float = float("inf")
+        last: int | None = None
+        while heap:
+            distance, _, node = heapq.heappop(heap)
+            # No path through unsettled nodes can beat the best seen so far
+            if distance >= best:
+                break
+            if node in done:
+                continue
+            done.add(node)
+            if node in targets and distance + targets[node] < best:
+                best = distance + targets[node]
+                last = node
+            for i in range(indptr[node], indptr[node + 1]):
+                neighbour: int = indices[i]
+                if neighbour in done:
+                    continue
+                candidate: float = distance + weights[i]
+                if neighbour not in distances or candidate < distances[neighbour]:
+                    distances[neighbour] = candidate
+                    predecessors[neighbour] = node
+                    counter += 1
+                    heapq.heappush(heap, (candidate, counter, neighbour))
+        if last is None:
+            raise Exception(
+                f"No node of {list(targets)} reachable from {list(sources)}"
+            )
+
+        # Sources have no predecessor, unless reached cheaper from another source
+        path: list[int] = [last]
+        while path[-1] in predecessors:
+            path.append(predecessors[path[-1]])
+        path.reverse()
+        return path, best
+
+    # Up to k short paths between two nodes that are not much alike, cheapest first
+    # Each is the shortest path through a via node, made of the shortest path to it
+    # from the source and from it to the target, out of one search tree grown from
+    # each end
+    # Via nodes are taken from plateaus, stretches the two trees share, so both
+    # halves of a path are shortest paths and it never doubles back
+    # A path costs at most stretch times the shortest, and shares at most
+    # max_overlap of its length in metres with any path taken before it
+    # The forward tree settles every node within stretch times the shortest cost, so
+    # the trees cost more than one search, and each path tried adds the time to walk
+    # and compare it, three paths take 2 to 3 times as long as one search
+    # Returns the node ids and the cost of each path
+    def alternatives(
+        self,
+        source: int,
+        target: int,
+        k: int = 3,
+        stretch: float = 1.25,
+        max_overlap: float = 0.8,
+    ) -> list[tuple[list[int], float]]:
+        if source == target:
+            return [([source], 0.0)]
+        forward, forward_predecessors = self.search_tree(
+            source, {target}, stretch=stretch
+        )
+        if target not in forward:
+            raise Exception(f"Node {target} not reachable from {source}")
+        best: float = forward[target]
+        # Only nodes through which a path is within the stretch can be via nodes, and
+        # every node on the shortest path from them to the target is one too, so the
+        # backward tree is bounded by the forward distances
+        backward, backward_predecessors = self.search_tree(
+            target, limit=best * stretch, bounds=forward
+        )
+
+        # A via node starts a plateau edge when the next node toward the target in
+        # the backward tree has it as its predecessor in the forward tree
+        candidates: list[tuple[float, int]] = sorted(
+            (forward[node] + backward[node], node)
+            for node, after in backward_predecessors.items()
+            if node in forward
+            and node in backward
+            and forward_predecessors.get(after) == node
+        )
+
+        paths: list[tuple[list[int], float]] = []
+        edge_sets: list[set[tuple[int, int]]] = []
+        used: set[int] = set()
+        for cost, via in [(best, target), *candidates]:
+            if len(paths) >= k or cost > best * stretch:
+                break
+            if via in used:
+                continue
+            path: list[int] = self._walk_back(forward_predecessors, source, via)
+            after: int = via
+            while after != target:
+                after = backward_predecessors[after]
+                path.append(after)
+            # Every via node of the same plateau gives the same path, sums of the
+            # same costs in another order may differ in the last digits
+            same: float = cost + 1e-9 * max(cost, 1.0)
+            used.update(
+                node
+                for node in path
+                if node in forward
+                and node in backward
+                and forward[node] + backward[node] <= same
+            )
+            if len(set(path)) != len(path):
+                continue
+
+            edges: set[tuple[int, int]] = {
+                (min(u, v), max(u, v)) for u, v in zip(path, path[1:])
+            }
+            lengths: dict[tuple[int, int], float] = dict(
+                zip(
+                    edges,
+                    haversine(
+                        self.coordinates[[u for u, _ in edges]],
+                        self.coordinates[[v for _, v in edges]],
+                    ).tolist(),
+                )
+            )
+            length: float = sum(lengths.values())
+            if any(
+                sum(lengths[edge] for edge in edges & taken) > max_overlap * length
+                for taken in edge_sets
+            ):
+                continue
+            paths.append((path, cost))
+            edge_sets.append(edges)
+        return paths
+
+    # Distances and predecessors of the nodes settled by Dijkstra's algorithm
+    # Stops once every target is settled, or once nodes are further than the limit
+    # With stretch, the search goes on past the last target, up to stretch times
+    # its distance
+    # With bounds, the distances of nodes from the other end of a route, a node is
+    # only reached if its distance plus its bound is within the limit, nodes
+    # without a bound are never reached
+    # Ties are broken as in `dijkstra`, so paths out of the tree match it
+    def search_tree(
+        self,
+        source: int,
+        targets: set[int] | None = None,
+        limit: float = float("inf"),
+        stretch: float | None = None,
+        bounds: dict[int, float] | None = None,
+    ) -> tuple[dict[int, float], dict[int, int]]:
+        # With no targets left to settle the search is done at the source
+        if targets is not None and len(targets) == 0:
+            return {source: 0.0}, {}
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+        distances: dict[int, float] = {source: 0.0}
+        predecessors: dict[int, int] = {}
+        settled: dict[int, float] = {}
+        remaining: set[int] = set() if targets is None else set(targets)
+        counter: int = 0
+        heap: list[tuple[float, int, int]] = [(0.0, counter, source)]
+        while heap:
+            distance, _, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            if distance > limit:
+                break
+            settled[node] = distance
+            if node in remaining:
+                remaining.discard(node)
+                if len(remaining) == 0:
+                    if stretch is None:
+                        break
+                    # Past the last target, only nodes within the stretch are settled
+                    limit = min(limit, distance * stretch)
+            for i in range(indptr[node], indptr[node + 1]):
+                neighbour: int = indices[i]
+                if neighbour in settled:
+                    continue
+                candidate: float = distance + weights[i]
+                if (
+                    bounds is not None
+                    and candidate + bounds.get(neighbour, float("inf")) > limit
+                ):
+                    continue
+                if neighbour not in distances or candidate < distances[neighbour]:
+                    distances[neighbour] = candidate
+                    predecessors[neighbour] = node
+                    counter += 1
+                    heapq.heappush(heap, (candidate, counter, neighbour))
+        return settled, predecessors
+
+    # Path from the source of a search tree to one of its settled nodes
+    def tree_path(
+        self, predecessors: dict[int, int], source: int, target: int
+    ) -> list[int]:
+        return self._walk_back(predecessors, source, target)
+
+    # Set the weight of the edge between two nodes, both ways, in place
+    def set_weight(self, u: int, v: int, weight: float) -> None:
+        lowered: bool = False
+        for a, b in [(u, v), (v, u)]:
+            for i in range(self._indptr[a], self._indptr[a + 1]):
+                if self._indices[i] == b:
+                    lowered = lowered or weight < self._weights[i]
+                    self.weights[i] = weight
+                    self._weights[i] = weight
+        self.edits += 1
+        # A lower weight may make the A* heuristic overestimate, so the scale is
+        # lowered to match, a higher weight leaves it lower than needed but safe
+        length: float = sqrt(
+            (self._x[u] - self._x[v]) ** 2 + (self._y[u] - self._y[v]) ** 2
+        )
+        if length > 0:
+            self.heuristic_scale = min(self.heuristic_scale, max(weight / length, 0.0))
+        # Landmark distances may then be longer than the new shortest paths, so they
+        # are found again on the next A* search, higher weights leave them safe
+        if lowered:
+            self._landmarks = None
+
+    # The same adjacency with other weights, in the order of `weights`
+    def with_weights(self, weights: np.ndarray) -> "CSRGraph":
+        csr: CSRGraph = CSRGraph(
+            self.coordinates, self.indptr, self.indices, weights, self.shared
+        )
+        csr._nodes, csr._ids = self._nodes, self._ids
+        return csr
+
+    # Straight line length in metres of every edge, in the order of `weights`
+    def edge_lengths(self) -> np.ndarray:
+        sources: np.ndarray = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        return haversine(self.coordinates[sources], self.coordinates[self.indices])
+
+    # Shortest path between two nodes with A*
+    # The heuristic is the larger of two lower bounds on the cost to the target:
+    # the straight line distance scaled to never overestimate, which is 0 when some
+    # edges cost nothing, and by the triangle inequality the difference of the
+    # distances of the node and the target from a landmark
+    def astar(self, source: int, target: int) -> list[int]:
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+        x, y, scale = self._x, self._y, self.heuristic_scale
+        target_x, target_y = x[target], y[target]
+
+        # The landmarks that bound the cost from the source best, those that cannot
+        # reach the target bound nothing
+        landmarks: np.ndarray = self.landmark_distances()
+        reaching: np.ndarray = np.flatnonzero(np.isfinite(landmarks[:, target]))
+        gaps: np.ndarray = np.abs(
+            landmarks[reaching, source] - landmarks[reaching, target]
+        )
+        active: list[tuple[memoryview, float]] = [
+            (memoryview(landmarks[i]), float(landmarks[i, target]))
+            for i in reaching[np.argsort(-gaps, kind="stable")][:_active_landmarks]
+        ]
+
+        distances: dict[int, float] = {source: 0.0}
+        predecessors: dict[int, int] = {}
+        done: set[int] = set()
+        counter: int = 0
+        heap: list[tuple[float, int, int]] = [(0.0, counter, source)]
+        while heap:
+            _, _, node = heapq.heappop(heap)
+            if node in done:
+                continue
+            done.add(node)
+            if node == target:
+                return self._walk_back(predecessors, source, target)
+            distance: float = distances[node]
+            for i in range(indptr[node], indptr[node + 1]):
+                neighbour: int = indices[i]
+                if neighbour in done:
+                    continue
+                candidate: float = distance + weights[i]
+                if neighbour not in distances or candidate < distances[neighbour]:
+                    distances[neighbour] = candidate
+                    predecessors[neighbour] = node
+                    dx: float = x[neighbour] - target_x
+                    dy: float = y[neighbour] - target_y
+                    bound: float = scale * sqrt(dx * dx + dy * dy)
+                    for from_landmark, target_from_landmark in active:
+                        gap: float = from_landmark[neighbour] - target_from_landmark
+                        if gap > bound:
+                            bound = gap
+                        elif -gap > bound:
+                            bound = -gap
+                    counter += 1
+                    heapq.heappush(heap, (candidate + bound, counter, neighbour))
+        raise Exception(f"Node {target} not reachable from {source}")
+
+    # Distances from landmarks to every node, one row per landmark
+    # Each landmark is the node furthest from those picked before it, starting from
+    # the node furthest from node 0, so they spread to the edges of the graph
+    # Found with SciPy, which searches in C, and kept until an edge gets cheaper
+    def landmark_distances(self) -> np.ndarray:
+        if self._landmarks is not None:
+            return self._landmarks
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import dijkstra
+
+        # Explicit zeros are edges that cost nothing, of parallel edges the
+        # cheapest is taken
+        matrix = csr_matrix(
+            (self.weights, self.indices, self.indptr), shape=(len(self), len(self))
+        )
+        rows: list[np.ndarray] = []
+        nearest: np.ndarray = (
+            dijkstra(matrix, indices=0) if len(self) > 0 else np.empty(0)
+        )
+        for count in range(min(_landmark_count, len(self))):
+            # Unreached nodes are furthest, so a landmark is picked among them
+            landmark: int = int(np.argmax(nearest))
+            rows.append(dijkstra(matrix, indices=landmark))
+            nearest = rows[0] if count == 0 else np.minimum(nearest, rows[-1])
+        self._landmarks = np.array(rows, dtype=np.float64).reshape(-1, len(self))
+        return self._landmarks
+
+    # Shortest path between two nodes, searching from both ends until they meet
+    def bidirectional(self, source: int, target: int) -> list[int]:
+        if source == target:
+            return [source]
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+
+        # Index 0 searches forward from the source, index 1 backward from the target
+        distances: list[dict[int, float]] = [{source: 0.0}, {target: 0.0}]
+        predecessors: list[dict[int, int]] = [{}, {}]
+        done: list[set[int]] = [set(), set()]
+        heaps: list[list[tuple[float, int]]] = [[(0.0, source)], [(0.0, target)]]
+
+        # Cost and meeting node of the best complete path seen so far
+        best: float = float("inf")
+        meeting: int | None = None
+
+        while heaps[0] and heaps[1]:
+            # No path through unsettled nodes can beat the best seen so far
+            if heaps[0][0][0] + heaps[1][0][0] >= best:
+                break
+
+            # Expand whichever side has the smaller frontier
+            side: int = 0 if len(heaps[0]) <= len(heaps[1]) else 1
+            distance, node = heapq.heappop(heaps[side])
+            if node in done[side]:
+                continue
+            done[side].add(node)
+
+            other: dict[int, float] = distances[1 - side]
+            for i in range(indptr[node], indptr[node + 1]):
+                neighbour: int = indices[i]
+                candidate: float = distance + weights[i]
+                if (
+                    neighbour not in distances[side]
+                    or candidate < distances[side][neighbour]
+                ):
+                    distances[side][neighbour] = candidate
+                    predecessors[side][neighbour] = node
+                    heapq.heappush(heaps[side], (candidate, neighbour))
+                if neighbour in other and candidate + other[neighbour] < best:
+                    best = candidate + other[neighbour]
+                    meeting = neighbour
+
+        if meeting is None:
+            raise Exception(f"Node {target} not reachable from {source}")
+        forward: list[int] = self._walk_back(predecessors[0], source, meeting)
+        backward: list[int] = self._walk_back(predecessors[1], target, meeting)
+        return forward + backward[::-1][1:]
+
+    # Total weight of a path of node ids, taking the cheapest of parallel edges
+    def path_weight(self, path: list[int]) -> float:
+        total: float = 0.0
+        for u, v in zip(path, path[1:]):
+            start, end = self._indptr[u], self._indptr[u + 1]
+            total += min(
+                self._weights[i] for i in range(start, end) if self._indices[i] == v
+            )
+        return total
+
+    # Smallest ratio of edge weight to straight line length
+    # Scaling straight line distance by it gives a heuristic that never overestimates
+    def _heuristic_scale(self) -> float:
+        if len(self.indices) == 0:
+            return 0.0
+        sources: np.ndarray = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        lengths: np.ndarray = np.hypot(
+            *(self.coordinates[sources] - self.coordinates[self.indices]).T
+        )
+        positive: np.ndarray = lengths > 0
+        if not positive.any():
+            return 0.0
+        return float(max((self.weights[positive] / lengths[positive]).min(), 0.0))
+
+    # Follow predecessors from a node back to the start of a search
+    def _walk_back(
+        self, predecessors: dict[int, int], start: int, node: int
+    ) -> list[int]:
+        path: list[int] = [node]
+        while node != start:
+            node = predecessors[node]
+            path.append(node)
+        path.reverse()
+        return path
+
+
+# Great circle distance in metres between arrays of (longitude, latitude) points
+def haversine(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    lon_a, lat_a = np.radians(a[..., 0]), np.radians(a[..., 1])
+    lon_b, lat_b = np.radians(b[..., 0]), np.radians(b[..., 1])
+    h: np.ndarray = (
+        np.sin((lat_b - lat_a) / 2) ** 2
+        + np.cos(lat_a) * np.cos(lat_b) * np.sin((lon_b - lon_a) / 2) ** 2
+    )
+    return 2 * _earth_radius * np.arcsin(np.sqrt(h))
@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import numpy as np
+import util
+from typing import Callable, Iterable, TextIO
+from xml.sax.saxutils import escape
+from csr import haversine
+
+"""
+Stream many routes to one file as they are found
+Routes are written as the tracks of one GPX file, or as newline-delimited
+GeoJSON with one feature per line, and only the route being written is held
+in memory
+"""
+
+
+# File extensions of each export format
+_gpx_extensions = [".gpx"]
+_geojson_lines_extensions = [".geojsonl", ".geojsons", ".ndjson", ".jsonl"]
+
+# Report progress every this many routes
+_progress_interval = 10000
+
+
+# Write routes from an iterable, such as a generator, to one file
+# The format is chosen by the extension, GPX tracks or GeoJSON lines
+# Routes without a path are kept, as empty tracks or features with no geometry,
+# so route i of the file is always path i of the iterable
+# Returns the number of routes written
+def export_paths(
+    paths: Iterable[list[tuple[float, float]]],
+    file_path: str,
+    name_prefix: str = "route",
+) -> int:
+    extension: str = os.path.splitext(file_path)[1].lower()
+    if extension in _gpx_extensions:
+        write_route: Callable[[TextIO, list, str], None] = _write_gpx_track
+    elif extension in _geojson_lines_extensions:
+        write_route = _write_geojson_line
+    else:
+        raise Exception(
+            f'Unknown export format "{extension}", choose one of '
+            f"{_gpx_extensions + _geojson_lines_extensions}"
+        )
+
+    directory: str = os.path.dirname(file_path)
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+
+    start: float = time.perf_counter()
+    count: int = 0
+    # Write to a temporary file first, so a failed export leaves no partial file
+    temporary_path: str = f"{file_path}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as file:
+        if extension in _gpx_extensions:
+            file.write(_gpx_header)
+        for count, path in enumerate(paths, start=1):
+            write_route(file, path, f"{name_prefix} {count - 1}")
+            if count % _progress_interval == 0:
+                util.info(f"Exported {count} routes")
+        if extension in _gpx_extensions:
+            file.write(_gpx_footer)
+    os.replace(temporary_path, file_path)
+
+    elapsed: float = time.perf_counter() - start
+    util.info(
+        f"Exported {count} routes to {file_path} in {elapsed:.1f} s, "
+        f"{count / max(elapsed, 1e-9):.0f} routes/s"
+    )
+    return count
+
+
+# Start and end of a GPX file, tracks are written between them
+_gpx_header = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" '
+    'creator="Pedestrian Trip Planner">\n'
+)
+_gpx_footer = "</gpx>\n"
+
+
+# Write one route as a GPX track
+def _write_gpx_track(file: TextIO, path: list[tuple[float, float]], name: str) -> None:
+    file.write(f"  <trk>\n    <name>{escape(name)}</name>\n    <trkseg>\n")
+    file.write(
+        "".join(f'      <trkpt lat="{lat}" lon="{lon}"/>\n' for lon, lat in path)
+    )
+    file.write("    </trkseg>\n  </trk>\n")
+
+
+# Write one route as a GeoJSON feature on its own line
+def _write_geojson_line(
+    file: TextIO, path: list[tuple[float, float]], name: str
+) -> None:
+    length: float = 0.0
+    geometry: dict | None = None
+    if len(path) > 0:
+        coordinates: np.ndarray = np.array(path, dtype=float).reshape(-1, 2)
+        length = float(haversine(coordinates[:-1], coordinates[1:]).sum())
+        geometry = {"type": "LineString", "coordinates": coordinates.tolist()}
+    feature: dict = {
+        "type": "Feature",
+        "geometry": geometry,
+        "properties": {"name": name, "length": length},
+    }
+    file.write(json.dumps(feature))
+    file.write("\n")
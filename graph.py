@@ -1,17 +1,51 @@
+from __future__ import annotations
+
+import math
+import time
+import weakref
+import itertools
 import networkx as nx
+import numpy as np
+import shapely
 from collections import namedtuple
+from scipy.spatial import cKDTree
 from util import *
+from csr import CSRGraph, haversine
+from compact import CompactGraph
+from contraction import ContractionHierarchy
+from route_cache import RouteCache, RouteKey, overridden_suffix
+from instrument import stage
 from math import sqrt
-from typing import Callable, List
+from typing import TYPE_CHECKING, Callable, Iterable, List
+
+# GeoPandas is slow to import, only isochrones need it
+if TYPE_CHECKING:
+    import geopandas as gpd
 
 """
 Collected networkx graph utility functions
 """
 
 
+# How points are snapped to the graph, to the nearest node or onto the nearest edge
+snaps = ["node", "edge"]
+
+# Search engines for shortest paths
+# "networkx" runs nx.dijkstra_path, "contraction" queries a ContractionHierarchy,
+# the others run on the array backed CSRGraph
+engines = ["networkx", "dijkstra", "astar", "bidirectional", "contraction"]
+
+# Engines that can search between points snapped onto edges
+edge_engines = ["dijkstra", "contraction"]
+
+
 # Longitude and latitude coordinates of a point
 Location = namedtuple("Location", ["longitude", "latitude"])
 
+# A road graph, as built or as read from the graph cache without building the
+# MultiGraph, routers, indexes and overrides take either
+RoadGraph = nx.MultiGraph | CompactGraph
+
 
 # Get single largest connected component of graph
 def largest_component(graph: nx.MultiGraph) -> nx.MultiGraph:
@@ -25,58 +59,1050 @@ def largest_component(graph: nx.MultiGraph) -> nx.MultiGraph:
     return graph.subgraph(largest_component)
 
 
+# KD-tree over the coordinates of every node in a graph, for fast point snapping
+class NodeIndex:
+    def __init__(self, graph: nx.Graph) -> None:
+        self.nodes: list[tuple[float, float]] = list(graph.nodes())
+        self.size: int = graph.number_of_nodes()
+        self.coordinates: np.ndarray = np.array(self.nodes, dtype=float).reshape(-1, 2)
+        self.tree: cKDTree | None = (
+            cKDTree(self.coordinates) if len(self.nodes) > 0 else None
+        )
+
+    # Get the nearest node to a single point
+    def nearest(self, pos: Location) -> tuple[float, float] | None:
+        if self.tree is None:
+            return None
+        _, i = self.tree.query((pos[0], pos[1]))
+        return self.nodes[i]
+
+    # Get the nearest node to each of many points, in one vectorized query
+    def nearest_many(self, positions: list[Location]) -> list[tuple[float, float]]:
+        if self.tree is None:
+            return [None] * len(positions)
+        points: np.ndarray = np.asarray(positions, dtype=float).reshape(-1, 2)
+        _, indices = self.tree.query(points)
+        return [self.nodes[i] for i in indices]
+
+
+# Node indexes already built, kept for as long as their graph is alive
+_node_indexes: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+# Get the node index of a graph, building it on first use
+def node_index(graph: nx.Graph) -> NodeIndex:
+    index: NodeIndex | None = _node_indexes.get(graph)
+    # Rebuild if nodes were added or removed since the index was built
+    if index is None or index.size != graph.number_of_nodes():
+        index = NodeIndex(graph)
+        _node_indexes[graph] = index
+    return index
+
+
 # Get the nearest node to a point in a graph
 def nearest_node(graph: nx.Graph, pos: Location) -> tuple[float, float] | None:
-    nodes: list[tuple[float, float]] = list(graph.nodes())
-    nearest: tuple[float, float] | None = None
-    min_distance_square: float = float("inf")
-    for node in nodes:
-        dy: float = node[0] - pos[0]
-        dx: float = node[1] - pos[1]
-        distance_square: float = (dy) ** 2 + (dx) ** 2
-        if distance_square < min_distance_square:
-            min_distance_square = distance_square
-            nearest = node
-    return nearest
+    return node_index(graph).nearest(pos)
+
+
+# Get the nearest node to each of many points in a graph
+def nearest_nodes(
+    graph: nx.Graph, positions: list[Location]
+) -> list[tuple[float, float]]:
+    return node_index(graph).nearest_many(positions)
+
+
+# A point snapped onto an edge: the (u, v, key) edge, how far along it from u as a
+# fraction of its length, the snapped (longitude, latitude) point, and the distance
+# in metres from the point to it
+EdgeSnap = namedtuple("EdgeSnap", ["edge", "fraction", "point", "distance"])
+
+
+# Spatial index over the geometry of every edge in a graph, for snapping points
+# onto the nearest edge
+# Longitudes are scaled by the cosine of the mean latitude, so distances in the
+# index are in proportion to metres and not to degrees
+class EdgeIndex:
+    def __init__(self, graph: RoadGraph) -> None:
+        # A graph read from cache has its geometries and ids as columns
+        if isinstance(graph, CompactGraph):
+            self.edges: list[tuple] = list(graph.edges(keys=True))
+            cached: np.ndarray | None = graph.edge_geometries()
+            geometries: list = (
+                [None] * len(self.edges) if cached is None else list(cached)
+            )
+            osm_ids: list = graph.edge_values("osm_id")
+        else:
+            rows: list[tuple] = list(graph.edges(keys=True, data=True))
+            self.edges = [row[:3] for row in rows]
+            geometries = [data.get("geometry") for _, _, _, data in rows]
+            osm_ids = [data.get("osm_id") for _, _, _, data in rows]
+        edges: list[tuple] = self.edges
+        # Edges without a geometry run straight between their ends
+        lines: list = [
+            geometry if geometry is not None else shapely.LineString([u, v])
+            for (u, v, _), geometry in zip(edges, geometries)
+        ]
+        ends: np.ndarray = np.array(
+            [(u, v) for u, v, _ in edges], dtype=np.float64
+        ).reshape(-1, 2, 2)
+        latitude: float = float(ends[..., 1].mean()) if len(edges) > 0 else 0.0
+        self.scale: np.ndarray = np.array([np.cos(np.radians(latitude)), 1.0])
+        self.lines: np.ndarray = shapely.transform(
+            np.array(lines, dtype=object), lambda coordinates: coordinates * self.scale
+        )
+        # Geometries drawn from v to u are measured from their far end
+        first: np.ndarray = shapely.get_coordinates(
+            shapely.get_point(lines, 0)
+        ).reshape(-1, 2)
+        self.reversed: np.ndarray = np.linalg.norm(
+            first - ends[:, 1], axis=1
+        ) < np.linalg.norm(first - ends[:, 0], axis=1)
+        self.tree: shapely.STRtree | None = (
+            shapely.STRtree(self.lines) if len(edges) > 0 else None
+        )
+        # Positions in edges of the edges of each OSM road, split roads have several
+        self.ids: dict[str, list[int]] = {}
+        for i, osm_id in enumerate(osm_ids):
+            if osm_id is not None:
+                self.ids.setdefault(str(osm_id), []).append(i)
+
+    # Positions in edges of the edges that cross an area, such as a box or polygon
+    def within(self, area: shapely.Geometry) -> list[int]:
+        if self.tree is None:
+            return []
+        scaled = shapely.transform(area, lambda coordinates: coordinates * self.scale)
+        return self.tree.query(scaled, predicate="intersects").tolist()
+
+    # Snap a single point onto its nearest edge
+    def nearest(self, pos: Location) -> EdgeSnap | None:
+        return self.nearest_many([pos])[0]
+
+    # Snap each of many points onto its nearest edge, in one vectorized query
+    # Given usable, a point whose nearest edge is not usable, such as a closed
+    # one, snaps onto its nearest usable edge, or stays on it if none is usable
+    def nearest_many(
+        self,
+        positions: list[Location],
+        usable: Callable[[tuple], bool] | None = None,
+    ) -> list[EdgeSnap]:
+        if self.tree is None:
+            return [None] * len(positions)
+        coordinates: np.ndarray = np.asarray(positions, dtype=float).reshape(-1, 2)
+        points: np.ndarray = shapely.points(coordinates * self.scale)
+        # One nearest edge per point, ties go to the first edge found
+        inputs, found = self.tree.query_nearest(points, all_matches=False)
+        edges: np.ndarray = np.empty(len(points), dtype=np.int64)
+        edges[inputs] = found
+        if usable is not None:
+            for i, edge in enumerate(edges.tolist()):
+                if not usable(self.edges[edge]):
+                    edges[i] = self._nearest_usable(points[i], edge, usable)
+
+        lines: np.ndarray = self.lines[edges]
+        along: np.ndarray = shapely.line_locate_point(lines, points, normalized=True)
+        # Edges of no length have no fraction, snap to their start
+        along = np.nan_to_num(along)
+        snapped: np.ndarray = (
+            shapely.get_coordinates(
+                shapely.line_interpolate_point(lines, along, normalized=True)
+            )
+            / self.scale
+        )
+        fractions: np.ndarray = np.where(self.reversed[edges], 1 - along, along)
+        distances: np.ndarray = haversine(coordinates, snapped)
+        return [
+            EdgeSnap(self.edges[edge], fraction, point, distance)
+            for edge, fraction, point, distance in zip(
+                edges.tolist(),
+                fractions.tolist(),
+                map(tuple, snapped.tolist()),
+                distances.tolist(),
+            )
+        ]
+
+    # Position of the nearest usable edge to a scaled point, given its nearest edge
+    # Edges are searched within a distance doubled until one is usable, the
+    # nearest usable edge within it is then the nearest of all
+    def _nearest_usable(
+        self, point: shapely.Point, nearest: int, usable: Callable[[tuple], bool]
+    ) -> int:
+        distance: float = max(float(shapely.distance(point, self.lines[nearest])), 1e-9)
+        while True:
+            distance *= 2
+            found: np.ndarray = np.sort(
+                self.tree.query(point, predicate="dwithin", distance=distance)
+            )
+            candidates: list[int] = [
+                edge for edge in found.tolist() if usable(self.edges[edge])
+            ]
+            if len(candidates) > 0:
+                gaps: np.ndarray = shapely.distance(point, self.lines[candidates])
+                return candidates[int(np.argmin(gaps))]
+            if len(found) == len(self.edges):
+                return nearest
+
+
+# Edge indexes already built, kept for as long as their graph is alive
+_edge_indexes: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+# Get the edge index of a graph, building it on first use
+# Counting the edges of a MultiGraph visits every node, so changes to the edges
+# need `Router.invalidate` to rebuild it
+def edge_index(graph: RoadGraph) -> EdgeIndex:
+    index: EdgeIndex | None = _edge_indexes.get(graph)
+    if index is None:
+        index = EdgeIndex(graph)
+        _edge_indexes[graph] = index
+    return index
+
+
+# Snap a point onto the nearest edge of a graph
+def nearest_edge(graph: RoadGraph, pos: Location) -> EdgeSnap | None:
+    return edge_index(graph).nearest(pos)
+
+
+# Snap each of many points onto the nearest edge of a graph
+def nearest_edges(graph: RoadGraph, positions: list[Location]) -> list[EdgeSnap]:
+    return edge_index(graph).nearest_many(positions)
+
+
+# Mark a weight function as taking the EdgeColumns of every edge at once
+# It returns the weight of each edge as an array, in the order of columns.edges
+def vectorized(
+    function: Callable[[EdgeColumns], np.ndarray],
+) -> Callable[[EdgeColumns], np.ndarray]:
+    function.vectorized = True
+    return function
+
+
+# Is a weight function vectorized, rather than called once per edge
+def is_vectorized(function: Callable) -> bool:
+    return getattr(function, "vectorized", False)
+
+
+# Every edge of a graph as NumPy columns, for vectorized weight functions
+# Weight columns of several weight functions over one graph are parallel, row i
+# of each is the weight of edges[i]
+class EdgeColumns:
+    def __init__(self, graph: RoadGraph) -> None:
+        # Iterating the edges of a MultiGraph is the slow part, so it is done once
+        rows: list[tuple] = list(graph.edges(keys=True, data=True))
+
+        # Edges as (u, v, key), in the order of the rows
+        self.edges: list[tuple] = [(u, v, key) for u, v, key, _ in rows]
+        self.nodes: list[tuple[float, float]] = list(graph.nodes())
+        ids: dict[tuple[float, float], int] = {
+            node: i for i, node in enumerate(self.nodes)
+        }
+        self.coordinates: np.ndarray = np.array(self.nodes, dtype=float).reshape(-1, 2)
+
+        # Node ids and (longitude, latitude) coordinates of the ends of each edge
+        self.u_ids: np.ndarray = np.array(
+            [ids[u] for u, _, _ in self.edges], dtype=np.int64
+        )
+        self.v_ids: np.ndarray = np.array(
+            [ids[v] for _, v, _ in self.edges], dtype=np.int64
+        )
+        self.u: np.ndarray = self.coordinates[self.u_ids]
+        self.v: np.ndarray = self.coordinates[self.v_ids]
+
+        # Missing or non-numeric speeds are NaN, missing classes are ""
+        speeds: list = [data.get("maxspeed") for _, _, _, data in rows]
+        try:
+            self.maxspeed: np.ndarray = np.array(speeds, dtype=np.float64)
+        except (TypeError, ValueError):
+            self.maxspeed = np.array(list(map(_number, speeds)), dtype=np.float64)
+        self.fclass: np.ndarray = np.array(
+            [
+                value if isinstance(value, str) else ""
+                for value in (data.get("fclass") for _, _, _, data in rows)
+            ],
+            dtype=str,
+        )
+
+    # Number of edges
+    def __len__(self) -> int:
+        return len(self.edges)
+
+    # A value of every node, such as a land use score, at each end of each edge
+    def node_values(
+        self, value: Callable[[tuple[float, float]], float]
+    ) -> tuple[np.ndarray, np.ndarray]:
+        values: np.ndarray = np.array(
+            [value(node) for node in self.nodes], dtype=np.float64
+        )
+        return values[self.u_ids], values[self.v_ids]
+
+
+# Edge columns already built, kept for as long as their graph is alive
+_edge_columns: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+# Get the edge columns of a graph, building them on first use
+# Every vectorized weight function of a graph shares them
+def edge_columns(graph: RoadGraph) -> EdgeColumns:
+    columns: EdgeColumns | None = _edge_columns.get(graph)
+    if columns is None:
+        columns = EdgeColumns(graph)
+        _edge_columns[graph] = columns
+    return columns
+
+
+# A number as a float, NaN if it is missing or not a number
+def _number(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+# Every edge of a graph as a GeoDataFrame, with the CSR ids of its ends and its weights
+class EdgeTable:
+    def __init__(
+        self, graph: RoadGraph, csr: CSRGraph, edge_weights: dict[tuple, float]
+    ) -> None:
+        import geopandas as gpd
+
+        edges: list[tuple] = list(graph.edges(keys=True, data=True))
+        self.size: int = len(csr)
+        self.u: np.ndarray = np.array(
+            [csr.ids[edge[0]] for edge in edges], dtype=np.int64
+        )
+        self.v: np.ndarray = np.array(
+            [csr.ids[edge[1]] for edge in edges], dtype=np.int64
+        )
+        self.straight_lengths: np.ndarray = haversine(
+            csr.coordinates[self.u], csr.coordinates[self.v]
+        )
+        # Closed edges have infinite length, so cannot be walked by metres either
+        # Edges of graphs stitched from tiles may be listed the other way round to
+        # the keys of their weights
+        self.costs: np.ndarray = np.array(
+            [
+                (
+                    edge_weights[(u, v, key)]
+                    if (u, v, key) in edge_weights
+                    else edge_weights[(v, u, key)]
+                )
+                for u, v, key, _ in edges
+            ],
+            dtype=np.float64,
+        )
+        self.lengths: np.ndarray = np.where(
+            np.isinf(self.costs), np.inf, self.straight_lengths
+        )
+        # Row of each (u, v, key) edge
+        self.rows: dict[tuple, int] = {edge[:3]: i for i, edge in enumerate(edges)}
+        self.edges: gpd.GeoDataFrame = gpd.GeoDataFrame(
+            [
+                {name: value for name, value in data.items() if name != "geometry"}
+                for _, _, _, data in edges
+            ],
+            geometry=[data.get("geometry") for _, _, _, data in edges],
+            crs=graph.graph.get("crs"),
+        )
+
+    # Edges that can be walked in full within a limit, given the distance of every
+    # node settled by a search tree, in metres or in weighted cost
+    # Each edge has a "reach" column, the cost or distance to its far end
+    def within(
+        self, settled: dict[int, float], limit: float, metres: bool = True
+    ) -> gpd.GeoDataFrame:
+        distances: np.ndarray = np.full(self.size, np.inf)
+        distances[list(settled.keys())] = list(settled.values())
+
+        # An edge is walked in full from whichever end is reached first
+        weights: np.ndarray = self.lengths if metres else self.costs
+        reach: np.ndarray = np.minimum(distances[self.u], distances[self.v]) + weights
+        within: np.ndarray = np.flatnonzero(reach <= limit)
+
+        isochrone: gpd.GeoDataFrame = self.edges.iloc[within].reset_index(drop=True)
+        isochrone["reach"] = reach[within]
+        return isochrone
+
+    # Set the cost of some (u, v, key) edges in place
+    def set_costs(self, costs: dict[tuple, float]) -> None:
+        for (u, v, key), cost in costs.items():
+            row: int = self.rows.get((u, v, key), self.rows.get((v, u, key)))
+            self.costs[row] = cost
+            self.lengths[row] = np.inf if np.isinf(cost) else self.straight_lengths[row]
+
+
+# Weighted search graph of a road graph, built once and reused across many queries
+class Router:
+    def __init__(
+        self,
+        graph: RoadGraph,
+        weight_function: Callable[[tuple[float, float], tuple[float, float]], float],
+        weights: dict[tuple, float] | None = None,
+    ) -> None:
+        self.graph: RoadGraph = graph
+        self.weight_function = weight_function
+        # Are the weights computed and overridden, the structures below are built
+        # from them when first asked for
+        self.prepared: bool = False
+        # Only the "networkx" engine searches a networkx graph
+        self.search_graph: nx.Graph | None = None
+        self.csr: CSRGraph | None = None
+        # Same adjacency as csr, weighted by length in metres
+        self.length_csr: CSRGraph | None = None
+        self.edge_table: EdgeTable | None = None
+        self.contraction: ContractionHierarchy | None = None
+        # Weight of every (u, v, key) edge, if already known from a graph cache
+        self.edge_weights: dict[tuple, float] | None = weights
+        # Finished routes are cached only when both are set, the version tags
+        # the graph and weights, so routes of other graphs are never returned
+        self.cache: RouteCache | None = None
+        self.version: str | None = None
+        # Computed weight of each edge whose weight is overridden, see
+        # `override_weights`, the edge weights hold the overridden weights
+        self.base_weights: dict[tuple, float] = {}
+
+    # Compute the weight of every edge, unless already computed
+    def prepare(self) -> dict[tuple, float]:
+        # Overrides past their expiry time are removed before any query
+        expire_overrides(self.graph)
+        # Counting the edges of a MultiGraph visits every node, so it is not
+        # checked on each query, changes to the graph need `invalidate`
+        if not self.prepared:
+            # Weights known for a different set of edges are out of date
+            edges: int = self.graph.number_of_edges()
+            if self.edge_weights is not None and len(self.edge_weights) != edges:
+                self.edge_weights = None
+            self._prepare_weights()
+            self.prepared = True
+            self.search_graph = None
+            self.csr = None
+            self.length_csr = None
+            self.edge_table = None
+            self.contraction = None
+        return self.edge_weights
+
+    # Get the search graph as CSR arrays, building them on first use
+    def prepare_csr(self) -> CSRGraph:
+        self.prepare()
+        if self.csr is None:
+            self.csr = self._build_csr()
+        return self.csr
+
+    # Get the search graph as a networkx graph, for the "networkx" engine
+    def prepare_search_graph(self) -> nx.Graph:
+        self.prepare()
+        if self.search_graph is None:
+            self.search_graph = self._build_search_graph()
+        return self.search_graph
+
+    # Get the search graph as CSR arrays weighted by length in metres
+    def prepare_length_csr(self) -> CSRGraph:
+        csr: CSRGraph = self.prepare_csr()
+        if self.length_csr is None:
+            # Closed edges cannot be walked by metres either
+            lengths: np.ndarray = csr.edge_lengths()
+            lengths[np.isinf(csr.weights)] = np.inf
+            self.length_csr = csr.with_weights(lengths)
+        return self.length_csr
+
+    # Get every edge of the graph as a table, for isochrones
+    def prepare_edge_table(self) -> "EdgeTable":
+        csr: CSRGraph = self.prepare_csr()
+        if self.edge_table is None:
+            self.edge_table = EdgeTable(self.graph, csr, self.edge_weights)
+        return self.edge_table
+
+    # Get the contraction hierarchy of the search graph, building it on first use
+    def prepare_contraction(self) -> ContractionHierarchy:
+        csr: CSRGraph = self.prepare_csr()
+        if self.contraction is None:
+            self.contraction = ContractionHierarchy.build(csr)
+        return self.contraction
+
+    # Discard the computed weights, they are recomputed on the next query
+    # Cached routes found with them are discarded too
+    def invalidate(self) -> None:
+        if self.cache is not None and self.version is not None:
+            self.cache.discard(self.version)
+            self.cache.discard(f"{self.version}{overridden_suffix}")
+        self.base_weights = {}
+        self.prepared = False
+        self.search_graph = None
+        self.csr = None
+        self.length_csr = None
+        self.edge_table = None
+        self.contraction = None
+        self.edge_weights = None
+        _edge_columns.pop(self.graph, None)
+        _edge_indexes.pop(self.graph, None)
+
+    # Get the shortest path between two points
+    # Points snap to their nearest nodes, or with snap "edge" onto their nearest
+    # edges, and the path then runs between the snapped points
+    def shortest_path(
+        self,
+        start: Location,
+        end: Location,
+        engine: str = "networkx",
+        snap: str = "node",
+    ) -> list[tuple[float, float]]:
+        if engine not in engines:
+            raise Exception(f'Unknown engine "{engine}", choose one of {engines}')
+        if snap not in snaps:
+            raise Exception(f'Unknown snap "{snap}", choose one of {snaps}')
+        if snap == "edge" and engine not in edge_engines:
+            raise Exception(
+                f'Engine "{engine}" cannot snap onto edges, choose one of {edge_engines}'
+            )
+        self.prepare()
+        if snap == "edge":
+            return self._shortest_path_on_edges(start, end, engine)
+
+        # Compute the nearest nodes to the start and end points
+        start_node, end_node = nearest_nodes(self.graph, [start, end])
+
+        if start_node == end_node:
+            # If the start and end nodes are the same, there is no path between
+            # Let the user off with a warning
+            warning(f"Path nodes are identical. {start_node}")
+            return []
+
+        key: RouteKey | None = None
+        if self.cache is not None and self.version is not None:
+            key = (self.route_version(), engine, start_node, end_node)
+            cached: list[tuple[float, float]] | None = self.cache.get(key)
+            if cached is not None:
+                # A copy, so callers changing the path do not change the cache
+                return list(cached)
+
+        # Throw an exception if the path finding fails
+        try:
+            with stage("search"):
+                path: list[tuple[float, float]] = self._search(
+                    start_node, end_node, engine
+                )
+            # Searches may cross closed edges when there is no other way
+            if len(self.base_weights) > 0:
+                csr: CSRGraph = self.prepare_csr()
+                if math.isinf(csr.path_weight([csr.ids[node] for node in path])):
+                    raise Exception("Every path crosses a closed edge")
+        except:
+            message: str = (
+                f"Cannot find a path between {start} and {end}. Search nodes are {start_node} and {end_node}"
+            )
+            raise Exception(message)
+
+        if key is not None:
+            self.cache.put(key, list(path))
+        return path
+
+    # Get the shortest path between two points snapped onto their nearest edges
+    # Each snapped point is a virtual node on its edge, joined to the ends of the
+    # edge at their share of its weight only for the search, the graph is unchanged
+    def _shortest_path_on_edges(
+        self, start: Location, end: Location, engine: str
+    ) -> list[tuple[float, float]]:
+        # Closed edges cannot be started or ended on, points snap past them
+        start_snap, end_snap = edge_index(self.graph).nearest_many(
+            [start, end], lambda edge: math.isfinite(self._edge_weight(edge))
+        )
+
+        # Snapped points are not nodes, so routes are keyed by the points
+        key: RouteKey | None = None
+        if self.cache is not None and self.version is not None:
+            key = (
+                self.route_version(),
+                f"{engine}:edge",
+                start_snap.point,
+                end_snap.point,
+            )
+            cached: list[tuple[float, float]] | None = self.cache.get(key)
+            if cached is not None:
+                return list(cached)
+
+        try:
+            with stage("search"):
+                nodes, cost = self._search_between(start_snap, end_snap, engine)
+            # Along a single edge, walking straight between the points may be cheaper
+            if start_snap.edge == end_snap.edge:
+                along: float = abs(start_snap.fraction - end_snap.fraction)
+                if along * self._edge_weight(start_snap.edge) <= cost:
+                    nodes, cost = [], along * self._edge_weight(start_snap.edge)
+            # Searches may cross closed edges when there is no other way
+            if math.isinf(cost):
+                raise Exception("Every path crosses a closed edge")
+        except:
+            message: str = (
+                f"Cannot find a path between {start} and {end}. Search edges are {start_snap.edge} and {end_snap.edge}"
+            )
+            raise Exception(message)
+
+        path: list[tuple[float, float]] = [start_snap.point]
+        for point in [*nodes, end_snap.point]:
+            # A point snapped onto the end of its edge is that node
+            if point != path[-1]:
+                path.append(point)
+
+        if key is not None:
+            self.cache.put(key, list(path))
+        return path
+
+    # Get the nodes of the cheapest path between two points snapped onto edges,
+    # and its cost from point to point
+    def _search_between(
+        self, start_snap: EdgeSnap, end_snap: EdgeSnap, engine: str
+    ) -> tuple[list[tuple[float, float]], float]:
+        csr: CSRGraph = self.prepare_csr()
+        if engine == "dijkstra":
+            ids, cost = csr.dijkstra_between(
+                self._snap_costs(start_snap, csr.ids),
+                self._snap_costs(end_snap, csr.ids),
+            )
+            return [csr.nodes[i] for i in ids], cost
+
+        # A hierarchy searches between nodes, so each end of the start edge is
+        # tried with each end of the end edge
+        hierarchy: ContractionHierarchy = self.prepare_contraction()
+        best: tuple[list[tuple[float, float]], float] | None = None
+        for source, to_source in self._snap_costs(start_snap, hierarchy.ids).items():
+            for target, from_target in self._snap_costs(
+                end_snap, hierarchy.ids
+            ).items():
+                nodes: list[tuple[float, float]] = [
+                    hierarchy.nodes[i] for i in hierarchy.shortest_path(source, target)
+                ]
+                cost: float = (
+                    to_source
+                    + csr.path_weight([csr.ids[node] for node in nodes])
+                    + from_target
+                )
+                if best is None or cost < best[1]:
+                    best = (nodes, cost)
+        return best
+
+    # Cost between a point snapped onto an edge and each end of the edge, by id
+    def _snap_costs(
+        self, snapped: EdgeSnap, ids: dict[tuple[float, float], int]
+    ) -> dict[int, float]:
+        u, v, _ = snapped.edge
+        weight: float = self._edge_weight(snapped.edge)
+        costs: dict[int, float] = {}
+        for node, share in [(u, snapped.fraction), (v, 1 - snapped.fraction)]:
+            # A point on a node costs nothing to it, even along a closed edge
+            cost: float = 0.0 if share == 0 else share * weight
+            # The ends of a loop are the same node, reached the cheaper way
+            costs[ids[node]] = min(cost, costs.get(ids[node], float("inf")))
+        return costs
+
+    # Version tag of the routes found now, routes found while weights are
+    # overridden are kept apart, so they are never returned once the overrides end
+    def route_version(self) -> str | None:
+        if self.version is None or len(self.base_weights) == 0:
+            return self.version
+        return f"{self.version}{overridden_suffix}"
+
+    # Weight of a (u, v, key) edge, whichever way round its ends are given
+    def _edge_weight(self, edge: tuple) -> float:
+        u, v, key = edge
+        weight: float | None = self.edge_weights.get(edge)
+        return self.edge_weights[(v, u, key)] if weight is None else weight
+
+    # Get the shortest path between two nodes with an engine
+    def _search(
+        self,
+        start_node: tuple[float, float],
+        end_node: tuple[float, float],
+        engine: str,
+    ) -> list[tuple[float, float]]:
+        if engine == "networkx":
+            return nx.dijkstra_path(
+                self.prepare_search_graph(), start_node, end_node, weight="weight"
+            )
+        if engine == "contraction":
+            hierarchy: ContractionHierarchy = self.prepare_contraction()
+            ids: list[int] = hierarchy.shortest_path(
+                hierarchy.ids[start_node], hierarchy.ids[end_node]
+            )
+            return [hierarchy.nodes[i] for i in ids]
+        csr: CSRGraph = self.prepare_csr()
+        search: Callable[[int, int], list[int]] = getattr(csr, engine)
+        ids = search(csr.ids[start_node], csr.ids[end_node])
+        return [csr.nodes[i] for i in ids]
+
+    # Get up to k short paths between two points that are not much alike, with
+    # their costs, cheapest first
+    # Paths cost at most stretch times the shortest path, and share at most
+    # max_overlap of their length with any cheaper path, see `CSRGraph.alternatives`
+    def alternative_paths(
+        self,
+        start: Location,
+        end: Location,
+        k: int = 3,
+        stretch: float = 1.25,
+        max_overlap: float = 0.8,
+    ) -> list[tuple[list[tuple[float, float]], float]]:
+        csr: CSRGraph = self.prepare_csr()
+        start_node, end_node = nearest_nodes(self.graph, [start, end])
+        if start_node == end_node:
+            warning(f"Path nodes are identical. {start_node}")
+            return []
+
+        try:
+            with stage("search"):
+                alternatives: list[tuple[list[int], float]] = csr.alternatives(
+                    csr.ids[start_node], csr.ids[end_node], k, stretch, max_overlap
+                )
+            # Searches may cross closed edges when there is no other way
+            if math.isinf(alternatives[0][1]):
+                raise Exception("Every path crosses a closed edge")
+        except:
+            message: str = (
+                f"Cannot find a path between {start} and {end}. Search nodes are {start_node} and {end_node}"
+            )
+            raise Exception(message)
+        return [([csr.nodes[i] for i in ids], cost) for ids, cost in alternatives]
+
+    # Get the shortest paths from one point to many, out of a single search tree
+    # Ends that snap to the start node, or that cannot be reached, get an empty path
+    def shortest_paths_from(
+        self, start: Location, ends: list[Location]
+    ) -> list[list[tuple[float, float]]]:
+        csr: CSRGraph = self.prepare_csr()
+        snapped: list[tuple[float, float]] = nearest_nodes(self.graph, [start, *ends])
+        source: int = csr.ids[snapped[0]]
+        targets: list[int] = [csr.ids[node] for node in snapped[1:]]
+
+        settled, predecessors = csr.search_tree(source, set(targets))
+        paths: list[list[tuple[float, float]]] = []
+        for target in targets:
+            if target == source or target not in settled:
+                paths.append([])
+                continue
+            ids: list[int] = csr.tree_path(predecessors, source, target)
+            paths.append([csr.nodes[i] for i in ids])
+
+        unreachable: int = sum(target not in settled for target in targets)
+        if unreachable > 0:
+            warning(f"{unreachable} of {len(ends)} ends cannot be reached from {start}")
+        return paths
+
+    # Get the edges that can be walked in full from a point, within a limit
+    # The limit is in metres, or in weighted cost if metres is False
+    # Each edge has a "reach" column, the cost or distance to its far end
+    def isochrone(
+        self, start: Location, limit: float, metres: bool = True
+    ) -> gpd.GeoDataFrame:
+        csr: CSRGraph = self.prepare_length_csr() if metres else self.prepare_csr()
+        source: int = csr.ids[nearest_node(self.graph, start)]
+        settled, _ = csr.search_tree(source, limit=limit)
+        return self.prepare_edge_table().within(settled, limit, metres)
+
+    # Compute the weight of every edge
+    # A vectorized weight function computes them all in one call on the edge columns
+    def _compute_edge_weights(self) -> dict[tuple, float]:
+        if is_vectorized(self.weight_function):
+            columns: EdgeColumns = edge_columns(self.graph)
+            weights: np.ndarray = np.asarray(
+                self.weight_function(columns), dtype=np.float64
+            )
+            return dict(zip(columns.edges, weights.tolist()))
+
+        # Edges of a compact graph have the attributes of those of a MultiGraph
+        edge_weights: dict[tuple, float] = {}
+        for u, v, key, data in self.graph.edges(keys=True, data=True):
+            edge_weights[(u, v, key)] = self.weight_function(
+                u, v, maxspeed=data["maxspeed"], fclass=data["fclass"]
+            )
+        return edge_weights
+
+    # Patch the prepared weights of edges in place, to their computed weight times
+    # the multipliers of the weight overrides of the graph that cover them
+    # The contraction hierarchy, and cached routes the change may affect, are
+    # discarded, the other prepared structures are patched
+    def apply_overrides(self, edges: Iterable[tuple]) -> None:
+        if not self.prepared:
+            # Overrides are applied when the weights are computed
+            return
+        overridden: bool = len(self.base_weights) > 0
+        changed, lowered = self._override_weights(edges)
+        if len(changed) == 0:
+            return
+
+        for u, v in {(u, v) for u, v, _ in changed}:
+            # Of parallel edges, only the cheapest is searched
+            weight: float = min(
+                self._edge_weight((u, v, key)) for key in edge_keys(self.graph, u, v)
+            )
+            if self.search_graph is not None:
+                self.search_graph[u][v]["weight"] = weight
+            if self.csr is not None:
+                self.csr.set_weight(self.csr.ids[u], self.csr.ids[v], weight)
+            # Closed edges cannot be walked by metres either
+            if self.length_csr is not None:
+                length: float = (
+                    math.inf
+                    if math.isinf(weight)
+                    else float(haversine(np.array(u), np.array(v)))
+                )
+                self.length_csr.set_weight(self.csr.ids[u], self.csr.ids[v], length)
+        if self.edge_table is not None:
+            self.edge_table.set_costs(
+                {edge: self.edge_weights[edge] for edge in changed}
+            )
+        self.contraction = None
+
+        if self.cache is None or self.version is None:
+            return
+        # Raised weights only change routes that cross the changed edges, or that
+        # start or end on them, so routes touching neither end are kept
+        # Any other change may give any route a cheaper way
+        version: str = f"{self.version}{overridden_suffix}"
+        if not overridden or lowered or len(self.base_weights) == 0:
+            self.cache.discard(version)
+        else:
+            ends: set[tuple[float, float]] = {
+                node for u, v, _ in changed for node in (u, v)
+            }
+            self.cache.discard(
+                version,
+                lambda key, path: len(path) <= 2 or not ends.isdisjoint(path),
+            )
+
+    # Set the weight of edges to their computed weight times the multipliers of
+    # the overrides covering them
+    # Returns the edges whose weight changed, and if any weight was lowered
+    def _override_weights(self, edges: Iterable[tuple]) -> tuple[set[tuple], bool]:
+        overrides: list[WeightOverride] = list(_overrides.get(self.graph, {}).values())
+        changed: set[tuple] = set()
+        lowered: bool = False
+        for u, v, key in edges:
+            edge: tuple = (
+                (u, v, key) if (u, v, key) in self.edge_weights else (v, u, key)
+            )
+            base: float = self.base_weights.get(edge, self.edge_weights[edge])
+            multiplier: float = math.prod(
+                override.multiplier for override in overrides if edge in override.edges
+            )
+            if multiplier == 1:
+                self.base_weights.pop(edge, None)
+            else:
+                self.base_weights[edge] = base
+            # Closed edges stay closed, even if their computed weight is 0
+            weight: float = math.inf if math.isinf(multiplier) else base * multiplier
+            if weight != self.edge_weights[edge]:
+                lowered = lowered or weight < self.edge_weights[edge]
+                self.edge_weights[edge] = weight
+                changed.add(edge)
+        return changed, lowered
+
+    # Compute the weight of every edge, unless known, and override them
+    def _prepare_weights(self) -> None:
+        if self.edge_weights is None:
+            with stage("weights"):
+                self.edge_weights = self._compute_edge_weights()
+        # Weights computed again are not overridden yet
+        self.base_weights = {}
+        self._override_weights(
+            edge
+            for override in _overrides.get(self.graph, {}).values()
+            for edge in override.edges
+        )
+        # Routes cached under overrides that may not be the ones applied now
+        if self.cache is not None and self.version is not None:
+            self.cache.discard(f"{self.version}{overridden_suffix}")
+
+    # Build the CSR arrays of the weighted edges, in the order of the networkx
+    # graph they would be added to
+    def _build_csr(self) -> CSRGraph:
+        nodes: list[tuple[float, float]] = list(self.graph.nodes())
+        ids: dict[tuple[float, float], int] = {node: i for i, node in enumerate(nodes)}
+        return CSRGraph.from_edges(
+            np.array(nodes, dtype=np.float64).reshape(-1, 2),
+            np.array([ids[u] for u, _, _ in self.edge_weights], dtype=np.int64),
+            np.array([ids[v] for _, v, _ in self.edge_weights], dtype=np.int64),
+            np.fromiter(
+                self.edge_weights.values(),
+                dtype=np.float64,
+                count=len(self.edge_weights),
+            ),
+        )
+
+    # Add the weighted edges to a networkx graph
+    def _build_search_graph(self) -> nx.Graph:
+        search_graph: nx.Graph = nx.Graph()
+        for (u, v, _), weight in self.edge_weights.items():
+            # Of parallel edges, only the cheapest can be on a shortest path
+            if search_graph.has_edge(u, v) and search_graph[u][v]["weight"] <= weight:
+                continue
+            search_graph.add_edge(u, v, weight=weight)
+        return search_graph
+
+
+# A temporary change to the weights of some (u, v, key) edges, each given both
+# ways round: their weights are multiplied by multiplier, or closed if it is
+# infinite, until time.time() passes expires, or until removed if it is None
+WeightOverride = namedtuple("WeightOverride", ["edges", "multiplier", "expires"])
+
+# Weight overrides of each graph, by id, shared by every router of the graph
+_overrides: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+# Ids of overrides, unique across graphs
+_override_ids = itertools.count(1)
+
+
+# Get the (u, v, key) edges of a graph that belong to OSM roads with some ids,
+# or that cross an area in longitude and latitude, such as a shapely box or polygon
+def select_edges(
+    graph: RoadGraph,
+    ids: Iterable[str] | None = None,
+    area: shapely.Geometry | None = None,
+) -> list[tuple]:
+    index: EdgeIndex = edge_index(graph)
+    positions: set[int] = set()
+    for osm_id in ids or []:
+        positions.update(index.ids.get(str(osm_id), []))
+    if area is not None:
+        positions.update(index.within(area))
+    return [index.edges[i] for i in sorted(positions)]
+
+
+# Multiply the weights of some (u, v, key) edges of a graph, for every router of
+# the graph, until the override is removed or until time.time() passes expires
+# Returns the id of the override, to remove it with `remove_override`
+def override_weights(
+    graph: RoadGraph,
+    edges: Iterable[tuple],
+    multiplier: float,
+    expires: float | None = None,
+) -> int:
+    if not multiplier > 0:
+        raise Exception(f"Weight multipliers must be positive, not {multiplier}")
+    edges = list(edges)
+    for u, v, key in edges:
+        if not graph.has_edge(u, v, key):
+            raise Exception(f"Graph has no edge {(u, v, key)}")
+    override_id: int = next(_override_ids)
+    _overrides.setdefault(graph, {})[override_id] = WeightOverride(
+        frozenset(edges + [(v, u, key) for u, v, key in edges]), multiplier, expires
+    )
+    for router in _routers.get(graph, {}).values():
+        router.apply_overrides(edges)
+    return override_id
+
+
+# Close some (u, v, key) edges of a graph, routes avoid them until the closure is
+# removed or until time.time() passes expires
+# Returns the id of the closure, to remove it with `remove_override`
+def close_edges(
+    graph: RoadGraph, edges: Iterable[tuple], expires: float | None = None
+) -> int:
+    return override_weights(graph, edges, math.inf, expires)
+
+
+# Remove a weight override or closure of a graph, restoring the weights it changed
+def remove_override(graph: RoadGraph, override_id: int) -> None:
+    override: WeightOverride | None = _overrides.get(graph, {}).pop(override_id, None)
+    if override is None:
+        raise Exception(f"Graph has no weight override {override_id}")
+    for router in _routers.get(graph, {}).values():
+        router.apply_overrides(override.edges)
+
+
+# Remove the overrides of a graph whose expiry time has passed
+# Returns how many were removed
+def expire_overrides(graph: RoadGraph, now: float | None = None) -> int:
+    overrides: dict[int, WeightOverride] | None = _overrides.get(graph)
+    if not overrides:
+        return 0
+    now = time.time() if now is None else now
+    expired: list[int] = [
+        override_id
+        for override_id, override in overrides.items()
+        if override.expires is not None and override.expires <= now
+    ]
+    for override_id in expired:
+        remove_override(graph, override_id)
+    return len(expired)
+
+
+# Keys of the edges between two nodes of a graph, whichever way round they are given
+def edge_keys(graph: RoadGraph, u: tuple[float, float], v: tuple[float, float]) -> list:
+    if isinstance(graph, CompactGraph):
+        return graph.edge_keys(u, v)
+    return list(graph[u][v])
+
+
+# Routers already prepared, per graph and then per weight function
+_routers: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+# Get the router for a graph and weight function, creating it on first use
+# Known edge weights, such as from a graph cache, save computing them again
+def prepare_router(
+    graph: RoadGraph,
+    weight_function: Callable[[tuple[float, float], tuple[float, float]], float],
+    weights: dict[tuple, float] | None = None,
+) -> Router:
+    routers: dict = _routers.setdefault(graph, {})
+    if weight_function not in routers:
+        routers[weight_function] = Router(graph, weight_function, weights)
+    return routers[weight_function]
+
+
+# Discard prepared weights, for one graph and/or weight function or for all of them
+def invalidate_routers(
+    graph: RoadGraph | None = None,
+    weight_function: (
+        Callable[[tuple[float, float], tuple[float, float]], float] | None
+    ) = None,
+) -> None:
+    graphs: list = list(_routers.keys()) if graph is None else [graph]
+    for g in graphs:
+        for function, router in _routers.get(g, {}).items():
+            if weight_function is None or function == weight_function:
+                router.invalidate()
 
 
 # Get the shortest path between two points in a graph
 def shortest_path(
-    graph: nx.multigraph.Graph,
+    graph: RoadGraph,
     start: Location,
     end: Location,
     weight_function: Callable[[tuple[float, float], tuple[float, float]], float],
+    engine: str = "networkx",
+    snap: str = "node",
 ) -> list[tuple[float, float]]:
-    # Compute the nearest nodes to the start and end points
-    start_node: tuple[float, float] = nearest_node(graph, start)
-    end_node: tuple[float, float] = nearest_node(graph, end)
-
-    if start_node == end_node:
-        # If the start and end nodes are the same, there is no path between
-        # Let the user off with a warning
-        warning(f"Path nodes are identical. {start_node}")
-        return []
-
-    # Compute distance weights to the search graph
-    search_graph: nx.Graph = nx.Graph()
-    graph_maxspeed = nx.get_edge_attributes(graph, "maxspeed")
-    graph_fclass = nx.get_edge_attributes(graph, "fclass")
-    for edge in graph.edges(keys=True):
-        u: tuple[float, float] = edge[0]
-        v: tuple[float, float] = edge[1]
-        maxspeed: float = graph_maxspeed[edge]
-        fclass: str = graph_fclass[edge]
-        weight = weight_function(u, v, maxspeed=maxspeed, fclass=fclass)
-        search_graph.add_edge(u, v, weight=weight)
-
-    # Throw an exception if the dijkstra path finding fails
-    try:
-        path: list[tuple[float, float]] = nx.dijkstra_path(
-            search_graph, start_node, end_node, weight="weight"
-        )
-        return path
-    except:
-        message: str = (
-            f"Cannot find a path between {start} and {end}. Search nodes are {start_node} and {end_node}"
-        )
-        raise Exception(message)
+    return prepare_router(graph, weight_function).shortest_path(
+        start, end, engine, snap
+    )
+
+
+# Get up to k short paths between two points in a graph that are not much alike,
+# with their costs, cheapest first
+def alternative_paths(
+    graph: RoadGraph,
+    start: Location,
+    end: Location,
+    weight_function: Callable[[tuple[float, float], tuple[float, float]], float],
+    k: int = 3,
+) -> list[tuple[list[tuple[float, float]], float]]:
+    return prepare_router(graph, weight_function).alternative_paths(start, end, k)
+
+
+# Get the shortest paths from one point to each of many points in a graph
+def shortest_paths_from(
+    graph: RoadGraph,
+    start: Location,
+    ends: list[Location],
+    weight_function: Callable[[tuple[float, float], tuple[float, float]], float],
+) -> list[list[tuple[float, float]]]:
+    return prepare_router(graph, weight_function).shortest_paths_from(start, ends)
+
+
+# Get the edges of a graph that can be walked from a point within a limit
+def isochrone(
+    graph: RoadGraph,
+    start: Location,
+    limit: float,
+    weight_function: Callable[[tuple[float, float], tuple[float, float]], float],
+    metres: bool = True,
+) -> gpd.GeoDataFrame:
+    return prepare_router(graph, weight_function).isochrone(start, limit, metres)
@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+import util
+from collections import Counter
+
+"""
+Opt-in timing and memory instrumentation of the stages of a run
+Each stage records wall time, CPU time and peak memory, reported to the terminal
+and written as a trace file that chrome://tracing or Perfetto can open
+Some stages, such as weights and search, can also be sampled by a profiler
+"""
+
+
+# Stages are only recorded once instrumentation is enabled
+_enabled = False
+
+# Stages that are sampled by the profiler, when sampling is enabled
+_sampled_stages = {"weights", "search"}
+_sampling = False
+
+# Seconds between profiler samples
+_sample_interval = 0.001
+
+# Finished stages, in the order they finished
+_records: list[dict] = []
+
+# Names of the stages running now, outermost first
+_running: list[str] = []
+
+# Samples of each sampled stage, as counts of call stacks
+_samples: dict[str, Counter] = {}
+
+# Time instrumentation was enabled, trace times are relative to it
+_origin: float = 0.0
+
+# Returned by `stage` while instrumentation is off, it does nothing
+_disabled = contextlib.nullcontext()
+
+
+# Start recording stages, and sample the weights and search stages if sample is True
+def enable_instrumentation(sample: bool = False) -> None:
+    global _enabled, _sampling, _origin
+    _enabled = True
+    _sampling = sample
+    _origin = time.perf_counter()
+    _records.clear()
+    _samples.clear()
+
+
+# Is instrumentation enabled
+def instrumentation_enabled() -> bool:
+    return _enabled
+
+
+# Record a stage of a run, for use in a with statement
+# Stages may be nested, a stage inside another counts towards both
+def stage(name: str) -> contextlib.AbstractContextManager:
+    if not _enabled:
+        return _disabled
+    return _Stage(name)
+
+
+# Print the time and memory of each stage, and the hottest sampled functions
+def report_stages() -> None:
+    if len(_records) == 0:
+        return
+    util.info("Stage                          wall s    cpu s  peak MB  +MB  calls")
+    for name, total in _totals().items():
+        util.info(
+            f"{'  ' * total['depth']}{name:<{30 - 2 * total['depth']}}"
+            f"{total['wall']:7.3f}  {total['cpu']:7.3f}  "
+            f"{total['peak_mb']:7.0f}  {total['grew_mb']:3.0f}  {total['calls']:5d}"
+        )
+    for name, stacks in _samples.items():
+        leaves: Counter = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total_samples: int = sum(leaves.values())
+        if total_samples == 0:
+            continue
+        util.info(f"Hottest functions of {name}, from {total_samples} samples:")
+        for function, count in leaves.most_common(5):
+            util.info(f"  {100 * count / total_samples:5.1f}%  {function}")
+
+
+# Write the recorded stages as a trace file, in the Chrome trace event format
+# Sampled call stacks are added as "samples", in the folded format of flame graphs
+def write_trace(path: str) -> None:
+    events: list[dict] = [
+        {
+            "name": record["name"],
+            "ph": "X",
+            "ts": record["start"] * 1e6,
+            "dur": record["wall"] * 1e6,
+            "pid": 0,
+            "tid": 0,
+            "args": {
+                "cpu_seconds": record["cpu"],
+                "peak_mb": record["peak_mb"],
+                "grew_mb": record["grew_mb"],
+            },
+        }
+        for record in _records
+    ]
+    trace: dict = {
+        "traceEvents": events,
+        "displayTimeUnit": "ms",
+        "stages": _totals(),
+        "samples": {
+            name: [f"{stack} {count}" for stack, count in stacks.most_common()]
+            for name, stacks in _samples.items()
+        },
+    }
+    with open(path, "w") as file:
+        json.dump(trace, file, indent=1)
+    util.info(f"Saved stage trace to {path}")
+
+
+# Times of the stages, summed over every call of each stage
+def _totals() -> dict[str, dict]:
+    totals: dict[str, dict] = {}
+    for record in sorted(_records, key=lambda record: record["start"]):
+        total: dict = totals.setdefault(
+            record["name"],
+            {
+                "depth": record["depth"],
+                "calls": 0,
+                "wall": 0.0,
+                "cpu": 0.0,
+                "peak_mb": 0.0,
+                "grew_mb": 0.0,
+            },
+        )
+        total["calls"] += 1
+        total["wall"] += record["wall"]
+        total["cpu"] += record["cpu"]
+        total["peak_mb"] = max(total["peak_mb"], record["peak_mb"])
+        total["grew_mb"] += record["grew_mb"]
+    return totals
+
+
+# Peak memory of this process in MB, 0 where it cannot be measured
+def _peak_mb() -> float:
+    peak: float | None = util.peak_memory_mb()
+    return 0.0 if peak is None else peak
+
+
+# A stage being recorded
+class _Stage:
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+        self.sampler: _Sampler | None = None
+
+    def __enter__(self) -> "_Stage":
+        # Nested sampled stages are part of the samples of the outer one
+        if _sampling and self.name in _sampled_stages:
+            if not any(name in _sampled_stages for name in _running):
+                self.sampler = _Sampler(_samples.setdefault(self.name, Counter()))
+                self.sampler.start()
+        self.depth: int = len(_running)
+        _running.append(self.name)
+        self.peak: float = _peak_mb()
+        self.cpu: float = time.process_time()
+        self.start: float = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception) -> None:
+        wall: float = time.perf_counter() - self.start
+        cpu: float = time.process_time() - self.cpu
+        _running.pop()
+        if self.sampler is not None:
+            self.sampler.stop()
+        peak: float = _peak_mb()
+        _records.append(
+            {
+                "name": self.name,
+                "depth": self.depth,
+                "start": self.start - _origin,
+                "wall": wall,
+                "cpu": cpu,
+                "peak_mb": peak,
+                # How much the stage raised the peak memory of the process
+                "grew_mb": peak - self.peak,
+            }
+        )
+
+
+# Samples the call stack of one thread at a fixed interval, from another thread
+class _Sampler:
+    def __init__(self, stacks: Counter) -> None:
+        self.stacks: Counter = stacks
+        self.thread_id: int = threading.get_ident()
+        self.stopped: threading.Event = threading.Event()
+        self.thread: threading.Thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        # The sampling thread needs the GIL to take a sample, so hand it over more
+        # often than every 5 ms, the default
+        self.switch_interval: float = sys.getswitchinterval()
+        sys.setswitchinterval(_sample_interval / 2)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+        sys.setswitchinterval(self.switch_interval)
+
+    def _run(self) -> None:
+        while not self.stopped.wait(_sample_interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack: list[str] = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            # A sample taken while the stage was stopping is of the profiler itself
+            if self.stopped.is_set():
+                break
+            # Outermost call first, as in the folded format of flame graphs
+            self.stacks[";".join(reversed(stack))] += 1
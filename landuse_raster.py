@@ -0,0 +1,219 @@
+import os
+import json
+import numpy as np
+import shapely
+
+"""
+Land use niceness as a raster, a fixed grid of scores over the land use layer
+Each cell holds the sum of the scores of the land use within the buffer radius of
+its centre, the same neighbourhood sum the polygon path finds around a point, so
+scoring a point is an array lookup
+The grid is built a block of rows at a time straight into its cached .npy file,
+so it never has to fit in memory, and is memory mapped, so processes reading it
+share its pages
+"""
+
+
+# Where the land use raster is cached
+_raster_cache_folder = "cache/landuse_raster"
+
+# Bytes of scores built at once, rasters are built a block of rows at a time
+_block_bytes = 32 * 2**20
+
+
+# Grid of land use niceness scores, rows run south to north and columns west to east
+class LandUseRaster:
+    def __init__(
+        self, scores: np.ndarray, west: float, south: float, cell: float
+    ) -> None:
+        # Score of the cell whose south west corner is
+        # (west + column * cell, south + row * cell) is scores[row, column]
+        self.scores: np.ndarray = scores
+        self.west: float = west
+        self.south: float = south
+        self.cell: float = cell
+
+    # Burn land use polygons into a raster with cells of a size in degrees
+    # A polygon adds its score to every cell whose centre is within radius of it,
+    # classes without a score add the default score
+    # Given a path, the scores are written to it as a .npy file and memory mapped,
+    # so a raster larger than memory can be built
+    @classmethod
+    def from_landuse(
+        cls,
+        geometries: np.ndarray,
+        classes: np.ndarray,
+        class_scores: dict[str, float],
+        radius: float,
+        cell: float,
+        default_score: float = 2,
+        path: str | None = None,
+    ) -> "LandUseRaster":
+        # A centre is within radius of a polygon when it is in the polygon grown by
+        # the radius, grown with the arcs the polygon path buffers points with
+        grown: np.ndarray = shapely.buffer(geometries, radius, quad_segs=16)
+        shapely.prepare(grown)
+        values: np.ndarray = np.array(
+            [class_scores.get(fclass, default_score) for fclass in classes],
+            dtype=np.float64,
+        )
+        tree: shapely.STRtree = shapely.STRtree(grown)
+        all_bounds: np.ndarray = shapely.bounds(grown)
+
+        # Beyond the grown bounds no land use is near, so scores are 0
+        if len(grown) == 0:
+            west, south, east, north = 0.0, 0.0, 0.0, 0.0
+        else:
+            west, south, east, north = shapely.total_bounds(grown).tolist()
+        columns: int = max(int(np.ceil((east - west) / cell)), 1)
+        rows: int = max(int(np.ceil((north - south) / cell)), 1)
+        xs: np.ndarray = west + (np.arange(columns) + 0.5) * cell
+        ys: np.ndarray = south + (np.arange(rows) + 0.5) * cell
+
+        scores: np.ndarray | None = None
+        file = None
+        if path is None:
+            scores = np.zeros((rows, columns), dtype=np.float32)
+        else:
+            file = open(path, "wb")
+            np.lib.format.write_array_header_1_0(
+                file,
+                {
+                    "descr": np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+                    "fortran_order": False,
+                    "shape": (rows, columns),
+                },
+            )
+
+        # Rows are built a block at a time, so only one block is ever in memory
+        # Each polygon only tests the centres within its own bounds, and is counted
+        # once per cell however much of the neighbourhood it covers
+        # Polygons are added in their order, so a cell sums the same either way
+        block_rows: int = max(_block_bytes // (columns * 4), 1)
+        buffer: np.ndarray = np.empty((min(block_rows, rows), columns), np.float32)
+        try:
+            for first in range(0, rows, block_rows):
+                last: int = min(first + block_rows, rows)
+                block: np.ndarray = buffer[: last - first]
+                block.fill(0)
+                nearby: np.ndarray = np.sort(
+                    tree.query(
+                        shapely.box(
+                            west, south + first * cell, east, south + last * cell
+                        )
+                    )
+                )
+                for i in nearby.tolist():
+                    polygon: shapely.Geometry = grown[i]
+                    if shapely.is_empty(polygon):
+                        continue
+                    bounds: np.ndarray = all_bounds[i]
+                    first_column, first_row = np.floor(
+                        (bounds[:2] - (west, south)) / cell
+                    ).astype(int)
+                    last_column, last_row = np.ceil(
+                        (bounds[2:] - (west, south)) / cell
+                    ).astype(int)
+                    first_row, last_row = max(first_row, first), min(last_row, last)
+                    if first_row >= last_row:
+                        continue
+                    window_xs, window_ys = np.meshgrid(
+                        xs[first_column:last_column], ys[first_row:last_row]
+                    )
+                    block[
+                        first_row - first : last_row - first, first_column:last_column
+                    ] += values[i] * shapely.intersects_xy(
+                        polygon, window_xs, window_ys
+                    )
+                if file is None:
+                    scores[first:last] = block
+                else:
+                    file.write(memoryview(block))
+        finally:
+            if file is not None:
+                file.close()
+
+        if path is not None:
+            scores = np.load(path, mmap_mode="r")
+        return cls(scores, west, south, cell)
+
+    # Score of each of an (n, 2) array of (longitude, latitude) positions
+    # Positions outside the raster have no land use near, so score 0
+    def lookup(self, positions: np.ndarray) -> np.ndarray:
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        columns: np.ndarray = np.floor(
+            (positions[:, 0] - self.west) / self.cell
+        ).astype(np.int64)
+        rows: np.ndarray = np.floor((positions[:, 1] - self.south) / self.cell).astype(
+            np.int64
+        )
+        inside: np.ndarray = (
+            (rows >= 0)
+            & (rows < self.scores.shape[0])
+            & (columns >= 0)
+            & (columns < self.scores.shape[1])
+        )
+        values: np.ndarray = np.zeros(len(positions), dtype=np.float64)
+        values[inside] = self.scores[rows[inside], columns[inside]]
+        return values
+
+    # Memory of the scores in bytes
+    def memory_bytes(self) -> int:
+        return self.scores.nbytes
+
+
+# Path to build a raster to cache at, passed as the path of `from_landuse`, so a
+# raster built there is moved into the cache instead of written again
+def raster_build_path(folder: str = _raster_cache_folder) -> str:
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, "scores.tmp.npy")
+
+
+# Write a raster to cache, tagged with the key of what it was built from
+def cache_raster(
+    raster: LandUseRaster, key: str, folder: str = _raster_cache_folder
+) -> None:
+    os.makedirs(folder, exist_ok=True)
+    # The index is written last, so scores without their index are never read
+    index_path: str = os.path.join(folder, "index.json")
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+    # Write to temporary files first, so a cache is never left half written
+    temporary_path: str = raster_build_path(folder)
+    built_at: str | None = getattr(raster.scores, "filename", None)
+    if built_at is None or os.path.abspath(built_at) != os.path.abspath(temporary_path):
+        np.save(temporary_path, raster.scores)
+    os.replace(temporary_path, os.path.join(folder, "scores.npy"))
+
+    index: dict = {
+        "key": key,
+        "west": raster.west,
+        "south": raster.south,
+        "cell": raster.cell,
+    }
+    temporary_path = os.path.join(folder, "index.tmp.json")
+    with open(temporary_path, "w") as file:
+        json.dump(index, file)
+    os.replace(temporary_path, index_path)
+
+
+# Read a raster from cache, memory mapping its scores
+# Returns None if there is no cache or it was built from other land use
+def read_raster_from_cache(
+    key: str, folder: str = _raster_cache_folder
+) -> LandUseRaster | None:
+    index_path: str = os.path.join(folder, "index.json")
+    scores_path: str = os.path.join(folder, "scores.npy")
+    if not os.path.exists(index_path) or not os.path.exists(scores_path):
+        return None
+    with open(index_path) as file:
+        index: dict = json.load(file)
+    if index["key"] != key:
+        return None
+    return LandUseRaster(
+        np.load(scores_path, mmap_mode="r"),
+        index["west"],
+        index["south"],
+        index["cell"],
+    )
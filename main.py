@@ -1,27 +1,54 @@
+from __future__ import annotations
+
 import sys
 import os
+import json
+import atexit
+import numpy as np
 import networkx as nx
-import geopandas as gpd
-import pandas as pd
-import matplotlib.pyplot as plt
+import shapely
 from collections import namedtuple
-from typing import Callable, List
+from typing import TYPE_CHECKING, Callable, List
 from util import *
 from cache_from_osm import cache_from_osm, cache_osm_exists, read_from_cache
+from cache_graph import cache_graph, graph_cache_key, read_graph_from_cache
+from compact import CompactGraph
+from tiles import cache_tiles, read_tile_layer, read_tiles, route_tiles, tiles_exist
+from landuse_raster import (
+    LandUseRaster,
+    cache_raster,
+    raster_build_path,
+    read_raster_from_cache,
+)
+from contraction import (
+    ContractionHierarchy,
+    cache_contraction,
+    read_contraction_from_cache,
+)
 from graph import *
-from gpxpy.gpx import GPX, GPXTrack, GPXTrackSegment, GPXTrackPoint
+from csr import haversine
+from batch import iter_shortest_paths, read_pairs_csv, shortest_paths
+from export import export_paths
+from render import draw_route_map, render_route_map
+from server import serve
+from route_cache import RouteCache
+from instrument import enable_instrumentation, report_stages, stage, write_trace
 from datetime import datetime
 from shapely.geometry import Point
 
+# matplotlib, GeoPandas, pandas and gpxpy add seconds to every run, so they are
+# imported where they are used, and a headless run never imports matplotlib
+if TYPE_CHECKING:
+    import geopandas as gpd
+    import pandas as pd
+    import matplotlib.pyplot as plt
+
 
 # useful for graphing
 # https://gis.stackexchange.com/questions/239633/how-to-convert-a-shapefile-into-a-graph-in-which-use-dijkstra
 # https://medium.com/analytics-vidhya/interative-map-with-osm-directions-and-networkx-582c4f3435bc
 
 
-pd.options.display.max_rows = 5000  # Max rows pandas will print in a DataFrame
-
-
 # Function to check if a point is within the specified geographic bounds
 def is_within_bounds(
     pos: tuple[float, float],
@@ -90,20 +117,21 @@ def get_landuse_negative() -> gpd.GeoDataFrame:
     return negative
 
 
-def walkable(roads: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    # Define a list of road classes considered walkable
-    walkable_classes = [
-        "footway",
-        "pedestrian",
-        "path",
-        "residential",
-        "living_street",
-        "unclassified",
-        "service",
-        "track",
-        "tertiary",
-    ]
+# Define a list of road classes considered walkable
+walkable_classes = [
+    "footway",
+    "pedestrian",
+    "path",
+    "residential",
+    "living_street",
+    "unclassified",
+    "service",
+    "track",
+    "tertiary",
+]
 
+
+def walkable(roads: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     # Create a boolean mask that identifies rows where the 'fclass' column matches any of the walkable classes
     walkable_criteria = roads["fclass"].isin(walkable_classes)
 
@@ -114,13 +142,19 @@ def walkable(roads: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
 
 
 def get_walkable_roads() -> gpd.GeoDataFrame:
-    raw_roads: gpd.GeoDataFrame = walkable(read_from_cache("roads"))
-
-    raw_graph: nx.Graph = gdf_to_graph(split_geometry(raw_roads))
-    raw_graph.remove_edges_from(nx.selfloop_edges(raw_graph))
-
-    graph = largest_component(raw_graph)
-    roads = graph_to_gdf(graph)
+    roads: gpd.GeoDataFrame = read_from_cache("roads")
+    with stage("walkable filtering"):
+        raw_roads: gpd.GeoDataFrame = walkable(roads)
+
+    with stage("geometry splitting"):
+        segments: gpd.GeoDataFrame = split_geometry(raw_roads)
+    with stage("graph construction"):
+        raw_graph: nx.Graph = gdf_to_graph(segments)
+        raw_graph.remove_edges_from(nx.selfloop_edges(raw_graph))
+
+    with stage("component extraction"):
+        graph = largest_component(raw_graph)
+        roads = graph_to_gdf(graph)
     return roads
 
 
@@ -155,6 +189,81 @@ land_use_niceness_scores = {
 }
 
 
+# Radius in degrees around a point to look for land use
+# May need to adjust buffer radius in degrees
+# 0.0001 degrees ≈ 10 m in Vancouver
+landuse_buffer_radius = 0.0003
+
+# Score land use from a precomputed raster instead of the polygons, set by "--raster"
+# Cells are landuse_raster_cell degrees wide, 0.00005 degrees ≈ 5 m in Vancouver,
+# so a point may be scored as if it were up to half a cell away
+use_landuse_raster = False
+landuse_raster_cell = 0.00005
+
+# Bump when `niceness` or the functions it uses change, so cached weights and
+# routes found with the old weights are not used
+niceness_version = 2
+
+# Where finished routes are kept between runs, and how much memory they may use
+route_cache_path = "cache/routes.json"
+route_cache_max_bytes = 64 * 2**20
+
+# Land use niceness of every graph node, filled in bulk by `score_landuse_niceness`
+node_niceness: dict[tuple[float, float], float] = {}
+
+# Land use of the zone, read from cache by `get_landuse` when first needed
+landuse: gpd.GeoDataFrame | None = None
+
+# Land use niceness raster, read from cache or built by `get_landuse_raster`
+landuse_raster: LandUseRaster | None = None
+
+
+# Get the land use of the zone, reading it from cache the first time
+# A run that loads a cached graph never needs it
+def get_landuse() -> gpd.GeoDataFrame:
+    global landuse
+    if landuse is None:
+        landuse = read_from_cache("landuse")
+    return landuse
+
+
+# Get the land use niceness raster, building and caching it the first time
+# A cached raster is memory mapped, and land use is only read to build one
+def get_landuse_raster() -> LandUseRaster:
+    global landuse_raster
+    if landuse_raster is None:
+        key: str = graph_cache_key(
+            ["landuse"],
+            [land_use_niceness_scores, landuse_buffer_radius, landuse_raster_cell],
+        )
+        landuse_raster = read_raster_from_cache(key)
+        if landuse_raster is None:
+            with stage("landuse raster build"):
+                landuse_raster = build_landuse_raster(
+                    get_landuse(), raster_build_path()
+                )
+            cache_raster(landuse_raster, key)
+            info(f"Cached land use raster of {landuse_raster.scores.shape} cells")
+    return landuse_raster
+
+
+# Burn land use into a raster of niceness scores, with the buffer radius folded in
+# Given a path, the scores are built into that file instead of memory
+def build_landuse_raster(
+    landuse: gpd.GeoDataFrame, path: str | None = None
+) -> LandUseRaster:
+    # Default score is 2 for unspecified land use types
+    return LandUseRaster.from_landuse(
+        landuse.geometry.to_numpy(),
+        landuse["fclass"].to_numpy(),
+        land_use_niceness_scores,
+        landuse_buffer_radius,
+        landuse_raster_cell,
+        default_score=2,
+        path=path,
+    )
+
+
 def point_niceness(pos: tuple[float, float]) -> float:
     """
     Computes the niceness of a position based on surrounding land use.
@@ -165,16 +274,19 @@ def point_niceness(pos: tuple[float, float]) -> float:
     Returns:
     - The niceness score for the position.
     """
-    point = Point(pos)
+    # Graph nodes are scored in bulk ahead of time, so look them up
+    if pos in node_niceness:
+        return node_niceness[pos]
 
-    # May need to adjust buffer radius in degrees
-    # 0.0001 degrees ≈ 10 m in Vancouver
-    buffer_radius = 0.0003
+    if use_landuse_raster:
+        return float(get_landuse_raster().lookup(np.array(pos))[0])
 
-    search_area = point.buffer(buffer_radius)
+    point = Point(pos)
+
+    search_area = point.buffer(landuse_buffer_radius)
 
     # Filter landuse GeoDataFrame for features within the search area
-    # Directly use the global landuse variable
+    landuse: gpd.GeoDataFrame = get_landuse()
     intersecting_landuse = landuse[landuse.intersects(search_area)]
 
     # Initialize the niceness score
@@ -190,74 +302,386 @@ def point_niceness(pos: tuple[float, float]) -> float:
     return niceness_score
 
 
-# Simple function to compute niceness based on the road
-def road_niceness(
-    u: tuple[float, float],
-    v: tuple[float, float],
-    maxspeed: int | None,
-    fclass: str | None,
-) -> float:
-    result = 0
-    if maxspeed is int:
-        result += max(maxspeed - 30, 0)
-    if fclass is str and fclass not in [
-        "pedestrian",
-        "living_street",
-        "unclassified",
-        "track",
-        "path",
-        "bridleway",
-        "cycleway",
-        "footway",
-        "steps",
-    ]:
-        result += 40
-
-    return result
-
-
-# Function weights the value of an edge
-def niceness(
-    u: tuple[float, float],
-    v: tuple[float, float],
-    maxspeed: float | None,
-    fclass: str | None,
-) -> float:
-    return length(u, v) * (
-        road_niceness(u, v, maxspeed=maxspeed, fclass=fclass)
-        + point_niceness(u)
-        + point_niceness(v)
+def score_landuse_niceness(
+    graph: nx.MultiGraph, landuse: gpd.GeoDataFrame
+) -> dict[tuple[float, float], float]:
+    """
+    Computes the land use niceness of every node of a graph in one pass.
+
+    The same score as `point_niceness`, but all nodes are buffered at once and
+    matched to land use with a spatial join on the landuse spatial index.
+    The scores are stored as the "niceness" node attribute.
+
+    Parameters:
+    - graph: The road graph, nodes are (longitude, latitude) tuples.
+    - landuse: The landuse GeoDataFrame.
+
+    Returns:
+    - A dictionary from node to niceness score.
+    """
+    import geopandas as gpd
+
+    nodes: list[tuple[float, float]] = list(graph.nodes())
+    search_areas = shapely.buffer(
+        shapely.points(nodes), landuse_buffer_radius, quad_segs=16
+    )
+    areas: gpd.GeoDataFrame = gpd.GeoDataFrame(geometry=search_areas, crs=landuse.crs)
+
+    # One row per intersecting (node, land use) pair
+    matches: gpd.GeoDataFrame = gpd.sjoin(
+        areas, landuse[["fclass", "geometry"]], how="inner", predicate="intersects"
+    )
+
+    # Default score is 2 for unspecified land use types
+    match_scores: pd.Series = matches["fclass"].map(land_use_niceness_scores).fillna(2)
+    scores: pd.Series = (
+        match_scores.groupby(level=0).sum().reindex(range(len(nodes)), fill_value=0)
+    )
+
+    niceness_scores: dict[tuple[float, float], float] = dict(
+        zip(nodes, scores.tolist())
+    )
+    nx.set_node_attributes(graph, niceness_scores, "niceness")
+    return niceness_scores
+
+
+# Land use niceness of every node of a graph from a raster, one array lookup
+# Stored as the "niceness" node attribute, as `score_landuse_niceness` does
+def score_raster_niceness(
+    graph: nx.MultiGraph, raster: LandUseRaster
+) -> dict[tuple[float, float], float]:
+    nodes: list[tuple[float, float]] = list(graph.nodes())
+    scores: np.ndarray = raster.lookup(np.array(nodes, dtype=np.float64))
+    niceness_scores: dict[tuple[float, float], float] = dict(
+        zip(nodes, scores.tolist())
+    )
+    nx.set_node_attributes(graph, niceness_scores, "niceness")
+    return niceness_scores
+
+
+# Land use niceness of every node of a graph, from the raster if it is used
+def score_node_niceness(graph: nx.MultiGraph) -> dict[tuple[float, float], float]:
+    if use_landuse_raster:
+        return score_raster_niceness(graph, get_landuse_raster())
+    return score_landuse_niceness(graph, get_landuse())
+
+
+# Road classes made for walking, other roads get the road niceness penalty
+pedestrian_classes = [
+    "pedestrian",
+    "living_street",
+    "unclassified",
+    "track",
+    "path",
+    "bridleway",
+    "cycleway",
+    "footway",
+    "steps",
+]
+
+# Road classes that carry through traffic, avoided by the "avoid-arterials" profile
+arterial_classes = [
+    "motorway",
+    "motorway_link",
+    "trunk",
+    "trunk_link",
+    "primary",
+    "primary_link",
+    "secondary",
+    "secondary_link",
+    "tertiary",
+    "tertiary_link",
+]
+
+# Roads with at least this speed limit are arterial whatever their class
+arterial_speed = 50
+
+# How many times longer an arterial road seems to the "avoid-arterials" profile
+arterial_penalty = 5
+
+
+# Niceness of roads based on their speed limit and class, for arrays of roads
+# Missing speed limits are NaN and missing classes are "", neither is penalized
+def road_niceness(maxspeed: np.ndarray, fclass: np.ndarray) -> np.ndarray:
+    speed: np.ndarray = np.maximum(np.nan_to_num(maxspeed) - 30, 0)
+    road_class: np.ndarray = np.where(
+        np.isin(fclass, pedestrian_classes) | (fclass == ""), 0, 40
+    )
+    return speed + road_class
+
+
+# Weight every edge by its length and how nice its road and land use are
+@vectorized
+def niceness(edges: EdgeColumns) -> np.ndarray:
+    u_niceness, v_niceness = edges.node_values(point_niceness)
+    return length(edges.u, edges.v) * (
+        road_niceness(edges.maxspeed, edges.fclass) + u_niceness + v_niceness
+    )
+
+
+# Weight every edge by its length in metres
+@vectorized
+def walking_distance(edges: EdgeColumns) -> np.ndarray:
+    return haversine(edges.u, edges.v)
+
+
+# Weight every edge by its length in metres, with arterial roads seeming longer
+@vectorized
+def avoid_arterials(edges: EdgeColumns) -> np.ndarray:
+    arterial: np.ndarray = np.isin(edges.fclass, arterial_classes) | (
+        edges.maxspeed >= arterial_speed
     )
+    return haversine(edges.u, edges.v) * np.where(arterial, arterial_penalty, 1)
+
+
+# Named weight profiles, each prepared as its own router over the same edges
+weight_profiles = {
+    "nicest": niceness,
+    "shortest": walking_distance,
+    "avoid-arterials": avoid_arterials,
+}
+
 
+# Length of edges in degrees, from arrays of their (longitude, latitude) ends
+def length(u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    difference: np.ndarray = np.asarray(u, dtype=float) - np.asarray(v, dtype=float)
+    return np.sqrt((difference**2).sum(axis=-1))
 
-# Length of an edge
-def length(u: tuple[float, float], v: tuple[float, float]) -> float:
-    dy: float = u[0] - v[0]
-    dx: float = u[1] - v[1]
-    distance: float = sqrt(dx**2 + dy**2)
-    return distance
+
+# Get the weight function of a named profile
+def weight_profile(profile: str) -> Callable:
+    if profile not in weight_profiles:
+        raise Exception(
+            f'Unknown profile "{profile}", choose one of {list(weight_profiles)}'
+        )
+    return weight_profiles[profile]
 
 
 def plan_route(
-    roads_graph: nx.MultiGraph, start: Location, end: Location
+    roads_graph: RoadGraph,
+    start: Location,
+    end: Location,
+    engine: str = "networkx",
+    profile: str = "nicest",
+    snap: str = "node",
 ) -> list[tuple[float, float]]:
     # Shortest path on weighted edges
     path_nodes: list[tuple[float, float]] = shortest_path(
-        roads_graph, start, end, niceness
+        roads_graph, start, end, weight_profile(profile), engine, snap
     )
     return path_nodes
 
 
+# Plan up to k routes that are not much alike, each with its cost, cheapest first
+def plan_alternative_routes(
+    roads_graph: RoadGraph,
+    start: Location,
+    end: Location,
+    k: int = 3,
+    profile: str = "nicest",
+) -> list[tuple[list[tuple[float, float]], float]]:
+    return alternative_paths(roads_graph, start, end, weight_profile(profile), k)
+
+
+# Plan the route of each (start, end) pair, spread over worker processes
+# Pairs without a route get an empty path
+def plan_routes(
+    roads_graph: RoadGraph,
+    pairs: list[tuple[Location, Location]],
+    engine: str = "dijkstra",
+    workers: int | None = None,
+    profile: str = "nicest",
+) -> list[list[tuple[float, float]]]:
+    router: Router = prepare_router(roads_graph, weight_profile(profile))
+    return shortest_paths(router, pairs, engine, workers)
+
+
+# Plan the route of each (start, end) pair and write them all to one file as they
+# are found, as GPX tracks or GeoJSON lines depending on the extension
+# Returns the number of routes written
+def export_routes(
+    roads_graph: RoadGraph,
+    pairs: list[tuple[Location, Location]],
+    file_path: str,
+    engine: str = "dijkstra",
+    workers: int | None = None,
+    profile: str = "nicest",
+) -> int:
+    router: Router = prepare_router(roads_graph, weight_profile(profile))
+    return export_paths(iter_shortest_paths(router, pairs, engine, workers), file_path)
+
+
+# Plan routes from one start to many ends, with a single search
+# Ends without a route get an empty path
+def plan_routes_from(
+    roads_graph: RoadGraph,
+    start: Location,
+    ends: list[Location],
+    profile: str = "nicest",
+) -> list[list[tuple[float, float]]]:
+    return shortest_paths_from(roads_graph, start, ends, weight_profile(profile))
+
+
+# Get the roads that can be walked from a start within a limit, as a GeoDataFrame
+# The limit is in metres, or in the weighted cost of the profile if metres is False
+def walking_isochrone(
+    roads_graph: RoadGraph,
+    start: Location,
+    limit: float,
+    metres: bool = True,
+    profile: str = "nicest",
+) -> gpd.GeoDataFrame:
+    return isochrone(roads_graph, start, limit, weight_profile(profile), metres)
+
+
 # Same as plan route, but returns a graph
 def plan_route_graph(
-    roads_graph: nx.MultiGraph, start: Location, end: Location
+    roads_graph: RoadGraph,
+    start: Location,
+    end: Location,
+    engine: str = "networkx",
+    profile: str = "nicest",
 ) -> nx.MultiGraph:
-    path_nodes: list[tuple[float, float]] = plan_route(roads_graph, start, end)
-    path_graph: nx.MultiGraph = roads_graph.subgraph(path_nodes)
+    path_nodes: list[tuple[float, float]] = plan_route(
+        roads_graph, start, end, engine, profile
+    )
+    path_graph: nx.MultiGraph = road_multigraph(roads_graph).subgraph(path_nodes)
 
     return path_graph
 
 
+# Get the routable road graph, with land use scored and niceness weights prepared
+# The graph is compiled to the graph cache, and read from it on later runs as the
+# compact graph, which is routed on without building the MultiGraph
+def get_routable_graph() -> RoadGraph:
+    global node_niceness
+
+    key: str = routable_graph_key()
+    with stage("graph cache load"):
+        cached: tuple[CompactGraph, dict[tuple, float]] | None = read_graph_from_cache(
+            key
+        )
+    if cached is not None:
+        graph, weights = cached
+        node_niceness = graph.node_attributes("niceness")
+        prepare_router(graph, niceness, weights)
+        use_route_cache(graph, key)
+        return graph
+
+    roads: gpd.GeoDataFrame = get_walkable_roads()
+    with stage("graph construction"):
+        graph: nx.MultiGraph = gdf_to_graph(roads)
+
+    # Score land use around every node up front, so routing only looks scores up
+    with stage("landuse scoring"):
+        node_niceness = score_node_niceness(graph)
+
+    router: Router = prepare_router(graph, niceness)
+    router.prepare()
+    # Reading the layers may have migrated them, so key the cache as they are now
+    key = routable_graph_key()
+    with stage("graph cache write"):
+        cache_graph(graph, key, router.edge_weights)
+    info(f"Cached graph of {len(graph)} nodes and {graph.number_of_edges()} edges")
+    use_route_cache(graph, key)
+    return graph
+
+
+# Cache the finished routes of the router of every weight profile in one cache,
+# tagged with the key of their graph and the name of their profile
+# Routes cached by earlier runs are read from disk
+def use_route_cache(graph: RoadGraph, key: str) -> None:
+    cache: RouteCache = RouteCache(route_cache_max_bytes, path=route_cache_path)
+    for profile, weight_function in weight_profiles.items():
+        router: Router = prepare_router(graph, weight_function)
+        router.version = f"{key}:{profile}"
+        router.cache = cache
+
+
+# Get the contraction hierarchy of the routable graph, for the "contraction" engine
+# It is cached next to the graph, and read from cache on later runs
+# The cache holds the hierarchy of one profile, other profiles replace it
+def get_contraction_hierarchy(
+    graph: RoadGraph, profile: str = "nicest"
+) -> ContractionHierarchy:
+    router: Router = prepare_router(graph, weight_profile(profile))
+    key: str = f"{routable_graph_key()}:{profile}"
+
+    hierarchy: ContractionHierarchy | None = read_contraction_from_cache(key)
+    # A hierarchy of a different graph, such as of the whole zone for a tiled graph
+    if hierarchy is not None and len(hierarchy) != len(router.prepare_csr()):
+        hierarchy = None
+
+    if hierarchy is None:
+        info("Building contraction hierarchy")
+        hierarchy = router.prepare_contraction()
+        cache_contraction(hierarchy, key)
+        info(f"Cached contraction hierarchy of {len(hierarchy)} nodes")
+
+    router.contraction = hierarchy
+    return hierarchy
+
+
+# The road graph as a MultiGraph, built from a graph read from cache only when
+# something needs every road with its attributes, such as plotting them
+def road_multigraph(graph: RoadGraph) -> nx.MultiGraph:
+    if isinstance(graph, CompactGraph):
+        return graph.to_graph()
+    return graph
+
+
+# Key of the graph cache, anything the graph or its weights are derived from is part of it
+def routable_graph_key() -> str:
+    config: list = [
+        walkable_classes,
+        land_use_niceness_scores,
+        landuse_buffer_radius,
+        niceness_version,
+    ]
+    # Raster scores differ a little from polygon scores, so are cached apart
+    if use_landuse_raster:
+        config.append(("raster", landuse_raster_cell))
+    return graph_cache_key(["roads", "landuse"], config)
+
+
+# Get the routable road graph of only the tiles around a route
+# Builds the tiled cache from the cached layers if needed
+def get_tiled_graph(start: Location, end: Location) -> nx.MultiGraph:
+    key: str = routable_graph_key()
+    if not tiles_exist(key):
+        cache_tiles(
+            split_geometry(walkable(read_from_cache("roads"))),
+            {"landuse": get_landuse()},
+            build_graph_fragment,
+            key,
+        )
+
+    fragments, weights = read_tiles(route_tiles(start, end), key)
+    graph: nx.MultiGraph = largest_component(fragments).copy()
+    node_niceness.update(nx.get_node_attributes(graph, "niceness"))
+
+    # Keep the weights of edges in the component
+    component_weights: dict[tuple, float] = {
+        edge: weight for edge, weight in weights.items() if edge[0] in graph
+    }
+    prepare_router(graph, niceness, component_weights)
+    return graph
+
+
+# Build the graph fragment of one tile, with land use scored and niceness weights
+def build_graph_fragment(
+    segments: gpd.GeoDataFrame,
+) -> tuple[nx.MultiGraph, dict[tuple, float]]:
+    fragment: nx.MultiGraph = gdf_to_graph(segments)
+    fragment.remove_edges_from(nx.selfloop_edges(fragment))
+
+    node_niceness.update(score_node_niceness(fragment))
+
+    router: Router = Router(fragment, niceness)
+    router.prepare()
+    return fragment, router.edge_weights
+
+
 def save_paths_as_gpx(
     paths: list[list[tuple[float, float]]],
     directory: str = "./",
@@ -272,6 +696,8 @@ def save_paths_as_gpx(
 
     Example usage: save_paths_as_gpx(paths, directory="path_to_directory", file_prefix="my_walk")
     """
+    from gpxpy.gpx import GPX, GPXTrack, GPXTrackSegment, GPXTrackPoint
+
     # Ensure the directory exists
     if not os.path.exists(directory):
         os.makedirs(directory)
@@ -307,19 +733,62 @@ def save_paths_as_gpx(
         info(f"Saved GPX data to {file_path}")
 
 
+# Save a path to a file, as GPX or as a GeoJSON feature depending on its extension
+def save_path(path: list[tuple[float, float]], file_path: str) -> None:
+    extension: str = os.path.splitext(file_path)[1].lower()
+    if extension not in (".gpx", ".geojson", ".json"):
+        raise Exception(
+            f'Unknown output format "{extension}", choose .gpx, .geojson or .json'
+        )
+
+    directory: str = os.path.dirname(file_path)
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+
+    if extension == ".gpx":
+        from gpxpy.gpx import GPX, GPXTrack, GPXTrackSegment, GPXTrackPoint
+
+        gpx = GPX()
+        gpx_track = GPXTrack()
+        gpx.tracks.append(gpx_track)
+        gpx_segment = GPXTrackSegment()
+        gpx_track.segments.append(gpx_segment)
+        for lon, lat in path:
+            gpx_segment.points.append(GPXTrackPoint(lat, lon))
+        text: str = gpx.to_xml()
+    else:
+        coordinates: np.ndarray = np.array(path).reshape(-1, 2)
+        feature: dict = {
+            "type": "Feature",
+            "geometry": {"type": "LineString", "coordinates": path},
+            "properties": {
+                "length": float(haversine(coordinates[:-1], coordinates[1:]).sum())
+            },
+        }
+        text = json.dumps(feature)
+
+    with open(file_path, "w") as file:
+        file.write(text)
+    info(f"Saved route to {file_path}")
+
+
 # Main function and entry point of program execution
 if __name__ == "__main__":
+    # Options start with "--", all other arguments are positional
+    args: list[str] = [arg for arg in sys.argv if not arg.startswith("--")]
+    options: list[str] = [arg for arg in sys.argv if arg.startswith("--")]
+
     # Check if the user has provided the minimum required argument (the path to OSM data)
-    if len(sys.argv) < 2:
+    if len(args) < 2:
         info(
             "You need to provide the path to the OSM data as an argument to run the project."
         )
-        info()
+        print()
         info("Correct formats for running the project are:")
         info("1) Default mode (using predefined locations for start and end points):")
         info("   python3 main.py <path-to-osm-unzipped>")
         info("   Example: python3 main.py ./british-columbia-latest-free.shp")
-        info()
+        print()
         info("2) Custom mode (specifying start and end points):")
         info(
             "   python3 main.py <path-to-osm-unzipped> <start_lon> <start_lat> <end_lon> <end_lat>"
@@ -327,29 +796,65 @@ if __name__ == "__main__":
         info(
             "   Example: python3 main.py ./british-columbia-latest-free.shp -123.1423 49.2871 -123.1217 49.2744"
         )
-        info()
+        print()
         info(
             "Please replace <path-to-osm-unzipped> with the actual path to your OSM data,"
         )
         info(
             "and <start_lon>, <start_lat>, <end_lon>, <end_lat> with your desired coordinates."
         )
+        print()
+        info("Options:")
+        info("   --tiled   Load only the cached tiles around the route")
+        info(f"   --engine=<name>   Search engine, one of {engines}")
+        info("   --pairs=<csv>   Route every start_lon,start_lat,end_lon,end_lat row")
+        info(
+            "   --workers=<n>   Worker processes for --pairs and --serve, default one per CPU"
+        )
+        info(
+            "   --isochrone=<metres>   Save the roads within walking distance of start"
+        )
+        info("   --alternatives=<k>   Save up to k routes that are not much alike")
+        info("   --profile[=<json>]   Report the time and memory of each stage")
+        info("   --sample   With --profile, sample the weights and search stages")
+        info(f"   --weights=<profile>   Weight profile, one of {list(weight_profiles)}")
+        info(
+            f"   --snap=<how>   Snap the start and end to the nearest {' or '.join(snaps)}"
+        )
+        info(f"   With --snap=edge, --engine is one of {edge_engines}")
+        info("   --no-plot   Skip plotting, for headless runs")
+        info(
+            "   --map=<path>   Draw the route, or the alternatives, to this .png or .svg file"
+        )
+        info(
+            "   --raster[=<degrees>]   Score land use from a cached raster with cells this wide"
+        )
+        info(
+            "   --output=<path>   Save the route, or the isochrone, to this .gpx or .geojson file"
+        )
+        info(
+            "   With --pairs or --alternatives, --output=<path> is one .gpx or .geojsonl file of every route"
+        )
         sys.exit(1)
 
     # Extract the path to OSM data from command-line arguments
-    path_to_osm: str = sys.argv[1]
+    path_to_osm: str = args[1]
 
-    # If there is no cache of location-limited files then create one
-    if not cache_osm_exists():
-        cache_from_osm(path_to_osm)
+    # Values of "--name=value" options
+    values: dict[str, str] = dict(
+        option.removeprefix("--").split("=", 1) for option in options if "=" in option
+    )
 
-    # Global declaration of the landuse GeoDataFrame
-    global landuse
-    # Load landuse data for route analysis in `point_niceness` function
-    landuse: gpd.GeoDataFrame = read_from_cache("landuse")
+    # Report the time and memory of each stage when the run ends, however it ends
+    if "--profile" in options or "profile" in values:
+        enable_instrumentation(sample="--sample" in options)
+        trace_path: str = values.get("profile", "profile.json")
+        atexit.register(lambda: (report_stages(), write_trace(trace_path)))
 
-    roads: gpd.GeoDataFrame = get_walkable_roads()
-    graph: nx.MultiGraph = gdf_to_graph(roads)
+    # If there is no cache of location-limited files then create one
+    if not cache_osm_exists():
+        with stage("cache build"):
+            cache_from_osm(path_to_osm)
 
     # Default coordinates for English Bay and YaleTown Roundhouse
     default_start: Location = Location(-123.1423, 49.2871)  # English Bay
@@ -366,11 +871,11 @@ if __name__ == "__main__":
     end: Location = default_end
 
     # Check user provided custom start and end points
-    if len(sys.argv) == 6:
+    if len(args) == 6:
         try:
             # Attempt to parse the custom coordinates
-            start = (float(sys.argv[2]), float(sys.argv[3]))
-            end = (float(sys.argv[4]), float(sys.argv[5]))
+            start = (float(args[2]), float(args[3]))
+            end = (float(args[4]), float(args[5]))
 
             # Validate the provided coordinates
             if not is_within_bounds(start) or not is_within_bounds(end):
@@ -381,19 +886,154 @@ if __name__ == "__main__":
             warning("Invalid coordinates format. Using default locations.")
             start, end = default_start, default_end
 
+    # Score land use from the raster, with cells of the "--raster=<degrees>" size
+    if "--raster" in options or "raster" in values:
+        use_landuse_raster = True
+        landuse_raster_cell = float(values.get("raster", landuse_raster_cell))
+
+    # Weight profile from the "--weights=<profile>" option
+    profile: str = values.get("weights", "nicest")
+    weight_function: Callable = weight_profile(profile)
+
+    # Server mode, keep the graph loaded and answer requests until interrupted
+    if "--serve" in options:
+        graph: RoadGraph = get_routable_graph()
+        engine: str = values.get("engine", "dijkstra")
+        if engine == "contraction":
+            get_contraction_hierarchy(graph, profile)
+        workers: int | None = int(values["workers"]) if "workers" in values else None
+        serve(
+            prepare_router(graph, weight_function),
+            engine,
+            port=int(values.get("port", 8080)),
+            workers=workers,
+        )
+        sys.exit(0)
+
+    # Batch mode, route every pair of a CSV file and write them all to one file
+    if "pairs" in values:
+        graph: RoadGraph = get_routable_graph()
+        engine: str = values.get("engine", "dijkstra")
+        if engine == "contraction":
+            get_contraction_hierarchy(graph, profile)
+        workers: int | None = int(values["workers"]) if "workers" in values else None
+        pairs: list[tuple[Location, Location]] = read_pairs_csv(values["pairs"])
+        export_routes(
+            graph,
+            pairs,
+            values.get("output", "routes.gpx"),
+            engine,
+            workers,
+            profile,
+        )
+        sys.exit(0)
+
+    # Plot the roads and the result, unless running headless with "--no-plot"
+    plot: bool = "--no-plot" not in options
+
+    # Isochrone mode, save the roads within walking distance of the start as GeoJSON
+    if "isochrone" in values:
+        graph: RoadGraph = get_routable_graph()
+        limit: float = float(values["isochrone"])
+        reachable: gpd.GeoDataFrame = walking_isochrone(
+            graph, start, limit, profile=profile
+        )
+        output: str = values.get("output", "isochrone.geojson")
+        reachable.to_file(output, driver="GeoJSON")
+        info(f"Saved {len(reachable)} roads within {limit:g} m to {output}")
+
+        if plot:
+            import matplotlib.pyplot as plt
+
+            roads_plot: plt.Axes = graph_to_gdf(road_multigraph(graph)).plot(
+                color="lightgrey"
+            )
+            reachable.plot(ax=roads_plot, column="reach", legend=True)
+            plt.show()
+        sys.exit(0)
+
+    # Alternatives mode, save up to k routes that are not much alike to one file
+    if "alternatives" in values:
+        graph: RoadGraph = get_routable_graph()
+        with stage("route"):
+            alternatives: list[tuple[list[tuple[float, float]], float]] = (
+                plan_alternative_routes(
+                    graph, start, end, int(values["alternatives"]), profile
+                )
+            )
+        for i, (path, cost) in enumerate(alternatives):
+            coordinates: np.ndarray = np.array(path)
+            length: float = float(haversine(coordinates[:-1], coordinates[1:]).sum())
+            info(f"Route {i}: cost {cost:.1f}, {length:.0f} m")
+        export_paths(
+            (path for path, _ in alternatives),
+            values.get("output", "alternatives.gpx"),
+        )
+
+        paths: list[list[tuple[float, float]]] = [path for path, _ in alternatives]
+        if "map" in values and len(paths) > 0:
+            render_route_map(values["map"], graph, paths, get_landuse())
+        if plot and len(paths) > 0:
+            import matplotlib.pyplot as plt
+
+            draw_route_map(plt.figure(), graph, paths, get_landuse())
+            plt.show()
+        sys.exit(0)
+
     info(f"Using start point: {start} and end point: {end}")
 
+    if "--tiled" in options:
+        with stage("tile load"):
+            graph: RoadGraph = get_tiled_graph(start, end)
+    else:
+        graph: RoadGraph = get_routable_graph()
+
+    # Search engine from the "--engine=<name>" option
+    # networkx cannot snap onto edges, so edge snapping defaults to dijkstra
+    snap: str = values.get("snap", "node")
+    engine: str = values.get("engine", "dijkstra" if snap == "edge" else "networkx")
+
+    if engine == "contraction" and "--tiled" not in options:
+        with stage("contraction hierarchy"):
+            get_contraction_hierarchy(graph, profile)
+
     # Path from start to end
-    path: list[tuple[float, float]] = plan_route(graph, start, end)
-    path_graph: nx.MultiGraph = graph.subgraph(path)
-    save_paths_as_gpx([path])
+    with stage("route"):
+        path: list[tuple[float, float]] = plan_route(
+            graph, start, end, engine, profile, snap
+        )
+
+    # Keep finished routes for later runs
+    route_cache: RouteCache | None = prepare_router(graph, weight_function).cache
+    if route_cache is not None:
+        route_cache.save()
+        info(f"Route cache: {route_cache.stats()}")
+
+    # Save to the "--output=<path>" file, or to a new GPX file named by the time
+    with stage("route writing"):
+        if "output" in values:
+            save_path(path, values["output"])
+        else:
+            save_paths_as_gpx([path])
+
+    if "map" not in values and not plot:
+        sys.exit(0)
+
+    if "--tiled" in options:
+        landuse = read_tile_layer(route_tiles(start, end), "landuse")
+    else:
+        landuse = get_landuse()
+
+    # Draw only the roads and land use around the path, to the "--map=<path>" file
+    if "map" in values:
+        with stage("rendering"):
+            render_route_map(values["map"], graph, [path], landuse)
 
-    # Plot path and roads, with roads in the background
-    roads_plot: tuple[plt.Figure, plt.Axes] = roads.plot()
+    if not plot:
+        sys.exit(0)
 
-    path_gdf: nx.MultiGraph = graph_to_gdf(path_graph)
-    path_plot: tuple[plt.Figure, plt.Axes] = path_gdf.plot(ax=roads_plot, color="red")
+    import matplotlib.pyplot as plt
 
-    # Plot landuse over top of roads and the path
-    landuse.plot(ax=path_plot, color="green")
+    with stage("plotting"):
+        draw_route_map(plt.figure(), graph, [path], landuse)
     plt.show()
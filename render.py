@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import os
+import time
+import numpy as np
+import shapely
+import util
+from typing import TYPE_CHECKING
+from graph import EdgeIndex, RoadGraph, edge_index
+
+# matplotlib is imported where it is drawn with, and pyplot never, so rendering
+# needs no display
+if TYPE_CHECKING:
+    import geopandas as gpd
+    from matplotlib.figure import Figure
+    from matplotlib.path import Path
+
+"""
+Draw maps of routes, the roads and the land use around them
+Only what is within the bounds of the routes plus a margin is drawn, geometries
+are simplified to the size of a pixel and those smaller than a pixel dropped, and
+each layer is drawn as one compound path, so the time to draw depends on the size
+of the map and not of the zone
+Maps are written as PNG or SVG files without a display
+"""
+
+
+# File extensions maps can be written to
+_map_extensions = [".png", ".svg"]
+
+# Margin around the routes, as a share of the larger side of their bounds, and at
+# least this many degrees so short routes still show the streets around them
+_margin_share = 0.1
+_minimum_margin = 0.002
+
+# Colours of each layer, routes after the first take the next colour
+_road_colour = "#b0b0b0"
+_landuse_colour = "#7fbf7f"
+_route_colours = ["red", "blue", "darkorange", "purple", "teal"]
+
+
+# Draw routes onto a figure, with the roads of a graph and land use around them
+# Bounds are (west, south, east, north), by default the routes plus a margin
+# The figure is sized so the longer side of the bounds is size pixels
+# Returns how many roads, land use areas and routes were drawn
+def draw_route_map(
+    figure: Figure,
+    graph: RoadGraph,
+    paths: list[list[tuple[float, float]]],
+    landuse: gpd.GeoDataFrame | None = None,
+    bounds: tuple[float, float, float, float] | None = None,
+    size: int = 1600,
+) -> dict[str, int]:
+    from matplotlib.collections import LineCollection, PathCollection
+
+    paths = [path for path in paths if len(path) > 0]
+    if bounds is None:
+        bounds = route_bounds(paths)
+    index: EdgeIndex = edge_index(graph)
+
+    # Draw with longitudes scaled as in the edge index, so the map is not stretched
+    area: shapely.Geometry = shapely.box(*bounds)
+    scaled: np.ndarray = np.array(bounds, dtype=float).reshape(2, 2) * index.scale
+    west, south, east, north = scaled.ravel().tolist()
+    pixel: float = max(east - west, north - south, 1e-12) / size
+
+    figure.set_size_inches(
+        max(east - west, pixel) / pixel / figure.dpi,
+        max(north - south, pixel) / pixel / figure.dpi,
+    )
+    axes = figure.add_axes((0, 0, 1, 1))
+    axes.set_axis_off()
+    axes.set_xlim(west, east)
+    axes.set_ylim(south, north)
+    axes.set_aspect("equal")
+
+    counts: dict[str, int] = {"roads": 0, "landuse": 0, "routes": len(paths)}
+
+    # Geometries are clipped a pixel wider than the map, so no edge is drawn at it
+    clip: tuple = (west - pixel, south - pixel, east + pixel, north + pixel)
+
+    if landuse is not None and len(landuse) > 0:
+        polygons: np.ndarray = landuse.geometry.values[landuse.sindex.query(area)]
+        polygons = shapely.transform(
+            np.asarray(polygons, dtype=object),
+            lambda coordinates: coordinates * index.scale,
+        )
+        polygons = _simplify(shapely.clip_by_rect(polygons, *clip), pixel)
+        polygons = polygons[shapely.area(polygons) >= pixel * pixel]
+        # The limits are already set, working them out from a large path is slow
+        axes.add_collection(
+            PathCollection(
+                [_polygons_path(polygons)],
+                facecolors=_landuse_colour,
+                edgecolors="none",
+                zorder=1,
+            ),
+            autolim=False,
+        )
+        counts["landuse"] = len(polygons)
+
+    lines: np.ndarray = _simplify(
+        shapely.clip_by_rect(index.lines[index.within(area)], *clip), pixel
+    )
+    roads, counts["roads"] = _lines_path(lines, pixel)
+    axes.add_collection(
+        PathCollection(
+            [roads],
+            facecolors="none",
+            edgecolors=_road_colour,
+            linewidths=0.6,
+            zorder=2,
+        ),
+        autolim=False,
+    )
+
+    axes.add_collection(
+        LineCollection(
+            [np.asarray(path, dtype=float) * index.scale for path in paths],
+            colors=[_route_colours[i % len(_route_colours)] for i in range(len(paths))],
+            linewidths=2.5,
+            zorder=3,
+        ),
+        autolim=False,
+    )
+    return counts
+
+
+# Draw routes onto a new figure and write it to a .png or .svg file, without a display
+# Returns how many roads, land use areas and routes were drawn
+def render_route_map(
+    file_path: str,
+    graph: RoadGraph,
+    paths: list[list[tuple[float, float]]],
+    landuse: gpd.GeoDataFrame | None = None,
+    bounds: tuple[float, float, float, float] | None = None,
+    size: int = 1600,
+) -> dict[str, int]:
+    from matplotlib.figure import Figure
+
+    extension: str = os.path.splitext(file_path)[1].lower()
+    if extension not in _map_extensions:
+        raise Exception(
+            f'Unknown map format "{extension}", choose one of {_map_extensions}'
+        )
+    directory: str = os.path.dirname(file_path)
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+
+    start: float = time.perf_counter()
+    # A figure made without pyplot draws with the Agg or SVG canvas, never a window
+    figure: Figure = Figure(dpi=100)
+    counts: dict[str, int] = draw_route_map(figure, graph, paths, landuse, bounds, size)
+    # Compressing a PNG takes longer than drawing it, so it is compressed lightly
+    # Only the PNG canvas takes PIL options, the SVG canvas rejects them
+    options: dict[str, object] = {}
+    if extension == ".png":
+        options["pil_kwargs"] = {"compress_level": 1}
+    figure.savefig(file_path, **options)
+    util.info(
+        f"Rendered {counts['roads']} roads, {counts['landuse']} land use areas and "
+        f"{counts['routes']} routes to {file_path} in {time.perf_counter() - start:.2f} s"
+    )
+    return counts
+
+
+# Bounds of routes as (west, south, east, north), plus a margin on every side
+def route_bounds(
+    paths: list[list[tuple[float, float]]],
+) -> tuple[float, float, float, float]:
+    coordinates: np.ndarray = np.concatenate(
+        [np.asarray(path, dtype=float).reshape(-1, 2) for path in paths]
+    )
+    west, south = coordinates.min(axis=0).tolist()
+    east, north = coordinates.max(axis=0).tolist()
+    margin: float = max(
+        _margin_share * max(east - west, north - south), _minimum_margin
+    )
+    return west - margin, south - margin, east + margin, north + margin
+
+
+# Simplify geometries to within a pixel, those with only two points, such as road
+# segments, cannot be simplified so are left as they are
+def _simplify(geometries: np.ndarray, pixel: float) -> np.ndarray:
+    geometries = geometries.copy()
+    many: np.ndarray = shapely.get_num_coordinates(geometries) > 2
+    geometries[many] = shapely.simplify(
+        geometries[many], pixel, preserve_topology=False
+    )
+    return geometries
+
+
+# Every line of lines and multi lines as one path, and how many lines are in it
+# Points are snapped to the centres of pixels and repeats dropped, lines within one
+# pixel are left out, so a road split into many short segments is still drawn
+def _lines_path(lines: np.ndarray, pixel: float) -> tuple[Path, int]:
+    from matplotlib.path import Path
+
+    parts: np.ndarray = shapely.get_parts(lines)
+    coordinates, line = shapely.get_coordinates(parts, return_index=True)
+    coordinates = np.round(coordinates / pixel) * pixel
+    starts: np.ndarray = np.ones(len(coordinates), dtype=bool)
+    starts[1:] = line[1:] != line[:-1]
+    kept: np.ndarray = starts.copy()
+    kept[1:] |= np.any(coordinates[1:] != coordinates[:-1], axis=1)
+
+    # A line is drawn if any of its points moved off the pixel it starts on
+    coordinates, line, starts = coordinates[kept], line[kept], starts[kept]
+    drawn: np.ndarray = np.zeros(len(coordinates), dtype=bool)
+    drawn[:-1] = ~starts[1:]
+    drawn[1:] |= ~starts[1:]
+    coordinates, starts = coordinates[drawn], starts[drawn]
+
+    codes: np.ndarray = np.where(starts, Path.MOVETO, Path.LINETO).astype(
+        Path.code_type
+    )
+    return Path(coordinates.reshape(-1, 2), codes), int(starts.sum())
+
+
+# Every polygon of polygons and multi polygons as one path, holes included
+# Normalized polygons have clockwise shells and anticlockwise holes, so with the
+# non-zero fill rule holes stay empty and overlapping polygons stay filled
+def _polygons_path(polygons: np.ndarray) -> Path:
+    from matplotlib.path import Path
+
+    parts: np.ndarray = shapely.normalize(shapely.get_parts(polygons))
+    parts = parts[shapely.get_type_id(parts) == shapely.GeometryType.POLYGON]
+    rings: np.ndarray = shapely.get_rings(parts)
+    coordinates: np.ndarray = shapely.get_coordinates(rings)
+    counts: np.ndarray = shapely.get_num_coordinates(rings)
+    ends: np.ndarray = np.cumsum(counts)
+    codes: np.ndarray = np.full(len(coordinates), Path.LINETO, dtype=Path.code_type)
+    codes[ends - counts] = Path.MOVETO
+    codes[ends - 1] = Path.CLOSEPOLY
+    return Path(coordinates.reshape(-1, 2), codes)
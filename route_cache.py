@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import util
+from collections import OrderedDict
+from typing import Callable
+
+"""
+Cache of finished routes, so repeated queries skip the search
+Routes are keyed by their snapped end nodes, the engine, and a version tag of the
+graph and weights they were found on
+The least recently used routes are evicted once the cache is full
+"""
+
+
+# Bump when the file layout changes, so old files are ignored
+_route_cache_version = 1
+
+# Key of a route: version tag, engine, start node and end node
+RouteKey = tuple[str, str, tuple[float, float], tuple[float, float]]
+
+# Version tags of routes found while weights are overridden end with this
+# Overrides do not outlive a run, so these routes are never written to disk
+overridden_suffix = ":overridden"
+
+
+# Bounded least recently used cache of routes, optionally kept on disk between runs
+class RouteCache:
+    def __init__(
+        self,
+        max_bytes: int = 64 * 2**20,
+        max_entries: int | None = None,
+        path: str | None = None,
+    ) -> None:
+        # Routes are evicted once either limit is passed
+        self.max_bytes: int = max_bytes
+        self.max_entries: int | None = max_entries
+        self.path: str | None = path
+
+        # Least recently used first
+        self.entries: OrderedDict[RouteKey, list[tuple[float, float]]] = OrderedDict()
+        self.sizes: dict[RouteKey, int] = {}
+        self.bytes: int = 0
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+        if path is not None and os.path.exists(path):
+            self._read(path)
+
+    # Number of cached routes
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    # Get a cached route, or None if it is not cached
+    def get(self, key: RouteKey) -> list[tuple[float, float]] | None:
+        path: list[tuple[float, float]] | None = self.entries.get(key)
+        if path is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return path
+
+    # Cache a route, evicting the least recently used routes if the cache is full
+    def put(self, key: RouteKey, path: list[tuple[float, float]]) -> None:
+        size: int = _path_size(path)
+        # A route larger than the whole cache is not worth evicting everything for
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.bytes -= self.sizes[key]
+        self.entries[key] = path
+        self.entries.move_to_end(key)
+        self.sizes[key] = size
+        self.bytes += size
+
+        while self.bytes > self.max_bytes or (
+            self.max_entries is not None and len(self.entries) > self.max_entries
+        ):
+            oldest, _ = self.entries.popitem(last=False)
+            self.bytes -= self.sizes.pop(oldest)
+            self.evictions += 1
+
+    # Forget the routes of a version tag, such as after its weights change
+    # With affected, only the routes it is True for are forgotten
+    def discard(
+        self,
+        version: str,
+        affected: Callable[[RouteKey, list[tuple[float, float]]], bool] | None = None,
+    ) -> None:
+        for key in [
+            key
+            for key, path in self.entries.items()
+            if key[0] == version and (affected is None or affected(key, path))
+        ]:
+            del self.entries[key]
+            self.bytes -= self.sizes.pop(key)
+
+    # Forget every route
+    def clear(self) -> None:
+        self.entries.clear()
+        self.sizes.clear()
+        self.bytes = 0
+
+    # Counters of the cache, for reporting
+    def stats(self) -> dict[str, int | float]:
+        lookups: int = self.hits + self.misses
+        return {
+            "routes": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+    # Write the cached routes to disk, in least recently used order
+    # Routes found while weights were overridden are left out
+    def save(self, path: str | None = None) -> None:
+        path = self.path if path is None else path
+        if path is None:
+            raise Exception("The route cache has no path to save to")
+
+        data: dict = {
+            "version": _route_cache_version,
+            "routes": [
+                [tag, engine, start, end, route]
+                for (tag, engine, start, end), route in self.entries.items()
+                if not tag.endswith(overridden_suffix)
+            ],
+        }
+        directory: str = os.path.dirname(path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+
+        # Write to a temporary file first, so a cache is never left half written
+        temporary_path: str = f"{path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(data, file)
+        os.replace(temporary_path, path)
+
+    # Read routes saved by `save`, keeping the limits of this cache
+    def _read(self, path: str) -> None:
+        try:
+            with open(path) as file:
+                data: dict = json.load(file)
+        except (OSError, ValueError):
+            util.warning(f"Route cache '{path}' cannot be read, starting empty")
+            return
+        if data.get("version") != _route_cache_version:
+            return
+        for tag, engine, start, end, route in data["routes"]:
+            # Files written before overridden routes were left out may hold some
+            if tag.endswith(overridden_suffix):
+                continue
+            self.put(
+                (tag, engine, tuple(start), tuple(end)), [tuple(node) for node in route]
+            )
+
+
+# Approximate memory of a route, a list of (longitude, latitude) tuples
+def _path_size(path: list[tuple[float, float]]) -> int:
+    node_size: int = sys.getsizeof((0.0, 0.0)) + 2 * sys.getsizeof(0.0)
+    return sys.getsizeof(path) + len(path) * node_size
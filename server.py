@@ -0,0 +1,489 @@
+import os
+import math
+import asyncio
+import json
+import signal
+import time
+import tempfile
+import numpy as np
+import util
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+from csr import CSRGraph, haversine
+from contraction import ContractionHierarchy
+from route_cache import RouteCache, RouteKey
+from graph import Location, Router, nearest_node, nearest_nodes
+from batch import (
+    load_shared_search,
+    worker_reach,
+    worker_route,
+    worker_tree_route,
+    write_search,
+)
+
+"""
+Local HTTP routing service
+The graph is loaded and prepared once, then route, snap and isochrone requests
+are answered as GeoJSON or GPX
+Searches run in worker processes that memory map the prepared arrays, so the
+event loop only parses requests and formats responses
+A contraction hierarchy out of date after weights change is rebuilt in a process
+of its own, routes are found with Dijkstra's until the rebuilt one is in place
+"""
+
+
+# Latencies kept per endpoint for /stats, older ones are dropped
+_latency_window = 1000
+
+# Reason phrases of the status codes the server answers with
+_reasons = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
+
+
+# Answers HTTP requests with a prepared router
+class RoutingServer:
+    def __init__(
+        self, router: Router, engine: str = "dijkstra", workers: int | None = None
+    ) -> None:
+        self.router: Router = router
+        self.engine: str = engine
+        self.workers: int | None = workers
+        router.prepare_edge_table()
+
+        self.folder: tempfile.TemporaryDirectory | None = None
+        self.executor: ProcessPoolExecutor | None = None
+        # Rebuild of the contraction hierarchy running, if any
+        self.rebuild: asyncio.Task | None = None
+        self._share()
+
+        self.latencies: dict[str, deque[float]] = {}
+        self.endpoints = {
+            "/route": self._route,
+            "/snap": self._snap,
+            "/isochrone": self._isochrone,
+            "/stats": self._stats,
+        }
+
+    # Answer one HTTP request on a connection, then close it
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        start: float = time.perf_counter()
+        path: str = ""
+        try:
+            request_line: str = (await reader.readline()).decode("latin-1")
+            # Headers are read and ignored, requests have no body
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts: list[str] = request_line.split()
+            if len(parts) < 2:
+                status, content_type, body = 400, *_error("Malformed request")
+            else:
+                url = urlsplit(parts[1])
+                path = url.path
+                query: dict[str, str] = {
+                    name: values[-1] for name, values in parse_qs(url.query).items()
+                }
+                if path not in self.endpoints:
+                    status, content_type, body = 404, *_error(f"No endpoint {path}")
+                elif parts[0] != "GET":
+                    status, content_type, body = 405, *_error("Only GET is allowed")
+                else:
+                    status, content_type, body = await self._answer(path, query)
+
+            writer.write(
+                (
+                    f"HTTP/1.1 {status} {_reasons[status]}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    "Connection: close\r\n\r\n"
+                ).encode("latin-1")
+                + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            if path in self.endpoints:
+                window: deque[float] = self.latencies.setdefault(
+                    path, deque(maxlen=_latency_window)
+                )
+                window.append(time.perf_counter() - start)
+
+    # Write the prepared arrays for the workers and start them, then stop the
+    # workers started before
+    def _share(self) -> None:
+        router: Router = self.router
+        csr: CSRGraph = router.prepare_csr()
+        length_csr: CSRGraph = router.prepare_length_csr()
+        hierarchy: ContractionHierarchy | None = (
+            router.prepare_contraction() if self.engine == "contraction" else None
+        )
+        edits: tuple[int, int] = (csr.edits, length_csr.edits)
+        folder, executor = self._start(csr, length_csr, hierarchy)
+        previous = self._swap(folder, executor, csr, length_csr, hierarchy, edits)
+        if previous is not None:
+            _stop(*previous)
+
+    # Write arrays for the workers to a new folder and start workers mapping it
+    # The router is not read, so this can run in a thread while the workers
+    # started before keep serving
+    def _start(
+        self,
+        csr: CSRGraph,
+        length_csr: CSRGraph,
+        hierarchy: ContractionHierarchy | None,
+    ) -> tuple[tempfile.TemporaryDirectory, ProcessPoolExecutor]:
+        folder: tempfile.TemporaryDirectory = tempfile.TemporaryDirectory(
+            prefix="server_"
+        )
+        write_search(folder.name, self.engine, csr, length_csr, hierarchy)
+        executor: ProcessPoolExecutor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_load_worker,
+            initargs=(folder.name, self.engine),
+        )
+        # Start the workers now, so the first request does not wait for them
+        executor.submit(worker_route, 0, 0).result()
+        return folder, executor
+
+    # Serve with workers started by `_start` on the given structures, whose
+    # weights were written at the given edits
+    # Returns the folder and workers serving before, to be stopped with `_stop`
+    def _swap(
+        self,
+        folder: tempfile.TemporaryDirectory,
+        executor: ProcessPoolExecutor,
+        csr: CSRGraph,
+        length_csr: CSRGraph,
+        hierarchy: ContractionHierarchy | None,
+        edits: tuple[int, int],
+    ) -> tuple[tempfile.TemporaryDirectory, ProcessPoolExecutor] | None:
+        previous = None if self.executor is None else (self.folder, self.executor)
+        self.folder, self.executor = folder, executor
+
+        # Routes use the ids of the engine, search trees the ids of the CSR arrays
+        self.tree_ids: dict[tuple[float, float], int] = csr.ids
+        self.route_ids: dict[tuple[float, float], int] = (
+            csr.ids if hierarchy is None else hierarchy.ids
+        )
+        self.nodes: list[tuple[float, float]] = (
+            csr.nodes if hierarchy is None else hierarchy.nodes
+        )
+
+        # The arrays and edits shared, weights changed in place since are written
+        # into the mapped files, which workers read without copying
+        self.csr: CSRGraph = csr
+        self.length_csr: CSRGraph = length_csr
+        self.edits: tuple[int, int] = edits
+        # Edits of the weights the shared contraction hierarchy was built from
+        self.contracted: int = edits[0]
+        self.weights: np.ndarray = self._writable("weights")
+        self.lengths: np.ndarray = self._writable("lengths")
+        self.landmarks: np.ndarray | None = (
+            csr.landmark_distances() if self.engine == "astar" else None
+        )
+        return previous
+
+    # A shared array, mapped so writes to it reach the workers
+    def _writable(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self.folder.name, f"{name}.npy"), mmap_mode="r+")
+
+    # Bring the workers up to date with the weights of the router, before a search
+    # Expired weight overrides are removed first, then changed weights are written
+    # into the files the workers map
+    # A rebuilt graph or A* landmarks are out of date as a whole, so the arrays are
+    # shared again and the workers restarted
+    # A contraction hierarchy is rebuilt apart from the event loop, see
+    # `_rebuild_contraction`
+    def _sync(self) -> None:
+        self.router.prepare()
+        csr: CSRGraph = self.router.prepare_csr()
+        length_csr: CSRGraph = self.router.prepare_length_csr()
+        if (
+            csr is self.csr
+            and length_csr is self.length_csr
+            and (csr.edits, length_csr.edits) == self.edits
+        ):
+            return
+        if (
+            csr is not self.csr
+            or length_csr is not self.length_csr
+            or (
+                self.engine == "astar"
+                and csr.landmark_distances() is not self.landmarks
+            )
+        ):
+            util.info("Weights changed, restarting the search workers")
+            self._share()
+            return
+        self.weights[:] = csr.weights
+        self.lengths[:] = length_csr.weights
+        self.edits = (csr.edits, length_csr.edits)
+        if self.engine == "contraction" and (
+            self.rebuild is None or self.rebuild.done()
+        ):
+            self.rebuild = asyncio.get_running_loop().create_task(
+                self._rebuild_contraction()
+            )
+
+    # Whether the shared contraction hierarchy was built from older weights
+    def _stale_hierarchy(self) -> bool:
+        return self.engine == "contraction" and self.contracted != self.csr.edits
+
+    # Rebuild the contraction hierarchy in a process of its own, then start workers
+    # on it in a thread and swap them in, so requests are answered meanwhile
+    # Weights changed during a rebuild make it start over
+    async def _rebuild_contraction(self) -> None:
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        try:
+            while self._stale_hierarchy():
+                util.info("Weights changed, rebuilding the contraction hierarchy")
+                csr: CSRGraph = self.csr
+                built: int = csr.edits
+                with ProcessPoolExecutor(max_workers=1) as builder:
+                    hierarchy: ContractionHierarchy = await loop.run_in_executor(
+                        builder,
+                        _build_hierarchy,
+                        csr.coordinates,
+                        csr.indptr,
+                        csr.indices,
+                        csr.weights.copy(),
+                        csr.heuristic_scale,
+                    )
+                if csr is not self.csr or csr.edits != built:
+                    continue
+                if self.router.csr is csr and self.router.contraction is None:
+                    self.router.contraction = hierarchy
+
+                # Weights changed while the workers start are written by `_sync`
+                length_csr: CSRGraph = self.length_csr
+                edits: tuple[int, int] = (csr.edits, length_csr.edits)
+                folder, executor = await loop.run_in_executor(
+                    None, self._start, csr, length_csr, hierarchy
+                )
+                if csr is not self.csr:
+                    _stop(folder, executor)
+                    continue
+                previous = self._swap(
+                    folder, executor, csr, length_csr, hierarchy, edits
+                )
+                await loop.run_in_executor(None, _stop, *previous)
+        except Exception as error:
+            util.warning(f"Rebuilding the contraction hierarchy failed: {error}")
+
+    # Stop the worker processes and remove the shared arrays
+    # Cached routes are saved, if the route cache has a path
+    def close(self) -> None:
+        _stop(self.folder, self.executor)
+        if self.router.cache is not None and self.router.cache.path is not None:
+            self.router.cache.save()
+
+    # Answer a request to an endpoint, as a status, content type and body
+    async def _answer(self, path: str, query: dict[str, str]) -> tuple[int, str, bytes]:
+        try:
+            content_type, body = await self.endpoints[path](query)
+            return 200, content_type, body
+        except LookupError as error:
+            return 404, *_error(str(error))
+        except ValueError as error:
+            return 400, *_error(str(error))
+        except Exception as error:
+            util.warning(f"Request to {path} failed: {error}")
+            return 500, *_error("Internal error")
+
+    # GET /route?start=<lon>,<lat>&end=<lon>,<lat>&format=geojson|gpx
+    async def _route(self, query: dict[str, str]) -> tuple[str, bytes]:
+        output: str = query.get("format", "geojson")
+        if output not in ("geojson", "gpx"):
+            raise ValueError(f'Unknown format "{output}", choose geojson or gpx')
+
+        start: Location = _location(query, "start")
+        end: Location = _location(query, "end")
+        self._sync()
+        start_node, end_node = nearest_nodes(self.router.graph, [start, end])
+
+        # Finished routes are cached by the router, if it has a route cache, apart
+        # from those found while weights are overridden
+        cache: RouteCache | None = self.router.cache
+        version: str | None = self.router.route_version()
+        key: RouteKey | None = None
+        path: list[tuple[float, float]] | None = None
+        if cache is not None and version is not None:
+            key = (version, self.engine, start_node, end_node)
+            path = cache.get(key)
+
+        if path is None:
+            # Until a rebuilt contraction hierarchy is in place, routes are found
+            # with Dijkstra's over the weights the workers already map
+            stale: bool = self._stale_hierarchy()
+            ids_of: dict[tuple[float, float], int] = (
+                self.tree_ids if stale else self.route_ids
+            )
+            nodes: list[tuple[float, float]] = self.csr.nodes if stale else self.nodes
+            ids: list[int] = await asyncio.get_running_loop().run_in_executor(
+                self.executor,
+                worker_tree_route if stale else worker_route,
+                ids_of[start_node],
+                ids_of[end_node],
+            )
+            path = [nodes[i] for i in ids]
+            # Searches may cross closed edges when there is no other way
+            if len(ids) == 0 or math.isinf(
+                self.csr.path_weight([self.tree_ids[node] for node in path])
+            ):
+                raise LookupError(f"No path between {tuple(start)} and {tuple(end)}")
+            # Weights changed during the search are not those of the key
+            if key is not None and self.router.route_version() == version:
+                cache.put(key, path)
+
+        if output == "gpx":
+            return "application/gpx+xml", _gpx(path).encode()
+        coordinates: np.ndarray = np.array(path)
+        feature: dict = {
+            "type": "Feature",
+            "geometry": {"type": "LineString", "coordinates": path},
+            "properties": {
+                "engine": self.engine,
+                "length": float(haversine(coordinates[:-1], coordinates[1:]).sum()),
+            },
+        }
+        return "application/geo+json", json.dumps(feature).encode()
+
+    # GET /snap?point=<lon>,<lat>
+    async def _snap(self, query: dict[str, str]) -> tuple[str, bytes]:
+        point: Location = _location(query, "point")
+        node: tuple[float, float] = nearest_node(self.router.graph, point)
+        distance: float = float(haversine(np.array(point), np.array(node)))
+        feature: dict = {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": node},
+            "properties": {"distance": distance},
+        }
+        return "application/geo+json", json.dumps(feature).encode()
+
+    # GET /isochrone?start=<lon>,<lat>&limit=<number>&by=metres|cost
+    async def _isochrone(self, query: dict[str, str]) -> tuple[str, bytes]:
+        by: str = query.get("by", "metres")
+        if by not in ("metres", "cost"):
+            raise ValueError(f'Unknown measure "{by}", choose metres or cost')
+        if "limit" not in query:
+            raise ValueError('Missing parameter "limit"')
+        limit: float = float(query["limit"])
+
+        start: Location = _location(query, "start")
+        self._sync()
+        source: int = self.tree_ids[nearest_node(self.router.graph, start)]
+        settled: dict[int, float] = await asyncio.get_running_loop().run_in_executor(
+            self.executor, worker_reach, source, limit, by == "metres"
+        )
+        isochrone = self.router.prepare_edge_table().within(
+            settled, limit, by == "metres"
+        )
+        return "application/geo+json", isochrone.to_json().encode()
+
+    # GET /stats, count and latency percentiles in milliseconds per endpoint,
+    # and the counters of the route cache
+    async def _stats(self, query: dict[str, str]) -> tuple[str, bytes]:
+        stats: dict[str, dict] = {}
+        for path, window in self.latencies.items():
+            milliseconds: np.ndarray = np.array(window) * 1000
+            p50, p90, p99 = np.percentile(milliseconds, [50, 90, 99]).tolist()
+            stats[path] = {
+                "count": len(milliseconds),
+                "p50": p50,
+                "p90": p90,
+                "p99": p99,
+                "max": float(milliseconds.max()),
+            }
+        if self.router.cache is not None:
+            stats["cache"] = self.router.cache.stats()
+        return "application/json", json.dumps(stats).encode()
+
+
+# Serve routing requests on a local port until interrupted
+def serve(
+    router: Router,
+    engine: str = "dijkstra",
+    host: str = "127.0.0.1",
+    port: int = 8080,
+    workers: int | None = None,
+) -> None:
+    server: RoutingServer = RoutingServer(router, engine, workers)
+
+    async def run() -> None:
+        listener = await asyncio.start_server(server.handle, host, port)
+        util.info(f"Serving routes on http://{host}:{port}")
+        async with listener:
+            await listener.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        util.info("Stopped serving routes")
+    finally:
+        server.close()
+
+
+# Stop workers once their searches are done, then remove the files they map
+def _stop(folder: tempfile.TemporaryDirectory, executor: ProcessPoolExecutor) -> None:
+    executor.shutdown()
+    folder.cleanup()
+
+
+# Build a contraction hierarchy from CSR arrays, in a process of its own
+def _build_hierarchy(
+    coordinates: np.ndarray,
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    weights: np.ndarray,
+    heuristic_scale: float,
+) -> ContractionHierarchy:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    return ContractionHierarchy.build(
+        CSRGraph(coordinates, indptr, indices, weights, heuristic_scale=heuristic_scale)
+    )
+
+
+# Set up a worker process, interrupts are left to the server to handle
+def _load_worker(folder: str, engine: str) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    load_shared_search(folder, engine)
+
+
+# Read a "<lon>,<lat>" query parameter
+def _location(query: dict[str, str], name: str) -> Location:
+    if name not in query:
+        raise ValueError(f'Missing parameter "{name}"')
+    try:
+        lon, lat = map(float, query[name].split(","))
+    except ValueError:
+        raise ValueError(f'Parameter "{name}" must be "<lon>,<lat>"')
+    return Location(lon, lat)
+
+
+# A JSON error message, as a content type and body
+def _error(message: str) -> tuple[str, bytes]:
+    return "application/json", json.dumps({"error": message}).encode()
+
+
+# A path as the text of a GPX file with one track
+def _gpx(path: list[tuple[float, float]]) -> str:
+    from gpxpy.gpx import GPX, GPXTrack, GPXTrackSegment, GPXTrackPoint
+
+    gpx = GPX()
+    gpx_track = GPXTrack()
+    gpx.tracks.append(gpx_track)
+    gpx_segment = GPXTrackSegment()
+    gpx_track.segments.append(gpx_segment)
+    for lon, lat in path:
+        gpx_segment.points.append(GPXTrackPoint(lat, lon))
+    return gpx.to_xml()
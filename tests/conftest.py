@@ -0,0 +1,49 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# The planner's modules sit at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from benchmark import synthetic_landuse, synthetic_roads
+from csr import CSRGraph
+from graph import largest_component, prepare_router
+from util import gdf_to_graph, split_geometry
+
+"""
+Shared fixtures: the benchmark's synthetic grids, weighted as the planner weights
+the cached zone
+"""
+
+
+# Profiles the engines are checked with, "nicest" has edges that cost nothing
+_profiles = ["nicest", "shortest"]
+
+
+# A benchmark grid, its graph, its search arrays for each profile, and random node
+# pairs
+@pytest.fixture(scope="session", params=[10, 30])
+def grid(request: pytest.FixtureRequest) -> dict:
+    size: int = request.param
+    graph = largest_component(gdf_to_graph(split_geometry(synthetic_roads(size))))
+    graph = graph.copy()
+    main.landuse = synthetic_landuse(size)
+    main.node_niceness = main.score_landuse_niceness(graph, main.landuse)
+
+    searches: dict[str, CSRGraph] = {
+        profile: prepare_router(graph, main.weight_profiles[profile]).prepare_csr()
+        for profile in _profiles
+    }
+    rng: np.random.Generator = np.random.default_rng(size)
+    pairs: list[tuple[int, int]] = [
+        (int(source), int(target))
+        for source, target in rng.integers(len(graph), size=(25, 2))
+    ]
+    return {"size": size, "graph": graph, "searches": searches, "pairs": pairs}
+
+
+# A copy of search arrays with weights of their own, to close edges on
+def copy_search(csr: CSRGraph) -> CSRGraph:
+    return csr.with_weights(csr.weights.copy())
@@ -0,0 +1,57 @@
+import pytest
+from csr import CSRGraph, haversine
+
+"""
+Alternative routes start with the shortest route, never visit a node twice, cost
+at most the stretch times the shortest, and share at most max_overlap of their
+length with any route before them
+"""
+
+
+# Length in metres of each edge of a path, each edge once whichever way round
+def _edge_lengths(csr: CSRGraph, path: list[int]) -> dict[tuple[int, int], float]:
+    edges: list[tuple[int, int]] = list(
+        {(min(u, v), max(u, v)) for u, v in zip(path, path[1:])}
+    )
+    lengths = haversine(
+        csr.coordinates[[u for u, _ in edges]], csr.coordinates[[v for _, v in edges]]
+    )
+    return dict(zip(edges, lengths.tolist()))
+
+
+@pytest.mark.parametrize("profile", ["nicest", "shortest"])
+@pytest.mark.parametrize("stretch, max_overlap", [(1.25, 0.8), (1.5, 0.5)])
+def test_alternatives(
+    grid: dict, profile: str, stretch: float, max_overlap: float
+) -> None:
+    csr: CSRGraph = grid["searches"][profile]
+    found: int = 0
+    for source, target in grid["pairs"]:
+        if source == target:
+            continue
+        shortest: list[int] = csr.dijkstra(source, target)
+        best: float = csr.path_weight(shortest)
+        paths = csr.alternatives(source, target, 3, stretch, max_overlap)
+        assert 1 <= len(paths) <= 3
+
+        # The first is the shortest path
+        assert paths[0][0] == shortest
+        assert paths[0][1] == pytest.approx(best, rel=1e-9, abs=1e-12)
+
+        taken: list[dict[tuple[int, int], float]] = []
+        for path, cost in paths:
+            assert path[0] == source and path[-1] == target
+            assert len(set(path)) == len(path)
+            assert cost == pytest.approx(csr.path_weight(path), rel=1e-9, abs=1e-12)
+            assert cost <= stretch * best + 1e-9 * max(best, 1.0)
+
+            lengths: dict[tuple[int, int], float] = _edge_lengths(csr, path)
+            length: float = sum(lengths.values())
+            for before in taken:
+                shared: float = sum(lengths[edge] for edge in lengths if edge in before)
+                assert shared <= max_overlap * length + 1e-9
+            taken.append(lengths)
+        found += len(paths) - 1
+
+    # Some pairs have alternatives, or the checks above check little
+    assert found > 0
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+import shapely
+import main
+from cache_graph import cache_graph, read_graph_from_cache
+from compact import CompactGraph
+from csr import haversine
+from graph import Location, close_edges, prepare_router, remove_override, select_edges
+
+"""
+A graph read from the graph cache is routed on as the compact graph, without
+building its MultiGraph, and gives the routes the MultiGraph gives
+"""
+
+
+# Engines and snapping checked on the compact graph
+_routes = [("networkx", "node"), ("dijkstra", "node"), ("dijkstra", "edge")]
+
+
+# Write the grid to the graph cache and read it back, with the routers of both
+def _cached(grid: dict, profile: str, path: str) -> tuple:
+    weight_function = main.weight_profiles[profile]
+    router = prepare_router(grid["graph"], weight_function)
+    cache_graph(grid["graph"], "test", router.prepare(), path)
+    compact, weights = read_graph_from_cache("test", path)
+    assert isinstance(compact, CompactGraph)
+    return router, prepare_router(compact, weight_function, weights)
+
+
+# Points part way between the nodes of each pair, so edge snapping has work to do
+def _points(grid: dict) -> list[tuple[Location, Location]]:
+    nodes: list[tuple[float, float]] = grid["searches"]["nicest"].nodes
+    return [
+        (
+            Location(nodes[source][0] + 0.0003, nodes[source][1] + 0.0001),
+            Location(nodes[target][0] - 0.0002, nodes[target][1] + 0.0004),
+        )
+        for source, target in grid["pairs"]
+        if source != target
+    ]
+
+
+@pytest.mark.parametrize("profile", ["nicest", "shortest"])
+@pytest.mark.parametrize("engine, snap", _routes)
+def test_compact_routes_match_multigraph(
+    grid: dict, tmp_path, profile: str, engine: str, snap: str
+) -> None:
+    router, compact = _cached(grid, profile, str(tmp_path / "graph.npz"))
+    for start, end in _points(grid):
+        assert compact.shortest_path(start, end, engine, snap) == router.shortest_path(
+            start, end, engine, snap
+        )
+
+
+# Roads closed on both graphs are avoided the same way, and reopen the same way
+def test_compact_closures_match_multigraph(grid: dict, tmp_path) -> None:
+    router, compact = _cached(grid, "nicest", str(tmp_path / "graph.npz"))
+    west, south = grid["searches"]["nicest"].coordinates.min(axis=0)
+    east, north = grid["searches"]["nicest"].coordinates.max(axis=0)
+    area = shapely.box(
+        west + 0.4 * (east - west),
+        south + 0.4 * (north - south),
+        west + 0.6 * (east - west),
+        south + 0.6 * (north - south),
+    )
+    assert len(select_edges(compact.graph, area=area)) > 0
+    closures: list[tuple] = [
+        (graph, close_edges(graph, select_edges(graph, area=area)))
+        for graph in [router.graph, compact.graph]
+    ]
+    try:
+        for start, end in _points(grid):
+            try:
+                expected = router.shortest_path(start, end, "dijkstra")
+            except Exception:
+                with pytest.raises(Exception):
+                    compact.shortest_path(start, end, "dijkstra")
+                continue
+            assert compact.shortest_path(start, end, "dijkstra") == expected
+    finally:
+        for graph, override_id in closures:
+            remove_override(graph, override_id)
+
+
+# A weight function of one edge at a time, not vectorized
+def _plain_distance(u: tuple, v: tuple, maxspeed: float, fclass: str) -> float:
+    return float(haversine(np.array(u), np.array(v)))
+
+
+# Plain weight functions weigh the compact graph as they weigh the MultiGraph
+def test_compact_plain_weights_match_multigraph(grid: dict, tmp_path) -> None:
+    path: str = str(tmp_path / "graph.npz")
+    router = prepare_router(grid["graph"], main.weight_profiles["shortest"])
+    cache_graph(grid["graph"], "test", router.prepare(), path)
+    compact, _ = read_graph_from_cache("test", path)
+
+    expected = prepare_router(grid["graph"], _plain_distance)
+    plain = prepare_router(compact, _plain_distance)
+    assert plain.prepare() == expected.prepare()
+    for start, end in _points(grid):
+        assert plain.shortest_path(start, end, "dijkstra") == expected.shortest_path(
+            start, end, "dijkstra"
+        )
@@ -0,0 +1,41 @@
+import pytest
+from conftest import copy_search
+from contraction import ContractionHierarchy
+from csr import CSRGraph
+
+"""
+Paths out of a contraction hierarchy cost the same as those of Dijkstra's
+algorithm on the graph it was built from
+"""
+
+
+# Every pair routed through the hierarchy costs what dijkstra finds, along edges
+# of the graph
+def _check_pairs(csr: CSRGraph, pairs: list[tuple[int, int]]) -> None:
+    hierarchy: ContractionHierarchy = ContractionHierarchy.build(csr)
+    for source, target in pairs:
+        expected: float = csr.path_weight(csr.dijkstra(source, target))
+        path: list[int] = hierarchy.shortest_path(source, target)
+        assert path[0] == source and path[-1] == target
+        assert csr.path_weight(path) == pytest.approx(expected, rel=1e-9, abs=1e-12)
+
+
+@pytest.mark.parametrize("profile", ["nicest", "shortest"])
+def test_contraction_matches_dijkstra(grid: dict, profile: str) -> None:
+    _check_pairs(grid["searches"][profile], grid["pairs"])
+
+
+# A closed edge costs infinity, the hierarchy routes around it as Dijkstra does
+@pytest.mark.parametrize("profile", ["nicest", "shortest"])
+def test_contraction_matches_dijkstra_with_closed_edge(
+    grid: dict, profile: str
+) -> None:
+    csr: CSRGraph = copy_search(grid["searches"][profile])
+    source, target = next((s, t) for s, t in grid["pairs"] if s != t)
+    path: list[int] = csr.dijkstra(source, target)
+    u, v = path[len(path) // 2 - 1 : len(path) // 2 + 1]
+    csr.set_weight(u, v, float("inf"))
+
+    # The grid has other ways around one closed road
+    assert csr.path_weight(csr.dijkstra(source, target)) < float("inf")
+    _check_pairs(csr, grid["pairs"])
@@ -0,0 +1,48 @@
+import pytest
+from conftest import copy_search
+from csr import CSRGraph
+
+"""
+The array backed engines find paths of the same cost as Dijkstra's algorithm
+"""
+
+
+# Engines of CSRGraph checked against its dijkstra
+_engines = ["astar", "bidirectional"]
+
+
+@pytest.mark.parametrize("profile", ["nicest", "shortest"])
+@pytest.mark.parametrize("engine", _engines)
+def test_engines_match_dijkstra(grid: dict, profile: str, engine: str) -> None:
+    csr: CSRGraph = grid["searches"][profile]
+    for source, target in grid["pairs"]:
+        expected: float = csr.path_weight(csr.dijkstra(source, target))
+        path: list[int] = getattr(csr, engine)(source, target)
+        assert path[0] == source and path[-1] == target
+        assert csr.path_weight(path) == pytest.approx(expected, rel=1e-9, abs=1e-12)
+
+
+# Edges that cost nothing leave no straight line bound, so landmarks bound A*
+def test_astar_heuristic_with_free_edges(grid: dict) -> None:
+    csr: CSRGraph = grid["searches"]["nicest"]
+    assert (csr.weights == 0).any()
+    assert csr.heuristic_scale == 0
+    assert len(csr.landmark_distances()) > 0
+
+
+# Lowering a weight again after A* has found its landmarks finds them again
+@pytest.mark.parametrize("engine", _engines)
+def test_engines_match_dijkstra_after_reopening(grid: dict, engine: str) -> None:
+    csr: CSRGraph = copy_search(grid["searches"]["nicest"])
+    source, target = next((s, t) for s, t in grid["pairs"] if s != t)
+    path: list[int] = csr.dijkstra(source, target)
+    u, v = path[len(path) // 2 - 1 : len(path) // 2 + 1]
+    weight: float = csr.path_weight([u, v])
+
+    csr.set_weight(u, v, float("inf"))
+    csr.astar(source, target)
+    csr.set_weight(u, v, weight)
+    for source, target in grid["pairs"]:
+        expected: float = csr.path_weight(csr.dijkstra(source, target))
+        path = getattr(csr, engine)(source, target)
+        assert csr.path_weight(path) == pytest.approx(expected, rel=1e-9, abs=1e-12)
@@ -0,0 +1,165 @@
+import json
+import pytest
+import main
+from csr import CSRGraph
+from graph import Location, Router, close_edges, edge_keys, remove_override
+from route_cache import RouteCache, RouteKey, _path_size
+
+"""
+Finished routes are cached by the version of the graph and weights they were found
+on, least recently used first out once full, and routes found while weights are
+overridden never outlive the overrides
+"""
+
+
+# Dijkstra routes between the pairs of the grid, keyed under the "test" tag
+def _routes(grid: dict) -> list[tuple[RouteKey, list[tuple[float, float]]]]:
+    csr: CSRGraph = grid["searches"]["shortest"]
+    routes: list[tuple[RouteKey, list[tuple[float, float]]]] = []
+    for source, target in grid["pairs"]:
+        if source != target:
+            path = [csr.nodes[i] for i in csr.dijkstra(source, target)]
+            routes.append((("test", "dijkstra", path[0], path[-1]), path))
+    return routes
+
+
+# Past max_entries, the least recently used routes go first
+def test_evicts_by_entries(grid: dict) -> None:
+    routes = _routes(grid)
+    cache: RouteCache = RouteCache(max_entries=3)
+    for key, path in routes[:3]:
+        cache.put(key, path)
+    # Reading the oldest route makes the second the least recently used
+    assert cache.get(routes[0][0]) == routes[0][1]
+    cache.put(*routes[3])
+
+    assert list(cache.entries) == [routes[2][0], routes[0][0], routes[3][0]]
+    assert cache.evictions == 1
+    assert cache.bytes == sum(_path_size(path) for path in cache.entries.values())
+
+
+# Past max_bytes, routes go until the rest fit, a route larger than the whole
+# cache is not cached at all
+def test_evicts_by_bytes(grid: dict) -> None:
+    routes = _routes(grid)
+    limit: int = sum(_path_size(path) for _, path in routes[-3:])
+    cache: RouteCache = RouteCache(max_bytes=limit)
+    for key, path in routes:
+        cache.put(key, path)
+
+    assert 3 <= len(cache) < len(routes)
+    assert list(cache.entries) == [key for key, _ in routes[-len(cache) :]]
+    assert cache.bytes <= limit
+    assert cache.evictions == len(routes) - len(cache)
+
+    huge: list[tuple[float, float]] = routes[0][1] * (limit // 10)
+    cache.put(("test", "dijkstra", (0.0, 0.0), (1.0, 1.0)), huge)
+    assert ("test", "dijkstra", (0.0, 0.0), (1.0, 1.0)) not in cache.entries
+
+
+# Hits, misses, evictions and the hit rate are counted for /stats
+def test_counters(grid: dict) -> None:
+    routes = _routes(grid)
+    cache: RouteCache = RouteCache(max_entries=2)
+    assert cache.stats()["hit_rate"] == 0.0
+    for key, path in routes[:3]:
+        cache.put(key, path)
+    assert cache.get(routes[0][0]) is None
+    assert cache.get(routes[2][0]) == routes[2][1]
+    assert cache.get(routes[2][0]) == routes[2][1]
+
+    assert cache.stats() == {
+        "routes": 2,
+        "bytes": cache.bytes,
+        "hits": 2,
+        "misses": 1,
+        "evictions": 1,
+        "hit_rate": pytest.approx(2 / 3),
+    }
+
+
+# Saved routes read back the same and in the same order, within the limits of
+# the cache reading them, and files of another layout version are ignored
+def test_save_and_reload(grid: dict, tmp_path) -> None:
+    routes = _routes(grid)
+    path: str = str(tmp_path / "routes" / "routes.json")
+    cache: RouteCache = RouteCache(path=path)
+    for key, route in routes:
+        cache.put(key, route)
+    cache.get(routes[0][0])
+    cache.save()
+
+    reloaded: RouteCache = RouteCache(path=path)
+    assert list(reloaded.entries.items()) == list(cache.entries.items())
+    assert reloaded.bytes == cache.bytes
+    # A smaller cache keeps the most recently used routes
+    smaller: RouteCache = RouteCache(max_entries=2, path=path)
+    assert list(smaller.entries) == list(cache.entries)[-2:]
+    # Routes of another graph version are cached, but not found under this one
+    assert reloaded.get(("other", *routes[0][0][1:])) is None
+
+    with open(path) as file:
+        data: dict = json.load(file)
+    data["version"] += 1
+    with open(path, "w") as file:
+        json.dump(data, file)
+    assert len(RouteCache(path=path)) == 0
+
+    with open(path, "w") as file:
+        file.write("{")
+    assert len(RouteCache(path=path)) == 0
+
+
+# Discarding forgets the routes of one version tag, or only those of the tag a
+# predicate picks, and keeps the byte count
+def test_discard(grid: dict) -> None:
+    routes = _routes(grid)
+    cache: RouteCache = RouteCache()
+    for key, path in routes:
+        cache.put(key, path)
+        cache.put(("other", *key[1:]), path)
+    long: set[RouteKey] = {key for key, path in routes if len(path) > 5}
+    assert 0 < len(long) < len(routes)
+
+    cache.discard("test", lambda key, path: len(path) > 5)
+    assert {key for key in cache.entries if key[0] == "test"} == {
+        key for key, _ in routes
+    } - long
+    assert len([key for key in cache.entries if key[0] == "other"]) == len(routes)
+
+    cache.discard("test")
+    assert all(key[0] == "other" for key in cache.entries)
+    assert len(cache) == len(routes)
+    assert cache.bytes == sum(_path_size(path) for path in cache.entries.values())
+
+
+# A route across a closed road, cached under overrides by an earlier run, is not
+# returned once the road is closed again, and overridden routes are never saved
+def test_overridden_routes_are_not_kept(grid: dict, tmp_path) -> None:
+    graph = grid["graph"]
+    weight_function = main.weight_profiles["shortest"]
+    nodes: list[tuple[float, float]] = grid["searches"]["shortest"].nodes
+    source, target = next((s, t) for s, t in grid["pairs"] if s != t)
+    start, end = Location(*nodes[source]), Location(*nodes[target])
+
+    cache: RouteCache = RouteCache(path=str(tmp_path / "routes.json"))
+    router: Router = Router(graph, weight_function)
+    router.cache, router.version = cache, "test"
+    route: list[tuple[float, float]] = router.shortest_path(start, end, "dijkstra")
+    u, v = route[len(route) // 2 - 1 : len(route) // 2 + 1]
+
+    closure: int = close_edges(graph, [(u, v, key) for key in edge_keys(graph, u, v)])
+    try:
+        cache.put(("test:overridden", "dijkstra", route[0], route[-1]), route)
+        later: Router = Router(graph, weight_function)
+        later.cache, later.version = cache, "test"
+        detour: list[tuple[float, float]] = later.shortest_path(start, end, "dijkstra")
+        assert all({a, b} != {u, v} for a, b in zip(detour, detour[1:]))
+        assert ("test:overridden", "dijkstra", route[0], route[-1]) in cache.entries
+
+        cache.save()
+        saved: RouteCache = RouteCache(path=cache.path)
+        assert len(saved) > 0
+        assert all(not key[0].endswith(":overridden") for key in saved.entries)
+    finally:
+        remove_override(graph, closure)
@@ -0,0 +1,44 @@
+import math
+import pytest
+import main
+from graph import (
+    Location,
+    Router,
+    close_edges,
+    edge_keys,
+    prepare_router,
+    remove_override,
+)
+
+"""
+Points snapped onto edges route like points snapped onto nodes, and never start
+or end on a closed edge
+"""
+
+
+# A point on a closed edge snaps onto the nearest open edge, so it still routes
+@pytest.mark.parametrize("engine", ["dijkstra", "contraction"])
+def test_points_snap_past_closed_edges(grid: dict, engine: str) -> None:
+    graph = grid["graph"]
+    csr = grid["searches"]["shortest"]
+    source, target = next((s, t) for s, t in grid["pairs"] if s != t)
+    start, end = Location(*csr.nodes[source]), Location(*csr.nodes[target])
+    router: Router = prepare_router(graph, main.weight_profiles["shortest"])
+    route: list[tuple[float, float]] = router.shortest_path(start, end, "dijkstra")
+    u, v = route[len(route) // 2 - 1 : len(route) // 2 + 1]
+
+    # Points in the middle of the closed edge, and on one of its ends
+    middle: Location = Location((u[0] + v[0]) / 2, (u[1] + v[1]) / 2)
+    closure: int = close_edges(graph, [(u, v, key) for key in edge_keys(graph, u, v)])
+    try:
+        for point in [middle, Location(*u)]:
+            for first, last in [(point, end), (start, point)]:
+                path: list[tuple[float, float]] = router.shortest_path(
+                    first, last, engine, snap="edge"
+                )
+                assert len(path) >= 2
+                ids: list[int] = [csr.ids[node] for node in path[1:-1]]
+                assert math.isfinite(router.prepare_csr().path_weight(ids))
+                assert all({a, b} != {u, v} for a, b in zip(path, path[1:]))
+    finally:
+        remove_override(graph, closure)
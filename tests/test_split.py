@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+import geopandas as gpd
+from benchmark import split_by_segment, synthetic_roads
+from util import split_geometry
+
+"""
+Roads split into segments all at once give the segments, in order and with the
+attributes of their road, that splitting one segment at a time gives
+"""
+
+
+# Grid roads, with a road of two parts and a road bent at several points
+def _roads(size: int) -> gpd.GeoDataFrame:
+    roads: gpd.GeoDataFrame = synthetic_roads(size)
+    west, south = roads.total_bounds[:2]
+    extra: gpd.GeoDataFrame = gpd.GeoDataFrame(
+        {
+            "osm_id": ["multi", "bent"],
+            "fclass": ["path", "track"],
+            "name": ["Two Parts Trail", "Bent Lane"],
+            "maxspeed": [0, 30],
+        },
+        geometry=[
+            shapely.MultiLineString(
+                [
+                    [(west, south), (west + 0.001, south + 0.001)],
+                    [
+                        (west + 0.002, south),
+                        (west + 0.003, south),
+                        (west + 0.003, south + 0.001),
+                    ],
+                ]
+            ),
+            shapely.LineString(
+                [(west, south), (west + 0.0005, south + 0.0002), (west + 0.001, south)]
+            ),
+        ],
+        crs=roads.crs,
+    )
+    return pd.concat([roads, extra[roads.columns]], ignore_index=True)
+
+
+@pytest.mark.parametrize("size", [3, 10])
+def test_split_geometry_matches_by_segment(size: int) -> None:
+    roads: gpd.GeoDataFrame = _roads(size)
+    split: gpd.GeoDataFrame = split_geometry(roads)
+    expected: gpd.GeoDataFrame = split_by_segment(roads)
+
+    assert len(split) == len(expected)
+    assert list(split.columns) == list(expected.columns)
+    for column in roads.columns.drop(roads.geometry.name):
+        assert split[column].tolist() == expected[column].tolist()
+    assert (shapely.get_num_coordinates(split.geometry.values) == 2).all()
+    np.testing.assert_array_equal(
+        shapely.get_coordinates(split.geometry.values),
+        shapely.get_coordinates(np.array(expected.geometry.tolist())),
+    )
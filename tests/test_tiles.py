@@ -0,0 +1,45 @@
+import numpy as np
+import main
+import tiles
+from benchmark import synthetic_roads
+from graph import Location, largest_component, prepare_router
+from util import split_geometry
+
+"""
+Graph fragments cached per tile stitch back together into a graph that routes
+and grows isochrones with the weights cached with the fragments
+"""
+
+
+# Stitched fragments may list an edge the other way round to the key of its
+# weight, the isochrone table still finds the weight of every edge
+def test_tiled_graph_isochrones(grid: dict, tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(tiles, "_tiles_folder", str(tmp_path / "tiles"))
+    # Small tiles, so the grid is cut into several
+    monkeypatch.setattr(tiles, "_tile_size", 0.01)
+    segments = split_geometry(synthetic_roads(grid["size"]))
+    tiles.cache_tiles(segments, {}, main.build_graph_fragment, "test")
+
+    # Read last to first, so nodes on the edges of tiles come first from the tile
+    # east or north of them, and the edges reaching them from the west or south
+    # are listed the other way round to the keys of their weights
+    covering: list[tiles.Tile] = tiles.tiles_within(tuple(segments.total_bounds))
+    assert len(covering) > 1
+    fragments, weights = tiles.read_tiles(covering[::-1], "test")
+    graph = largest_component(fragments).copy()
+    assert any(edge not in weights for edge in graph.edges(keys=True))
+    router = prepare_router(
+        graph,
+        main.niceness,
+        {edge: weight for edge, weight in weights.items() if edge[0] in graph},
+    )
+
+    table = router.prepare_edge_table()
+    assert len(table.costs) == graph.number_of_edges()
+    assert np.isfinite(table.costs).all()
+    nodes: list[tuple[float, float]] = router.prepare_csr().nodes
+    start, end = Location(*nodes[0]), Location(*nodes[-1])
+    assert len(router.shortest_path(start, end, "dijkstra")) > 1
+    csr = router.prepare_csr()
+    settled, _ = csr.search_tree(csr.ids[nodes[0]], limit=500)
+    assert len(table.within(settled, 500)) > 0
@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import os
+import json
+import math
+import shutil
+import numpy as np
+import networkx as nx
+import shapely
+import util
+from typing import TYPE_CHECKING, Callable
+from cache_graph import cache_graph, read_graph_from_cache
+
+# pandas and GeoPandas are slow to import, reading graph fragments needs neither
+if TYPE_CHECKING:
+    import geopandas as gpd
+
+"""
+Partition the cache into fixed geographic tiles
+Each tile holds its part of the cached layers and a fragment of the road graph
+Route queries load only the tiles they need and stitch the fragments together
+"""
+
+
+# Width and height of a tile in degrees, about 3.6 km by 5.6 km in Vancouver
+_tile_size = 0.05
+
+# Where tiles are cached, one folder per tile
+_tiles_folder = "cache/tiles"
+
+# Column and row of a tile, counted in tile sizes from longitude and latitude 0
+Tile = tuple[int, int]
+
+
+# Get the tile a point is in
+def tile_of(pos: tuple[float, float]) -> Tile:
+    return (math.floor(pos[0] / _tile_size), math.floor(pos[1] / _tile_size))
+
+
+# Get the longitude and latitude bounds of a tile, as (xmin, ymin, xmax, ymax)
+def tile_bounds(tile: Tile) -> tuple[float, float, float, float]:
+    column, row = tile
+    return (
+        column * _tile_size,
+        row * _tile_size,
+        (column + 1) * _tile_size,
+        (row + 1) * _tile_size,
+    )
+
+
+# Get every tile that meets a bounding box, as (xmin, ymin, xmax, ymax)
+def tiles_within(bounds: tuple[float, float, float, float]) -> list[Tile]:
+    xmin, ymin, xmax, ymax = bounds
+    first_column, first_row = tile_of((xmin, ymin))
+    last_column, last_row = tile_of((xmax, ymax))
+    return [
+        (column, row)
+        for column in range(first_column, last_column + 1)
+        for row in range(first_row, last_row + 1)
+    ]
+
+
+# Get the tiles covering the corridor between two points, plus a margin in degrees
+def route_tiles(
+    start: tuple[float, float], end: tuple[float, float], margin: float = 0.01
+) -> list[Tile]:
+    return tiles_within(
+        (
+            min(start[0], end[0]) - margin,
+            min(start[1], end[1]) - margin,
+            max(start[0], end[0]) + margin,
+            max(start[1], end[1]) + margin,
+        )
+    )
+
+
+# Does a tiled cache built from the given key exist
+def tiles_exist(key: str) -> bool:
+    index: dict | None = _read_index()
+    return index is not None and index["key"] == key and index["size"] == _tile_size
+
+
+# Partition road segments and layers into tiles, and cache a graph fragment per tile
+# Each segment goes to the tile containing its midpoint, so fragments share
+# only the nodes at their boundaries, and stitch back together on those nodes
+def cache_tiles(
+    segments: gpd.GeoDataFrame,
+    layers: dict[str, gpd.GeoDataFrame],
+    build_fragment: Callable[
+        [gpd.GeoDataFrame], tuple[nx.MultiGraph, dict[tuple, float]]
+    ],
+    key: str,
+) -> None:
+    import pandas as pd
+
+    if os.path.exists(_tiles_folder):
+        shutil.rmtree(_tiles_folder)
+
+    midpoints = shapely.centroid(segments.geometry.values)
+    columns: np.ndarray = np.floor(shapely.get_x(midpoints) / _tile_size).astype(int)
+    rows: np.ndarray = np.floor(shapely.get_y(midpoints) / _tile_size).astype(int)
+
+    tiles: list[Tile] = []
+    for (column, row), positions in pd.Series(range(len(segments))).groupby(
+        [columns, rows]
+    ):
+        tile: Tile = (int(column), int(row))
+        folder: str = _tile_folder(tile)
+        os.makedirs(folder)
+
+        # Layers keep every feature meeting the tile, so some are in several tiles
+        xmin, ymin, xmax, ymax = tile_bounds(tile)
+        for name, layer in layers.items():
+            layer.cx[xmin:xmax, ymin:ymax].to_parquet(f"{folder}/{name}.parquet")
+
+        fragment, weights = build_fragment(segments.iloc[positions.values])
+        cache_graph(fragment, key, weights, path=f"{folder}/graph.npz")
+        tiles.append(tile)
+
+    with open(f"{_tiles_folder}/index.json", "w") as file:
+        json.dump({"key": key, "size": _tile_size, "tiles": tiles}, file)
+
+    util.info(f"Cached {len(tiles)} tiles")
+
+
+# Read the graph fragments of some tiles, stitched together at shared nodes
+# Tiles outside the cached area are skipped
+def read_tiles(tiles: list[Tile], key: str) -> tuple[nx.MultiGraph, dict[tuple, float]]:
+    cached: set[Tile] = _cached_tiles()
+    fragments: list[nx.MultiGraph] = []
+    weights: dict[tuple, float] = {}
+    for tile in tiles:
+        if tile not in cached:
+            continue
+        fragment = read_graph_from_cache(key, path=f"{_tile_folder(tile)}/graph.npz")
+        if fragment is None:
+            raise Exception(f"Tile {tile} is out of date, rebuild the tile cache")
+        fragments.append(fragment[0].to_graph())
+        weights.update(fragment[1])
+
+    if len(fragments) == 0:
+        raise Exception(f"No cached tiles among {tiles}")
+    return nx.compose_all(fragments), weights
+
+
+# Read a layer of some tiles, with features in several tiles only once
+def read_tile_layer(tiles: list[Tile], name: str) -> gpd.GeoDataFrame:
+    import pandas as pd
+    import geopandas as gpd
+
+    cached: set[Tile] = _cached_tiles()
+    parts: list[gpd.GeoDataFrame] = [
+        gpd.read_parquet(f"{_tile_folder(tile)}/{name}.parquet")
+        for tile in tiles
+        if tile in cached
+    ]
+    if len(parts) == 0:
+        raise Exception(f"No cached tiles among {tiles}")
+    layer: gpd.GeoDataFrame = pd.concat(parts)
+    return layer[~layer.index.duplicated()]
+
+
+# Folder a tile is cached in
+def _tile_folder(tile: Tile) -> str:
+    return f"{_tiles_folder}/{tile[0]}_{tile[1]}"
+
+
+# Tiles in the tiled cache
+def _cached_tiles() -> set[Tile]:
+    index: dict | None = _read_index()
+    if index is None:
+        return set()
+    return {tuple(tile) for tile in index["tiles"]}
+
+
+# Read the index of the tiled cache, if there is one
+def _read_index() -> dict | None:
+    path: str = f"{_tiles_folder}/index.json"
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return json.load(file)
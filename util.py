@@ -1,8 +1,23 @@
-import momepy as mpy
+from __future__ import annotations
+
+import sys
 import networkx as nx
-import geopandas as gpd
+import numpy as np
+import shapely
+from typing import TYPE_CHECKING
 from shapely.geometry import LineString
 
+# GeoPandas and momepy take seconds to import, so they are imported by the
+# functions that use them, and only for type checking here
+if TYPE_CHECKING:
+    import geopandas as gpd
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
 
 # Adapted from https://stackoverflow.com/questions/287871/how-do-i-print-colored-text-to-the-terminal
 # Terminal Codes for style
@@ -33,13 +48,55 @@ def warning(message: any) -> None:
     print_color(f"[WARN] {message}", TerminalStyle.WARNING)
 
 
+# Peak memory of this process, or of its largest finished child process, in MB
+def peak_memory_mb(children: bool = False) -> float | None:
+    if resource is None:
+        return None
+    who: int = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak: int = resource.getrusage(who).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak / 2**20
+    return peak / 2**10
+
+
+# Memory of this process in MB, as read from Linux's /proc: resident memory, its
+# proportional share, where each page is split between the processes mapping it,
+# private memory, mapped by no other process, and the peak resident memory
+# None where it cannot be measured
+def process_memory_mb() -> dict[str, float] | None:
+    fields: dict[str, int] = {}
+    try:
+        for name in ["/proc/self/smaps_rollup", "/proc/self/status"]:
+            with open(name) as file:
+                fields.update(
+                    {
+                        parts[0].rstrip(":"): int(parts[1])
+                        for parts in map(str.split, file)
+                        if len(parts) == 3 and parts[2] == "kB"
+                    }
+                )
+    except OSError:
+        return None
+    return {
+        "rss": fields["Rss"] / 2**10,
+        "pss": fields["Pss"] / 2**10,
+        "private": (fields["Private_Clean"] + fields["Private_Dirty"]) / 2**10,
+        "peak": fields["VmHWM"] / 2**10,
+    }
+
+
 # Turn a GeoPandas.GeoDataFrame to a networkx.MultiGraph of edges
 def gdf_to_graph(gdf: gpd.GeoDataFrame) -> nx.MultiGraph:
+    import momepy as mpy
+
     return mpy.gdf_to_nx(gdf, approach="primal").to_undirected()
 
 
 # Turn a networkx.MultiGraph to a GeoPandas.GeoDataFrame
 def graph_to_gdf(graph: nx.MultiGraph) -> gpd.GeoDataFrame:
+    import momepy as mpy
+
     return mpy.nx_to_gdf(graph)[1]
 
 
@@ -50,16 +107,24 @@ def segment(linestring: LineString) -> map:
 
 # Split the edges of a GeoPandas.GeoDataFrame into individual LineStrings that span 2 points
 def split_geometry(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    result = gpd.GeoDataFrame(columns=gdf.columns)
-    rows = gdf.apply(lambda row: (segment(row.geometry), row), axis=1)
-    i = 0
-    for row in rows:
-        split_geometry = row[0]
-        data = row[1]
-        for geometry in split_geometry:
-            # Add line-by-line
-            result.loc[i] = data
-            result.loc[i, "geometry"] = geometry
-            i += 1
-
+    import geopandas as gpd
+
+    # Multi-part lines are split into their parts first, so no segment joins the
+    # end of one part to the start of the next
+    parts, rows = shapely.get_parts(gdf.geometry.values, return_index=True)
+
+    # All coordinates at once, with the part each coordinate belongs to
+    coordinates, part_of = shapely.get_coordinates(parts, return_index=True)
+
+    # A segment joins each coordinate to the next one of the same part
+    same_part: np.ndarray = part_of[:-1] == part_of[1:]
+    starts: np.ndarray = coordinates[:-1][same_part]
+    ends: np.ndarray = coordinates[1:][same_part]
+    segments: np.ndarray = shapely.linestrings(np.stack([starts, ends], axis=1))
+
+    # Repeat the attributes of each row once for each of its segments
+    result: gpd.GeoDataFrame = gdf.iloc[rows[part_of[:-1][same_part]]].reset_index(
+        drop=True
+    )
+    result[gdf.geometry.name] = gpd.GeoSeries(segments, crs=gdf.crs)
     return result